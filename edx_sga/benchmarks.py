@@ -0,0 +1,598 @@
+"""
+Benchmarks for the Staff Graded Assignment XBlock.  These are not part of the
+test suite.  Run them explicitly, with the same settings as the tests::
+
+    python -m unittest edx_sga.benchmarks
+
+They use the test database, SQLite in memory or otherwise, and store files
+in a temporary `FileSystemStorage`.  Environment variables size them:
+
+SGA_BENCHMARK_LEARNERS
+    Comma separated sizes of the synthetic courses to build, eg
+    "100,1000,10000,50000".  Defaults to "100,1000,10000".
+
+SGA_BENCHMARK_THREADS
+    How many learners upload at once in the deadline rush.  Defaults to 8.
+
+SGA_BENCHMARK_UPLOADS, SGA_BENCHMARK_FILE_KB
+    How many files are uploaded in the deadline rush, and how big each is.
+    Default to 400 and 256.
+
+SGA_BENCHMARK_GRADERS
+    How many staff change students' states at once.  Defaults to 8.  This
+    needs a database which threads can connect to separately, so it is
+    skipped with an in-memory SQLite database.
+
+SGA_BENCHMARK_UPLOAD_MB, SGA_BENCHMARK_DOWNLOAD_MB
+    The size of the single large file uploaded, and downloaded.  Default to
+    1024 and 256.
+
+SGA_BENCHMARK_OUTPUT
+    A file to append results to, one JSON object per line, as well as
+    printing them.  Each has the benchmark's `name` and `params`, its
+    `metrics`, and the database and Python used.  Metrics are seconds,
+    except for rates, which end with `_per_s`, sizes, which end with `_kb`,
+    and counts.  `peak_rss_kb`, the most memory the benchmark used, is
+    measured on Linux only.
+
+Two result files can be compared with::
+
+    python -m edx_sga.benchmarks baseline.json results.json [tolerance]
+
+which lists each metric more than `tolerance` (default 0.2, ie 20%) worse
+than it was, and exits non-zero if there are any.  Rates and the metrics in
+`HIGHER_IS_BETTER` are worse when they go down, all others when they go up.
+"""
+import datetime
+import hashlib
+import json
+import mock
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from courseware.models import StudentModule
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import connection, connections
+from functools import partial
+from student.models import UserProfile
+
+from edx_sga.models import Submission
+from edx_sga.tests import DummyUpload, StaffGradedAssignmentTestCase
+from edx_sga.utils import invalidate_statistics
+
+LEARNERS = [int(n) for n in os.environ.get(
+    'SGA_BENCHMARK_LEARNERS', '100,1000,10000').split(',')]
+THREADS = int(os.environ.get('SGA_BENCHMARK_THREADS', 8))
+UPLOADS = int(os.environ.get('SGA_BENCHMARK_UPLOADS', 400))
+FILE_KB = int(os.environ.get('SGA_BENCHMARK_FILE_KB', 256))
+OUTPUT = os.environ.get('SGA_BENCHMARK_OUTPUT')
+
+# Rows per bulk insert, few enough for SQLite's limit on query parameters.
+INSERT_BATCH_SIZE = 50
+
+# Metrics, besides rates, which are better the higher they are.
+HIGHER_IS_BETTER = frozenset(['reloads'])
+
+
+def timed(func, *args, **kw):
+    """
+    Calls `func` and returns how long the call took, in seconds.
+    """
+    start = time.time()
+    func(*args, **kw)
+    return time.time() - start
+
+
+def peak_rss_kb():
+    """
+    Returns the most memory this process has used since this was last
+    called, in kilobytes, so that each benchmark's use is measured on its
+    own.  Returns `None` where the peak can't be reset, which is everywhere
+    but Linux 4.0 and later.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            peak = [int(line.split()[1]) for line in status
+                    if line.startswith('VmHWM:')]
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        return None
+    return peak[0] if peak else None
+
+
+def report(name, params=None, **metrics):
+    """
+    Prints a benchmark's results, and appends them to `OUTPUT`, if set.
+    The memory it used since it started, or since its last report, is
+    added to them.
+    """
+    metrics['peak_rss_kb'] = peak_rss_kb()
+    print("%s: %s" % (name, ", ".join(
+        "%s=%s" % (key, _format(key, value))
+        for key, value in sorted(metrics.items()))))
+    if OUTPUT:
+        result = {
+            'name': name,
+            'params': params or {},
+            'metrics': metrics,
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'time': datetime.datetime.utcnow().isoformat(),
+        }
+        with open(OUTPUT, 'a') as output:
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def _format(key, value):
+    if isinstance(value, float) and key.endswith('_per_s'):
+        return "%.1f/s" % value
+    if isinstance(value, float):
+        return "%.3fs" % value
+    return str(value)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def shared_connections():
+    """
+    Returns the database connections which threads have to share, since
+    they are to in-memory SQLite databases.
+    """
+    return dict(
+        (conn.alias, conn) for conn in connections.all()
+        if conn.vendor == 'sqlite' and
+        conn.settings_dict['NAME'] in (':memory:', ''))
+
+
+def run_threads(count, target, *args):
+    """
+    Runs `target(i, *args)` on `count` threads at once, and waits for them
+    all.  An in-memory SQLite database only exists on the connection which
+    made it, so that connection is shared with the threads, as Django's
+    `LiveServerTestCase` does.  SQLite then runs their queries one at a
+    time.
+    """
+    shared = shared_connections()
+    for conn in shared.values():
+        conn.allow_thread_sharing = True
+
+    def run(i):
+        for alias, conn in shared.items():
+            connections[alias] = conn
+        try:
+            target(i, *args)
+        finally:
+            if not shared:
+                connection.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class SyntheticCourse(object):
+    """
+    Fills the database with learners for a block, quickly, with bulk
+    inserts.  `submitted` and `graded` are the fractions of learners who
+    have uploaded a file and been graded.  Uploads are `files` distinct
+    small files, stored for real so they can be downloaded.
+    """
+
+    def __init__(self, block, learners, submitted=0.8, graded=0.5, files=16):
+        from edx_sga.sga import _save_file
+        self.block = block
+        self.url = block.location.url()
+        self.course_id = block.xmodule_runtime.course_id
+        self.prefix = 'bench%d-' % learners
+        sha1s = [_save_file(self.url, ContentFile(os.urandom(2**12)),
+                            'essay.pdf')
+                 for i in range(files)]
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+
+        users = [User(username='%s%d' % (self.prefix, i),
+                      email='%s%d@example.com' % (self.prefix, i))
+                 for i in range(learners)]
+        self._insert(User, users)
+        user_ids = self.users().values_list('id', flat=True)
+        self._insert(UserProfile, [
+            UserProfile(user_id=user_id, name='Learner %d' % user_id)
+            for user_id in user_ids])
+
+        modules = []
+        self.states = {}
+        for i, user_id in enumerate(user_ids):
+            state = {}
+            if i < learners * submitted:
+                state.update(
+                    uploaded_sha1=sha1s[i % files],
+                    uploaded_filename='essay.pdf',
+                    uploaded_mimetype='application/pdf',
+                    uploaded_timestamp=now)
+            if i < learners * graded:
+                state.update(score=i % 100, score_published=i % 2 == 0)
+            self.states[user_id] = state
+            modules.append(StudentModule(
+                module_state_key=self.url, module_type='edx_sga',
+                student_id=user_id, course_id=self.course_id,
+                state=json.dumps(state)))
+        self._insert(StudentModule, modules)
+
+        self.module_ids = []
+        submissions = []
+        for module_id, user_id in self.modules().values_list(
+                'id', 'student_id'):
+            self.module_ids.append(module_id)
+            submissions.append(Submission(
+                module_id=module_id,
+                **Submission.values_from_state(self.states[user_id])))
+        self._insert(Submission, submissions)
+        invalidate_statistics((self.course_id, self.url))
+
+    def _insert(self, model, objects):
+        for i in range(0, len(objects), INSERT_BATCH_SIZE):
+            model.objects.bulk_create(objects[i:i + INSERT_BATCH_SIZE])
+
+    def users(self):
+        return User.objects.filter(username__startswith=self.prefix)
+
+    def modules(self):
+        return StudentModule.objects.filter(
+            module_state_key=self.url, student__username__startswith=self.prefix)
+
+    def delete(self):
+        Submission.objects.filter(module__in=self.module_ids).delete()
+        self.modules().delete()
+        UserProfile.objects.filter(
+            user__username__startswith=self.prefix).delete()
+        self.users().delete()
+        invalidate_statistics((self.course_id, self.url))
+
+
+class BenchmarkCase(StaffGradedAssignmentTestCase):
+
+    def setUp(self):
+        super(BenchmarkCase, self).setUp()
+        peak_rss_kb()  # Don't count what ran before
+
+
+class GradingBenchmarks(BenchmarkCase):
+    students = 300
+
+    def make_students(self, block):
+        return [self.make_student_module(block, "student%d" % i)
+                for i in range(self.students)]
+
+    def test_enter_grades(self):
+        block = self.make_one()
+        modules = self.make_students(block)
+
+        def one_at_a_time():
+            for module in modules:
+                block.enter_grade(mock.Mock(params={
+                    'module_id': module.id,
+                    'grade': 7,
+                    'comment': "Good!"}))
+
+        def all_at_once():
+            block.enter_grades(mock.Mock(method='POST', body=json.dumps({
+                'grades': [
+                    {'module_id': module.id, 'grade': 8, 'comment': "Good!"}
+                    for module in modules]})))
+
+        report("enter_grades (%d students)" % self.students,
+               enter_grade=timed(one_at_a_time),
+               enter_grades=timed(all_at_once))
+
+
+class UploadBenchmarks(BenchmarkCase):
+    megabytes = int(os.environ.get('SGA_BENCHMARK_UPLOAD_MB', 1024))
+
+    def make_upload(self):
+        upload = tempfile.NamedTemporaryFile()
+        self.addCleanup(upload.close)
+        block = os.urandom(2**20)
+        for i in range(self.megabytes):
+            upload.write(block)
+        upload.flush()
+        upload.seek(0)
+        return upload
+
+    def test_save_file(self):
+        from edx_sga import sga
+        upload = self.make_upload()
+
+        def hash_then_save():
+            # How uploads were stored before: hash, rewind, then store.
+            sha1 = hashlib.sha1()
+            for block in iter(partial(upload.read, 2**13), ''):
+                sha1.update(block)
+            upload.seek(0)
+            path = sga._file_storage_path(
+                'i4x://foo/bar/baz/before', sha1.hexdigest(), 'test.bin')
+            if not sga.default_storage.exists(path):
+                sga.default_storage.save(path, File(upload))
+
+        def single_pass():
+            upload.seek(0)
+            sga._save_file('i4x://foo/bar/baz/after', upload, 'test.bin')
+
+        report("save %dMB upload" % self.megabytes,
+               hash_then_save=timed(hash_then_save),
+               single_pass=timed(single_pass))
+
+
+class RenderBenchmarks(BenchmarkCase):
+    renders = 1000
+
+    def test_student_view(self):
+        from edx_sga.sga import clear_caches
+        block = self.make_one()
+
+        def uncached():
+            for i in range(self.renders):
+                clear_caches()
+                block.student_view()
+
+        def cached():
+            for i in range(self.renders):
+                block.student_view()
+
+        report("student_view (%d renders)" % self.renders,
+               uncached=timed(uncached),
+               cached=timed(cached))
+
+
+class CourseBenchmarkCase(BenchmarkCase):
+
+    def make_block(self, user_id=1):
+        block = self.make_one(points=100)
+        block.scope_ids = mock.Mock(user_id=user_id)
+        block.xmodule_runtime = mock.Mock(
+            course_id=self.runtime.course_id, user_is_staff=True)
+        return block
+
+    def make_course(self, learners, **kw):
+        course = SyntheticCourse(self.make_block(), learners, **kw)
+        self.addCleanup(course.delete)
+        return course
+
+
+class DeadlineRushBenchmarks(CourseBenchmarkCase):
+    """
+    What the hour before a due date looks like: courses of each size in
+    `LEARNERS`, many learners uploading at once, and staff reloading the
+    gradebook.
+    """
+
+    def test_gradebook(self):
+        for learners in LEARNERS:
+            course = self.make_course(learners)
+            block = course.block
+
+            def statistics():
+                invalidate_statistics((course.course_id, course.url))
+                block.statistics()
+
+            def csv():
+                for line in block.staff_download_grades(
+                        mock.Mock(params={})).app_iter:
+                    pass
+
+            report("gradebook", {'learners': learners},
+                   full=timed(block.staff_grading_data),
+                   first_page=timed(block.staff_grading_data, limit=100),
+                   ungraded_by_score=timed(
+                       block.staff_grading_data, sort='score',
+                       status='ungraded', limit=100),
+                   statistics=timed(statistics),
+                   csv=timed(csv))
+            course.delete()
+
+    def test_upload_rush(self):
+        """
+        `THREADS` learners at a time upload `UPLOADS` files between them,
+        while staff reload the first page of the gradebook.
+        """
+        course = self.make_course(max(LEARNERS[0], UPLOADS), submitted=0)
+        user_ids = list(course.users().values_list('id', flat=True))
+        upload = tempfile.NamedTemporaryFile()
+        self.addCleanup(upload.close)
+        upload.write(os.urandom(FILE_KB * 1024))
+        upload.flush()
+        done = threading.Event()
+        errors = []
+        upload_times = []
+        reload_times = []
+
+        def learner(i):
+            for user_id in user_ids[i:UPLOADS:THREADS]:
+                block = self.make_block(user_id)
+                request = mock.Mock(content_length=None, params={
+                    'assignment': mock.Mock(file=DummyUpload(
+                        upload.name, 'essay%d.pdf' % user_id))})
+                try:
+                    upload_times.append(
+                        timed(block.upload_assignment, request))
+                except Exception as error:
+                    errors.append(error)
+
+        def staff():
+            block = self.make_block()
+            while not done.is_set():
+                reload_times.append(timed(
+                    block.get_staff_grading_data,
+                    mock.Mock(params={'limit': '100'})))
+
+        finished = []
+        lock = threading.Lock()
+
+        def worker(i):
+            if i == THREADS:
+                return staff()
+            try:
+                learner(i)
+            finally:
+                with lock:
+                    finished.append(i)
+                    if len(finished) == THREADS:
+                        done.set()
+
+        elapsed = timed(run_threads, THREADS + 1, worker)
+
+        uploaded = len(upload_times)
+        report("upload_rush",
+               {'threads': THREADS, 'uploads': UPLOADS, 'file_kb': FILE_KB},
+               elapsed=elapsed,
+               uploads_per_s=uploaded / elapsed,
+               mb_per_s=uploaded * FILE_KB / 1024.0 / elapsed,
+               upload_median=percentile(upload_times, 0.5),
+               upload_p95=percentile(upload_times, 0.95),
+               reloads=len(reload_times),
+               reload_median=percentile(reload_times, 0.5),
+               reload_p95=percentile(reload_times, 0.95),
+               errors=len(errors))
+        self.assertEqual(errors, [])
+        self.assertEqual(Submission.objects.filter(
+            module__in=course.module_ids,
+            uploaded_sha1__isnull=False).count(), UPLOADS)
+
+    def test_download_streaming(self):
+        from edx_sga import sga
+        megabytes = int(os.environ.get('SGA_BENCHMARK_DOWNLOAD_MB', 256))
+        upload = tempfile.NamedTemporaryFile()
+        self.addCleanup(upload.close)
+        for i in range(megabytes):
+            upload.write(os.urandom(2**20))
+        upload.flush()
+        upload.seek(0)
+        block = self.make_block()
+        block.uploaded_sha1 = sga._save_file(
+            block.location.url(), upload, 'big.bin')
+        block.uploaded_filename = 'big.bin'
+        block.uploaded_mimetype = 'application/octet-stream'
+
+        def download():
+            for chunk in block.download_assignment(
+                    mock.Mock(headers={})).app_iter:
+                pass
+
+        elapsed = timed(download)
+        report("download", {'megabytes': megabytes},
+               elapsed=elapsed, mb_per_s=megabytes / elapsed)
+
+        learners = LEARNERS[0]
+        course = self.make_course(learners, submitted=1)
+
+        def download_zip():
+            response = course.block.staff_download_submissions(
+                mock.Mock(params={}))
+            return sum(len(chunk) for chunk in response.app_iter)
+
+        elapsed = timed(download_zip)
+        report("download_zip", {'learners': learners},
+               elapsed=elapsed, files_per_s=learners / elapsed)
+
+
+class ConcurrentGradingBenchmarks(CourseBenchmarkCase):
+    """
+    Many staff changing the same students' states at once.  Each grader
+    writes a key of its own to every student, so any update lost to another
+    grader's shows up as a missing or stale key.
+    """
+    graders = int(os.environ.get('SGA_BENCHMARK_GRADERS', 8))
+    rounds = 5
+
+    def test_parallel_graders(self):
+        if shared_connections():
+            self.skipTest("Threads can't have connections of their own to "
+                          "an in-memory SQLite database.")
+        course = self.make_course(LEARNERS[0])
+        module_ids = course.module_ids
+
+        def grade(grader, conflicts):
+            block = self.make_block()
+            for i in range(self.rounds):
+                block.update_student_states(dict(
+                    (module_id, {'grader%d' % grader: i})
+                    for module_id in module_ids), conflicts)
+
+        def run(graders):
+            conflicts = set()
+            elapsed = timed(run_threads, graders, grade, conflicts)
+            return elapsed, conflicts
+
+        updates = len(module_ids) * self.rounds
+        one_per_s = updates / run(1)[0]
+        elapsed, conflicts = run(self.graders)
+        many_per_s = updates * self.graders / elapsed
+        report("parallel_graders",
+               {'learners': len(module_ids), 'graders': self.graders},
+               one_grader_per_s=one_per_s,
+               updates_per_s=many_per_s,
+               conflicts=len(conflicts))
+
+        self.assertEqual(conflicts, set())
+        # Graders may not speed each other up, but mustn't grind to a halt
+        self.assertTrue(many_per_s > one_per_s / 2)
+        for module_id, state in course.modules().values_list('id', 'state'):
+            state = json.loads(state)
+            for grader in range(self.graders):
+                self.assertEqual(state['grader%d' % grader], self.rounds - 1)
+
+
+def compare(baseline, results, tolerance=0.2):
+    """
+    Compares two result files written by the benchmarks, and returns a line
+    for each metric which is more than `tolerance` worse in `results`.  A
+    metric which was zero is worse by any amount.
+    """
+    def load(path):
+        with open(path) as lines:
+            return dict(
+                ((result['name'], json.dumps(result['params'],
+                                             sort_keys=True)), result)
+                for result in map(json.loads, lines))
+
+    before, after = load(baseline), load(results)
+    worse = []
+    for key in sorted(set(before) & set(after)):
+        for metric, old in sorted(before[key]['metrics'].items()):
+            new = after[key]['metrics'].get(metric)
+            if old is None or new is None:
+                continue
+            if metric.endswith('_per_s') or metric in HIGHER_IS_BETTER:
+                loss = old - new
+            else:
+                loss = new - old
+            if loss <= 0:
+                continue
+            if not old:
+                worse.append("%s %s %s: %s -> %s" % (
+                    key[0], key[1], metric, old, new))
+            elif loss / float(abs(old)) > tolerance:
+                worse.append("%s %s %s: %s -> %s (%d%% worse)" % (
+                    key[0], key[1], metric, old, new,
+                    loss * 100 / float(abs(old))))
+    return worse
+
+
+if __name__ == '__main__':
+    worse = compare(*sys.argv[1:3],
+                    tolerance=float(sys.argv[3]) if len(sys.argv) > 3 else 0.2)
+    for line in worse:
+        print(line)
+    sys.exit(1 if worse else 0)
@@ -0,0 +1,201 @@
+"""
+Deletes stored files which no student's state refers to any more, such as
+uploads which students have since replaced and annotated files removed along
+with a grade, and temporary files left by uploads which never finished.
+
+Files are stored in a folder per block, named by their SHA1, see
+`edx_sga.sga._file_storage_path`.  Blocks are collected one at a time: the
+SHA1s which the block's student states refer to are gathered a batch of
+states at a time, then the block's folder is listed and anything else in it
+is deleted.  So memory use depends on the number of students in the largest
+block, not on how many files are stored overall.  Since a student may have
+gone back to a file meanwhile, and a file already stored is used again
+rather than stored twice, whether anything refers to a file, and how old it
+is, are looked up again just before it is deleted.  A file which is used
+again is made new, see `edx_sga.sga._refresh_stored_file`, so it is kept
+while the state which is to refer to it is saved.
+
+Under the shared storage layout, files are stored once for every block, see
+`edx_sga.utils.blob_path`.  These are collected a subfolder at a time, by
+looking up which of the SHA1s in it any `Submission` refers to.  So the
+`Submission` table must have been filled in, with the
+`backfill_sga_submissions` command, before they are collected.
+"""
+import datetime
+import json
+import logging
+
+from courseware.models import StudentModule
+from django.core.files.storage import default_storage
+from django.db.models import Q
+
+from edx_sga.models import Submission
+from edx_sga.utils import (
+    BATCH_SIZE, BLOB_PREFIX, iterate_in_batches, storage_prefix)
+
+log = logging.getLogger(__name__)
+
+# Files younger than this are never deleted, since a student's state is only
+# saved after the file they uploaded has been stored.
+MIN_AGE = datetime.timedelta(days=1)
+
+
+def collect_garbage(course_id=None, dry_run=False, min_age=MIN_AGE,
+                    batch_size=BATCH_SIZE):
+    """
+    Deletes the files stored for Staff Graded Assignments, in the given
+    course or in all of them, which no student's state refers to and which
+    are older than `min_age`.  Files shared between blocks are only
+    collected for all courses.  With `dry_run`, only logs what would be
+    deleted.  Returns the number of files checked and the number deleted.
+    """
+    modules = StudentModule.objects.filter(module_type='edx_sga')
+    if course_id is not None:
+        modules = modules.filter(course_id=course_id)
+    blocks = modules.values('module_state_key').distinct()
+    cutoff = datetime.datetime.now() - min_age
+
+    checked = deleted = 0
+    for block in iterate_in_batches(
+            blocks, batch_size, order=('module_state_key',)):
+        url = block['module_state_key']
+        live = _live_references(
+            modules.filter(module_state_key=url), batch_size)
+        prefix = storage_prefix(url)
+        for path in _stored_files(prefix):
+            checked += 1
+            reference = _reference(path[len(prefix) + 1:])
+            if reference in live or not _older_than(path, cutoff):
+                continue
+            if reference is not None and modules.filter(
+                    module_state_key=url, state__contains=reference).exists():
+                continue
+            if _older_than(path, cutoff):
+                _delete(path, dry_run)
+                deleted += 1
+
+    if course_id is None:
+        for folder in _blob_folders():
+            files = _list_files(folder)
+            live = _live_blobs(set(_sha1(name) for name in files))
+            for name in files:
+                checked += 1
+                path = folder + '/' + name
+                if _sha1(name) in live or not _older_than(path, cutoff):
+                    continue
+                if not _live_blobs([_sha1(name)]) and _older_than(
+                        path, cutoff):
+                    _delete(path, dry_run)
+                    deleted += 1
+
+    return checked, deleted
+
+
+def _delete(path, dry_run):
+    log.info("%s unreferenced file %s",
+             "Would delete" if dry_run else "Deleting", path)
+    if not dry_run:
+        default_storage.delete(path)
+
+
+def _live_references(modules, batch_size):
+    """
+    Returns the SHA1s of the files, and the ids of the chunked uploads in
+    progress, which the given student modules' states refer to.
+    """
+    live = set()
+    query = modules.values('id', 'state')
+    for module in iterate_in_batches(query, batch_size):
+        state = json.loads(module['state'] or '{}')
+        live.add(state.get('uploaded_sha1'))
+        live.add(state.get('annotated_sha1'))
+        upload = state.get('chunked_upload')
+        if upload:
+            live.add(upload['upload_id'])
+    live.discard(None)
+    return live
+
+
+def _live_blobs(sha1s):
+    """
+    Returns which of `sha1s` any submission refers to.
+    """
+    if not sha1s:
+        return set()
+    live = set()
+    sha1s = list(sha1s)
+    query = Submission.objects.filter(
+        Q(uploaded_sha1__in=sha1s) | Q(annotated_sha1__in=sha1s))
+    for uploaded, annotated in query.values_list(
+            'uploaded_sha1', 'annotated_sha1'):
+        live.add(uploaded)
+        live.add(annotated)
+    return live
+
+
+def _blob_folders():
+    """
+    Generates the subfolders which files are stored in under the shared
+    storage layout.
+    """
+    for first in _list_folders(BLOB_PREFIX):
+        for second in _list_folders(BLOB_PREFIX + '/' + first):
+            yield '%s/%s/%s' % (BLOB_PREFIX, first, second)
+
+
+def _list_folders(folder):
+    try:
+        return default_storage.listdir(folder)[0]
+    except OSError:
+        return []  # No such folder
+
+
+def _list_files(folder):
+    try:
+        return default_storage.listdir(folder)[1]
+    except OSError:
+        return []  # No such folder
+
+
+def _stored_files(folder):
+    """
+    Generates the paths of the files under `folder` in storage.
+    """
+    try:
+        folders, files = default_storage.listdir(folder)
+    except OSError:
+        return  # No such folder
+    for name in files:
+        yield folder + '/' + name
+    for name in folders:
+        for path in _stored_files(folder + '/' + name):
+            yield path
+
+
+def _reference(path):
+    """
+    Returns what a student's state refers to the file at `path`, relative
+    to a block's folder, by: its SHA1, or for chunks of uploads in progress,
+    which are stored under `tmp/<upload id>/`, the upload's id.  Returns
+    `None` for other temporary files, which nothing refers to.
+    """
+    parts = path.split('/')
+    if parts[0] == 'tmp':
+        return parts[1] if len(parts) > 2 else None
+    return _sha1(parts[-1])
+
+
+def _sha1(name):
+    """
+    Returns the SHA1 of the stored file with the given name.  Files derived
+    from it, such as its preview, are named for it too.
+    """
+    return name.split('.', 1)[0]
+
+
+def _older_than(path, cutoff):
+    try:
+        return default_storage.modified_time(path) < cutoff
+    except NotImplementedError:
+        # Can't tell how old the file is, so leave it be.
+        return False
@@ -0,0 +1,116 @@
+"""
+The gradebook for a whole course: every learner's submission and grade
+status for every Staff Graded Assignment in it, as a matrix with a row per
+learner and a column per assignment.
+
+It is read straight from the student modules and their `Submission` rows,
+in one query fetched a batch at a time, without loading any of the blocks.
+So it only knows about assignments which at least one learner has opened,
+names them by their location, and can't tell their maximum scores.  Rows
+are generated as they are read, so a course of any size can be streamed.
+"""
+import csv
+import itertools
+import json
+
+from courseware.models import StudentModule
+
+from edx_sga.utils import BATCH_SIZE, CSVLine, csv_value, iterate_in_batches
+
+COLUMNS = (
+    'student_id', 'module_state_key', 'student__username',
+    'student__profile__name', 'sga_submission__uploaded_sha1',
+    'sga_submission__score', 'sga_submission__score_published')
+
+
+def course_gradebook(course_id, batch_size=BATCH_SIZE):
+    """
+    Returns the locations of the assignments in the course, and a generator
+    of `(username, fullname, cells)` for each learner, in order of user id.
+    `cells` has a `(status, score)` pair for each assignment, in the same
+    order, where `status` is one of `edx_sga.sga.GRADING_STATUSES`.
+    """
+    modules = StudentModule.objects.filter(
+        course_id=course_id, module_type='edx_sga')
+    assignments = list(modules.values_list(
+        'module_state_key', flat=True).distinct().order_by(
+            'module_state_key'))
+    return assignments, _learners(modules, assignments, batch_size)
+
+
+def _learners(modules, assignments, batch_size):
+    missing = ('missing', None)
+    rows = iterate_in_batches(
+        modules.values(*COLUMNS), batch_size,
+        order=('student_id', 'module_state_key'))
+    for student_id, group in itertools.groupby(
+            rows, lambda row: row['student_id']):
+        cells = {}
+        for row in group:
+            cells[row['module_state_key']] = _cell(row)
+        yield (row['student__username'], row['student__profile__name'],
+               [cells.get(url, missing) for url in assignments])
+
+
+def _cell(row):
+    score = row['sga_submission__score']
+    if score is not None:
+        if row['sga_submission__score_published']:
+            return 'published', score
+        return 'unpublished', score
+    if row['sga_submission__uploaded_sha1']:
+        return 'ungraded', None
+    return 'missing', None
+
+
+def assignment_name(url):
+    """
+    Returns the short name of the assignment at `url`, its last part.
+    """
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def gradebook_csv(course_id, batch_size=BATCH_SIZE):
+    """
+    Generates the lines of the course's gradebook as a CSV file, with a
+    score and a status column for each assignment.
+    """
+    assignments, learners = course_gradebook(course_id, batch_size)
+    writer = csv.writer(CSVLine())
+    header = ['username', 'fullname']
+    for url in assignments:
+        name = assignment_name(url)
+        header.extend((name, name + ' status'))
+    yield writer.writerow([csv_value(column) for column in header])
+    for username, fullname, cells in learners:
+        row = [username, fullname]
+        for status, score in cells:
+            row.extend((score, status))
+        yield writer.writerow([csv_value(value) for value in row])
+
+
+def gradebook_json(course_id, batch_size=BATCH_SIZE):
+    """
+    Generates the course's gradebook as chunks of a JSON document, with the
+    `assignments` and a row for each of the `learners`, each with a
+    `{"status", "score"}` cell for each assignment.
+    """
+    assignments, learners = course_gradebook(course_id, batch_size)
+    yield '{"course_id": %s, "assignments": %s, "learners": [' % (
+        json.dumps(course_id), json.dumps(assignments))
+    separator = '\n'
+    for username, fullname, cells in learners:
+        yield separator + json.dumps({
+            'username': username,
+            'fullname': fullname,
+            'cells': [{'status': status, 'score': score}
+                      for status, score in cells],
+        })
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+FORMATS = {
+    'csv': (gradebook_csv, 'text/csv'),
+    'json': (gradebook_json, 'application/json'),
+}
@@ -0,0 +1,286 @@
+"""
+Measures where the time goes in each request to a Staff Graded Assignment.
+
+Each handler, and `student_view` and `studio_view`, is wrapped with
+`instrumented`, which records a `Measurement` of the call: its wall time,
+the number of database queries run and the time they took, the calls made
+to storage and the time they took, and the number of bytes in the response.
+For a streamed response, the measurement goes on until the response has been
+sent, so downloads are measured as a whole.
+
+Measurements are passed to each of the sinks listed, as dotted paths, in the
+`SGA_METRICS_SINKS` setting, or added with `add_sink`.  A sink is any
+callable which takes a `Measurement`.  `log_sink` logs each measurement,
+`statsd_sink` sends them to statsd, see `StatsdSink`, and `MemorySink` keeps
+them, for tests.  With no sinks, the default, nothing is measured.
+
+Counting queries turns on Django's debug cursor for the duration of the
+call, as `settings.DEBUG` does, and storage calls are only counted through
+`InstrumentedStorage`.
+"""
+import functools
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from webob.response import Response
+
+log = logging.getLogger(__name__)
+
+SINKS = list(getattr(settings, 'SGA_METRICS_SINKS', ()))
+STATSD_HOST = getattr(settings, 'SGA_STATSD_HOST', 'localhost')
+STATSD_PORT = getattr(settings, 'SGA_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'SGA_STATSD_PREFIX', 'edx_sga')
+
+_local = threading.local()
+
+
+def add_sink(sink):
+    """
+    Adds a sink, or the dotted path of one, to pass measurements to.
+    """
+    SINKS.append(sink)
+
+
+def remove_sink(sink):
+    SINKS.remove(sink)
+
+
+class Measurement(object):
+    """
+    What a call to a handler or view cost.  It is measured while it is the
+    current measurement, see `current_measurement`, which may be several
+    times for a streamed response.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.storage_calls = {}
+        self.storage_time = 0.0
+        self.bytes_sent = 0
+        self.error = None
+
+    def as_dict(self):
+        return dict((name, value) for name, value in vars(self).items()
+                    if not name.startswith('_'))
+
+    def record_storage_call(self, method, seconds):
+        self.storage_calls[method] = self.storage_calls.get(method, 0) + 1
+        self.storage_time += seconds
+
+    def __enter__(self):
+        _local.measurement = self
+        self._use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self._first_query = len(connection.queries)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time += time.time() - self._start
+        queries = connection.queries[self._first_query:]
+        self.queries += len(queries)
+        self.query_time += sum(float(query['time']) for query in queries)
+        if not settings.DEBUG:
+            # Only Django's debugging needs the queries kept
+            del connection.queries[self._first_query:]
+        connection.use_debug_cursor = self._use_debug_cursor
+        _local.measurement = None
+
+
+def current_measurement():
+    """
+    Returns the measurement being made in this thread, if any.
+    """
+    return getattr(_local, 'measurement', None)
+
+
+def instrumented(func):
+    """
+    Measures calls to a block's handler or view, named for the function.
+    Keeps the marks which make a function a handler, so it can go before
+    `XBlock.handler`.  Calls made while another is being measured count
+    towards that one.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kw):
+        if not SINKS or current_measurement() is not None:
+            return func(self, *args, **kw)
+        measurement = Measurement(name)
+        try:
+            with measurement:
+                result = func(self, *args, **kw)
+        except Exception as error:
+            measurement.error = type(error).__name__
+            _report(measurement)
+            raise
+        if isinstance(result, Response):
+            length = result.content_length
+            result.app_iter = _MeasuredIter(result.app_iter, measurement)
+            result.content_length = length
+        else:
+            _report(measurement)
+        return result
+
+    return wrapper
+
+
+class _MeasuredIter(object):
+    """
+    Goes on measuring a response while it is sent, and reports the
+    measurement once it has been.
+    """
+
+    def __init__(self, app_iter, measurement):
+        self.app_iter = app_iter
+        self.iterator = None
+        self.measurement = measurement
+        self.reported = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.iterator is None:
+            self.iterator = iter(self.app_iter)
+        try:
+            with self.measurement:
+                chunk = next(self.iterator)
+        except StopIteration:
+            self._report()
+            raise
+        self.measurement.bytes_sent += len(chunk)
+        return chunk
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        self._report()
+
+    def _report(self):
+        if not self.reported:
+            self.reported = True
+            _report(self.measurement)
+
+
+def _report(measurement):
+    for sink in SINKS:
+        try:
+            if isinstance(sink, basestring):
+                sink = _import(sink)
+            sink(measurement)
+        except Exception:
+            log.error("Unable to report to %r", sink, exc_info=True)
+
+
+def _import(name):
+    module, name = name.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+class InstrumentedStorage(object):
+    """
+    Wraps a storage, so that calls to it count towards the current
+    measurement.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        def call(*args, **kw):
+            measurement = current_measurement()
+            if measurement is None:
+                return attr(*args, **kw)
+            start = time.time()
+            try:
+                return attr(*args, **kw)
+            finally:
+                measurement.record_storage_call(name, time.time() - start)
+
+        return call
+
+
+def log_sink(measurement):
+    """
+    Logs a measurement, on one line.
+    """
+    log.info(
+        "%s took %.3fs: %d queries in %.3fs, %d storage calls (%s) in %.3fs, "
+        "%d bytes sent%s", measurement.name, measurement.wall_time,
+        measurement.queries, measurement.query_time,
+        sum(measurement.storage_calls.values()),
+        ", ".join("%s=%d" % call
+                  for call in sorted(measurement.storage_calls.items())),
+        measurement.storage_time, measurement.bytes_sent,
+        ", failed with " + measurement.error if measurement.error else "")
+
+
+class StatsdSink(object):
+    """
+    Sends measurements to a statsd server, over UDP, as timings in
+    milliseconds and counts named `<prefix>.<handler>.<metric>`.
+    """
+
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT,
+                 prefix=STATSD_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, measurement):
+        name = '%s.%s.' % (self.prefix, measurement.name)
+        lines = [
+            name + 'time:%d|ms' % (measurement.wall_time * 1000),
+            name + 'queries:%d|c' % measurement.queries,
+            name + 'query_time:%d|ms' % (measurement.query_time * 1000),
+            name + 'storage_calls:%d|c' % sum(
+                measurement.storage_calls.values()),
+            name + 'storage_time:%d|ms' % (measurement.storage_time * 1000),
+            name + 'bytes_sent:%d|c' % measurement.bytes_sent,
+        ]
+        if measurement.error:
+            lines.append(name + 'errors:1|c')
+        self.socket.sendto('\n'.join(lines), self.address)
+
+
+class _LazyStatsdSink(object):
+    """
+    Makes the statsd sink when first used, so its socket isn't opened unless
+    it is.
+    """
+    sink = None
+
+    def __call__(self, measurement):
+        if self.sink is None:
+            self.sink = StatsdSink()
+        self.sink(measurement)
+
+
+statsd_sink = _LazyStatsdSink()
+
+
+class MemorySink(object):
+    """
+    Keeps the measurements it is passed, in `measurements`.
+    """
+
+    def __init__(self):
+        self.measurements = []
+
+    def __call__(self, measurement):
+        self.measurements.append(measurement)
@@ -0,0 +1,53 @@
+"""
+Fills in the `Submission` table from the user state of Staff Graded
+Assignments, eg after upgrading to a version which has it.
+"""
+import json
+
+from optparse import make_option
+
+from courseware.models import StudentModule
+from django.core.management.base import BaseCommand
+
+from edx_sga.models import Submission
+from edx_sga.utils import BATCH_SIZE, iterate_in_batches
+
+
+class Command(BaseCommand):
+    help = "Fills in the Submission table for Staff Graded Assignments."
+    option_list = BaseCommand.option_list + (
+        make_option('--course-id', default=None,
+                    help="Only fill in submissions for this course."),
+        make_option('--batch-size', type='int', default=BATCH_SIZE,
+                    help="How many student modules to read at a time."),
+        make_option('--refresh', action='store_true', default=False,
+                    help="Update submissions which already exist, too."),
+    )
+
+    def handle(self, *args, **options):
+        query = StudentModule.objects.filter(module_type='edx_sga')
+        if options['course_id']:
+            query = query.filter(course_id=options['course_id'])
+        query = query.values('id', 'state', 'sga_submission__id')
+
+        created = updated = 0
+        batch = []
+        rows = iterate_in_batches(query, options['batch_size'])
+        for module in rows:
+            state = json.loads(module['state'] or '{}')
+            if module['sga_submission__id'] is None:
+                batch.append(Submission(
+                    module_id=module['id'],
+                    **Submission.values_from_state(state)))
+            elif options['refresh']:
+                Submission.update_from_state(module['id'], state)
+                updated += 1
+            if len(batch) >= options['batch_size']:
+                Submission.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        Submission.objects.bulk_create(batch)
+        created += len(batch)
+
+        self.stdout.write(
+            "Created %d submissions, updated %d.\n" % (created, updated))
@@ -0,0 +1,37 @@
+"""
+Deletes files stored for Staff Graded Assignments which no student's state
+refers to any more.  Meant to be run periodically, eg from cron.
+"""
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from edx_sga.garbage import MIN_AGE, collect_garbage
+from edx_sga.utils import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Deletes unreferenced files stored for Staff Graded Assignments."
+    option_list = BaseCommand.option_list + (
+        make_option('--course-id', default=None,
+                    help="Only collect files for this course."),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only list the files which would be deleted."),
+        make_option('--min-age', type='float',
+                    default=MIN_AGE.total_seconds() / 3600,
+                    help="Keep files younger than this many hours."),
+        make_option('--batch-size', type='int', default=BATCH_SIZE,
+                    help="How many student modules to read at a time."),
+    )
+
+    def handle(self, *args, **options):
+        checked, deleted = collect_garbage(
+            course_id=options['course_id'],
+            dry_run=options['dry_run'],
+            min_age=datetime.timedelta(hours=options['min_age']),
+            batch_size=options['batch_size'])
+        self.stdout.write("Checked %d files, %s %d.\n" % (
+            checked, "would delete" if options['dry_run'] else "deleted",
+            deleted))
@@ -0,0 +1,36 @@
+"""
+Publishes grades entered by staff for Staff Graded Assignments which haven't
+been published yet, eg because publishing failed when they were entered.
+Meant to be run periodically, eg from cron.  Run it once with
+`--queue-unpublished` after upgrading from a version which published grades
+when students viewed them, see `edx_sga.publishing`.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from edx_sga.publishing import (
+    BATCH_SIZE, MAX_ATTEMPTS, publish_grades, queue_unpublished_grades)
+
+
+class Command(BaseCommand):
+    help = "Publishes queued grades for Staff Graded Assignments."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=BATCH_SIZE,
+                    help="How many grades to publish per transaction."),
+        make_option('--max-attempts', type='int', default=MAX_ATTEMPTS,
+                    help="Skip grades which have failed this many times."),
+        make_option('--queue-unpublished', action='store_true', default=False,
+                    help="First queue grades entered before upgrading which "
+                         "haven't been published."),
+    )
+
+    def handle(self, *args, **options):
+        if options['queue_unpublished']:
+            queued = queue_unpublished_grades(options['batch_size'])
+            self.stdout.write("Queued %d unpublished grades.\n" % queued)
+        published, failed = publish_grades(
+            batch_size=options['batch_size'],
+            max_attempts=options['max_attempts'])
+        self.stdout.write(
+            "Published %d grades, %d failed.\n" % (published, failed))
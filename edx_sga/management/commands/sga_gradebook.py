@@ -0,0 +1,39 @@
+"""
+Writes the gradebook for every Staff Graded Assignment in a course, as a
+matrix of learners by assignments, see `edx_sga.gradebook`.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from edx_sga.gradebook import FORMATS
+from edx_sga.utils import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Writes the gradebook for all Staff Graded Assignments in a course."
+    option_list = BaseCommand.option_list + (
+        make_option('--course-id', default=None,
+                    help="The course to write the gradebook for."),
+        make_option('--format', default='csv', choices=sorted(FORMATS),
+                    help="csv (the default) or json."),
+        make_option('--output', default=None,
+                    help="The file to write to, instead of standard output."),
+        make_option('--batch-size', type='int', default=BATCH_SIZE,
+                    help="How many student modules to read at a time."),
+    )
+
+    def handle(self, *args, **options):
+        if not options['course_id']:
+            raise CommandError("--course-id is required.")
+        generate = FORMATS[options['format']][0]
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = self.stdout
+        try:
+            for chunk in generate(options['course_id'], options['batch_size']):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Submission'
+        db.create_table('edx_sga_submission', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('module', self.gf('django.db.models.fields.related.OneToOneField')(related_name='sga_submission', unique=True, to=orm['courseware.StudentModule'])),
+            ('uploaded_sha1', self.gf('django.db.models.fields.CharField')(max_length=40, null=True, db_index=True)),
+            ('uploaded_filename', self.gf('django.db.models.fields.CharField')(max_length=255, null=True)),
+            ('uploaded_mimetype', self.gf('django.db.models.fields.CharField')(max_length=255, null=True)),
+            ('uploaded_timestamp', self.gf('django.db.models.fields.DateTimeField')(null=True, db_index=True)),
+            ('annotated_sha1', self.gf('django.db.models.fields.CharField')(max_length=40, null=True, db_index=True)),
+            ('annotated_filename', self.gf('django.db.models.fields.CharField')(max_length=255, null=True)),
+            ('annotated_mimetype', self.gf('django.db.models.fields.CharField')(max_length=255, null=True)),
+            ('annotated_timestamp', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+            ('score', self.gf('django.db.models.fields.FloatField')(null=True, db_index=True)),
+            ('score_published', self.gf('django.db.models.fields.BooleanField')(default=True, db_index=True)),
+            ('comment', self.gf('django.db.models.fields.TextField')(default='', blank=True)),
+            ('modified', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, db_index=True, blank=True)),
+        ))
+        db.send_create_signal('edx_sga', ['Submission'])
+
+    def backwards(self, orm):
+        # Deleting model 'Submission'
+        db.delete_table('edx_sga_submission')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'courseware.studentmodule': {
+            'Meta': {'unique_together': "(('student', 'module_state_key', 'course_id'),)", 'object_name': 'StudentModule'},
+            'course_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'done': ('django.db.models.fields.CharField', [], {'default': "'na'", 'max_length': '8', 'db_index': 'True'}),
+            'grade': ('django.db.models.fields.FloatField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'max_grade': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'module_state_key': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_column': "'module_id'", 'db_index': 'True'}),
+            'module_type': ('django.db.models.fields.CharField', [], {'default': "'problem'", 'max_length': '32', 'db_index': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'student': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'edx_sga.submission': {
+            'Meta': {'object_name': 'Submission'},
+            'annotated_filename': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'annotated_mimetype': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'annotated_sha1': ('django.db.models.fields.CharField', [], {'max_length': '40', 'null': 'True', 'db_index': 'True'}),
+            'annotated_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'module': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'sga_submission'", 'unique': 'True', 'to': "orm['courseware.StudentModule']"}),
+            'score': ('django.db.models.fields.FloatField', [], {'null': 'True', 'db_index': 'True'}),
+            'score_published': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'db_index': 'True'}),
+            'uploaded_filename': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'uploaded_mimetype': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True'}),
+            'uploaded_sha1': ('django.db.models.fields.CharField', [], {'max_length': '40', 'null': 'True', 'db_index': 'True'}),
+            'uploaded_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'})
+        },
+        'edx_sga.pendinggrade': {
+            'Meta': {'object_name': 'PendingGrade'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'max_score': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'module': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sga_pending_grades'", 'to': "orm['courseware.StudentModule']"}),
+            'score': ('django.db.models.fields.FloatField', [], {'null': 'True'})
+        }
+    }
+
+    complete_apps = ['edx_sga']
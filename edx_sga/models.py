@@ -0,0 +1,91 @@
+"""
+Models for the Staff Graded Assignment XBlock.
+"""
+from courseware.models import StudentModule
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+from xblock.fields import DateTime
+
+
+class PendingGrade(models.Model):
+    """
+    A grade entered by staff which hasn't been published to the courseware
+    gradebook yet.  See `edx_sga.publishing`.
+    """
+    module = models.ForeignKey(StudentModule, related_name='sga_pending_grades')
+    score = models.FloatField(null=True)
+    max_score = models.FloatField(null=True)
+    attempts = models.IntegerField(default=0, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class Submission(models.Model):
+    """
+    A student's submission for a Staff Graded Assignment, and its grade.  This
+    duplicates the XBlock's user state, which is stored as a JSON blob in the
+    `StudentModule`, in typed, indexed columns, so that the gradebook can be
+    sorted, filtered and counted by the database.  It is written whenever the
+    XBlock changes the state, see `update_from_state`, and can be rebuilt
+    with the `backfill_sga_submissions` management command.
+    """
+    module = models.OneToOneField(StudentModule, related_name='sga_submission')
+    uploaded_sha1 = models.CharField(max_length=40, null=True, db_index=True)
+    uploaded_filename = models.TextField(null=True)
+    uploaded_mimetype = models.CharField(max_length=255, null=True)
+    uploaded_timestamp = models.DateTimeField(null=True, db_index=True)
+    annotated_sha1 = models.CharField(max_length=40, null=True, db_index=True)
+    annotated_filename = models.TextField(null=True)
+    annotated_mimetype = models.CharField(max_length=255, null=True)
+    annotated_timestamp = models.DateTimeField(null=True)
+    score = models.FloatField(null=True, db_index=True)
+    score_published = models.BooleanField(default=True, db_index=True)
+    comment = models.TextField(blank=True, default='')
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # How far processing of the uploaded file has got, see edx_sga.processing
+    processing_status = models.CharField(max_length=16, null=True)
+    processing_error = models.TextField(blank=True, default='')
+
+    @classmethod
+    def values_from_state(cls, state):
+        """
+        Returns the column values for the given XBlock user state.
+        """
+        def timestamp(name):
+            return DateTime().from_json(state.get(name))
+
+        return {
+            'uploaded_sha1': state.get('uploaded_sha1'),
+            'uploaded_filename': state.get('uploaded_filename'),
+            'uploaded_mimetype': state.get('uploaded_mimetype'),
+            'uploaded_timestamp': timestamp('uploaded_timestamp'),
+            'annotated_sha1': state.get('annotated_sha1'),
+            'annotated_filename': state.get('annotated_filename'),
+            'annotated_mimetype': state.get('annotated_mimetype'),
+            'annotated_timestamp': timestamp('annotated_timestamp'),
+            'score': state.get('score'),
+            'score_published': state.get('score_published', True),
+            'comment': state.get('comment') or '',
+        }
+
+    @classmethod
+    def update_from_state(cls, module_id, state):
+        """
+        Saves the submission for a student module from its XBlock user state.
+        This is part of the caller's transaction, if any, so it can be saved
+        along with the state.
+        """
+        values = cls.values_from_state(state)
+        values['modified'] = timezone.now()
+        if cls.objects.filter(module=module_id).update(**values):
+            return
+        # A savepoint, as get_or_create uses, rather than a transaction of
+        # its own, which would commit or roll back the caller's.
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(module_id=module_id, **values)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else just created it
+            transaction.savepoint_rollback(sid)
+            cls.objects.filter(module=module_id).update(**values)
@@ -0,0 +1,184 @@
+"""
+Makes small previews of uploaded images and PDFs, so that staff can see
+submissions in the gradebook without downloading each one.
+
+`generate_preview` is a processor for `edx_sga.processing`, so previews are
+made in the background once a file is uploaded.  To turn it on, add it to
+the `SGA_PROCESSORS` setting:
+
+    SGA_PROCESSORS = ['edx_sga.previews.generate_preview']
+
+Previews are JPEGs stored next to the file they are of, see
+`preview_path`.  Files are stored by SHA1, so a preview is only made once
+for each distinct file.  Images need PIL.  PDFs need the `pdftoppm` program
+from Poppler, and are skipped if it isn't installed.
+"""
+import logging
+import os
+import posixpath
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import threading
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from edx_sga import processing
+
+try:
+    from PIL import Image
+except ImportError:  # pragma NO COVER
+    Image = None
+
+log = logging.getLogger(__name__)
+
+PREVIEW_PROCESSOR = 'edx_sga.previews.generate_preview'
+PREVIEW_SUFFIX = '.preview.jpg'
+PREVIEW_SIZE = (240, 240)
+PREVIEW_QUALITY = 80
+
+# Larger images than this are not previewed, rather than risk running out of
+# memory decoding them.
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+
+# How long, in seconds, `pdftoppm` may take to render a PDF's first page
+# before it is killed, and processing the PDF fails, so that a malformed or
+# malicious PDF can't tie up a processing worker.
+PDF_TIMEOUT = 60
+
+IMAGE_MIMETYPES = (
+    'image/bmp', 'image/gif', 'image/jpeg', 'image/png', 'image/tiff')
+PDF_MIMETYPES = ('application/pdf',)
+
+
+def has_preview(mimetype):
+    """
+    Tells whether previews are made of files of the given mimetype.
+    """
+    return mimetype in IMAGE_MIMETYPES or mimetype in PDF_MIMETYPES
+
+
+def previews_made():
+    """
+    Tells whether previews are made, ie whether `generate_preview` is one of
+    the processors.
+    """
+    return any(processor in (PREVIEW_PROCESSOR, generate_preview)
+               for processor in processing.PROCESSORS)
+
+
+def preview_path(path):
+    """
+    Returns where the preview of the stored file at `path` is stored.
+    """
+    return posixpath.splitext(path)[0] + PREVIEW_SUFFIX
+
+
+def generate_preview(path, filename, mimetype, sha1):
+    """
+    Makes and stores a preview of the stored file at `path`, unless there
+    is one already, or previews aren't made of files of its type.
+    """
+    if not has_preview(mimetype):
+        return
+    preview = preview_path(path)
+    if default_storage.exists(preview):
+        return
+    if mimetype in PDF_MIMETYPES:
+        content = _pdf_preview(path)
+    else:
+        content = _image_preview(path)
+    if content is not None:
+        default_storage.save(preview, ContentFile(content))
+
+
+def _image_preview(path):
+    if Image is None:
+        log.warning("PIL is not installed, so images can't be previewed.")
+        return None
+    file = default_storage.open(path)
+    try:
+        image = Image.open(file)
+        width, height = image.size
+        if width * height > MAX_IMAGE_PIXELS:
+            log.info("Not previewing %s, which is %dx%d.", path, width, height)
+            return None
+        # Lets JPEGs be decoded at a fraction of their size
+        image.draft('RGB', PREVIEW_SIZE)
+        return _jpeg(image)
+    finally:
+        file.close()
+
+
+def _pdf_preview(path):
+    """
+    Renders the first page of a stored PDF with `pdftoppm`, which needs the
+    PDF to be in a local file.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        try:
+            local = default_storage.path(path)
+        except NotImplementedError:
+            local = os.path.join(tmp, 'file.pdf')
+            _copy_to_local(path, local)
+        output = os.path.join(tmp, 'page')
+        try:
+            process = subprocess.Popen([
+                'pdftoppm', '-jpeg', '-f', '1', '-l', '1', '-singlefile',
+                '-scale-to', str(max(PREVIEW_SIZE)), local, output])
+        except OSError:
+            log.warning("pdftoppm is not installed, so PDFs can't be "
+                        "previewed.")
+            return None
+        _wait(process, PDF_TIMEOUT)
+        with open(output + '.jpg', 'rb') as page:
+            return page.read()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _wait(process, timeout):
+    """
+    Waits for a program to finish, killing it if it takes longer than
+    `timeout` seconds.  Raises `RuntimeError` unless it succeeded.
+    """
+    killed = threading.Event()
+
+    def kill():
+        if process.poll() is None:
+            killed.set()
+            process.kill()
+
+    watchdog = threading.Timer(timeout, kill)
+    watchdog.start()
+    try:
+        returncode = process.wait()
+    finally:
+        watchdog.cancel()
+    if killed.is_set():
+        raise RuntimeError(
+            "Previewing the PDF took longer than %d seconds." % timeout)
+    if returncode:
+        raise RuntimeError("Unable to preview the PDF.")
+
+
+def _copy_to_local(path, local):
+    src = default_storage.open(path)
+    try:
+        with open(local, 'wb') as dst:
+            for chunk in src.chunks():
+                dst.write(chunk)
+    finally:
+        src.close()
+
+
+def _jpeg(image):
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail(PREVIEW_SIZE, Image.ANTIALIAS)
+    out = StringIO.StringIO()
+    image.save(out, 'JPEG', quality=PREVIEW_QUALITY)
+    return out.getvalue()
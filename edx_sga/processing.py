@@ -0,0 +1,189 @@
+"""
+Runs processors on files students upload, such as virus scanners or preview
+generators, in the background so that uploads return as soon as the file is
+stored, however big it is and however long processing takes.
+
+Processors are listed, as dotted paths, in the `SGA_PROCESSORS` setting, or
+added with `register_processor`.  Each is called in turn as
+
+    processor(path, filename, mimetype, sha1)
+
+where `path` is where the file is in `default_storage`, and fails the
+processing of the file by raising an exception.  How far processing has got
+is recorded on the student's `Submission`, see `PROCESSING_STATUSES`.
+
+Processing is run by the pool named by the `SGA_PROCESSING_POOL` setting:
+'thread', the default, for a pool of `SGA_PROCESSING_WORKERS` threads in
+each web worker, 'inline' to process files during the upload request, or
+the dotted path of a `submit(func, *args)` callable, eg one which hands the
+call to a task queue.  Calls queued on a thread pool are lost if the web
+worker is restarted, so processing which has been pending or running for
+longer than `SGA_PROCESSING_TIMEOUT` seconds is failed when its status is
+next read, see `processing_lost`.
+"""
+import datetime
+import logging
+import os
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+from edx_sga.models import Submission
+
+log = logging.getLogger(__name__)
+
+PROCESSORS = list(getattr(settings, 'SGA_PROCESSORS', ()))
+PROCESSING_POOL = getattr(settings, 'SGA_PROCESSING_POOL', 'thread')
+PROCESSING_WORKERS = getattr(settings, 'SGA_PROCESSING_WORKERS', 2)
+PROCESSING_TIMEOUT = getattr(settings, 'SGA_PROCESSING_TIMEOUT', 3600)
+
+PROCESSING_STATUSES = ('pending', 'running', 'done', 'failed')
+LOST_PROCESSING_ERROR = (
+    "Processing was interrupted.  Please upload your file again.")
+
+
+def register_processor(processor):
+    """
+    Adds a processor, or the dotted path of one, to be run on uploads.
+    """
+    PROCESSORS.append(processor)
+
+
+def has_processors():
+    return bool(PROCESSORS)
+
+
+def process_upload(module_id, sha1, path, filename, mimetype):
+    """
+    Queues an uploaded file for processing, if there are any processors.
+    Its status is kept on the student's submission, as long as the
+    submission is still for that file.
+    """
+    if not PROCESSORS:
+        return
+    _set_status(module_id, sha1, 'pending')
+    _get_pool()(_process, module_id, sha1, path, filename, mimetype)
+
+
+def _process(module_id, sha1, path, filename, mimetype):
+    _set_status(module_id, sha1, 'running')
+    try:
+        for processor in PROCESSORS:
+            if isinstance(processor, basestring):
+                processor = _import(processor)
+            processor(path, filename, mimetype, sha1)
+    except Exception as error:
+        log.error("Unable to process %s", path, exc_info=True)
+        _set_status(module_id, sha1, 'failed', str(error))
+    else:
+        _set_status(module_id, sha1, 'done')
+
+
+def _set_status(module_id, sha1, status, error=''):
+    Submission.objects.filter(module=module_id, uploaded_sha1=sha1).update(
+        processing_status=status, processing_error=error,
+        modified=timezone.now())
+
+
+def processing_lost(status, modified):
+    """
+    Tells whether processing which has had `status` since `modified` won't
+    finish, since it has been unfinished for longer than
+    `PROCESSING_TIMEOUT`.
+    """
+    timeout = datetime.timedelta(seconds=PROCESSING_TIMEOUT)
+    return (status in ('pending', 'running') and
+            modified < timezone.now() - timeout)
+
+
+def fail_lost_processing(submissions):
+    """
+    Fails the processing of those of `submissions`, a `Submission` query,
+    which is lost, see `processing_lost`.
+    """
+    timeout = datetime.timedelta(seconds=PROCESSING_TIMEOUT)
+    submissions.filter(
+        processing_status__in=('pending', 'running'),
+        modified__lt=timezone.now() - timeout).update(
+            processing_status='failed',
+            processing_error=LOST_PROCESSING_ERROR,
+            modified=timezone.now())
+
+
+def _import(name):
+    module, name = name.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def _run_inline(func, *args):
+    func(*args)
+
+
+class ThreadPool(object):
+    """
+    Runs calls on a fixed number of daemon threads, which are started when
+    the first call is submitted, and again in a process forked after that.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __call__(self, func, *args):
+        self.submit(func, *args)
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+        self.queue.put((func, args))
+
+    def join(self):
+        """
+        Waits for every call submitted so far to finish.
+        """
+        if self.queue is not None:
+            self.queue.join()
+
+    def _start(self):
+        self.queue = Queue.Queue()
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, args=(self.queue,),
+                name="edx_sga.processing-%d" % i)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, queue):
+        while True:
+            func, args = queue.get()
+            try:
+                func(*args)
+            except Exception:
+                log.error("Unable to run %r", func, exc_info=True)
+            finally:
+                # Don't hold a database connection between calls
+                connection.close()
+                queue.task_done()
+
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        if PROCESSING_POOL == 'thread':
+            _pool = ThreadPool(PROCESSING_WORKERS)
+        elif PROCESSING_POOL == 'inline':
+            _pool = _run_inline
+        else:
+            _pool = _import(PROCESSING_POOL)
+    return _pool
@@ -0,0 +1,172 @@
+"""
+Publishes grades entered by staff to the courseware gradebook.
+
+The courseware application only accepts a grade event for the logged in
+user, so staff can't publish a student's grade with `runtime.publish`.
+Instead, grades are queued as `PendingGrade` rows and written straight to the
+`StudentModule` grade columns, as the grade event handler would do, a batch at
+a time.  Grades which fail to publish stay queued, and are retried by the
+`publish_sga_grades` management command.
+
+Versions before this one published a grade when the student next viewed the
+assignment, so grades entered with them may still be waiting, with nothing
+queued.  `queue_unpublished_grades` queues them.
+"""
+import json
+import logging
+
+from courseware.models import StudentModule
+from django.db import transaction
+from django.db.models import F
+from xmodule.modulestore import Location
+from xmodule.modulestore.django import modulestore
+from xmodule.modulestore.exceptions import ItemNotFoundError
+
+from edx_sga.models import PendingGrade, Submission
+from edx_sga.utils import (
+    iterate_in_batches, statistics_row, update_statistics)
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+
+
+def queue_grades(scores, max_score):
+    """
+    Queues grades for publishing.  `scores` maps student module ids to
+    scores, or to `None` where a grade has been removed.  Grades already
+    queued for those students are replaced.
+    """
+    with transaction.commit_on_success():
+        PendingGrade.objects.filter(module__in=list(scores)).delete()
+        PendingGrade.objects.bulk_create([
+            PendingGrade(module_id=module_id, score=score, max_score=max_score)
+            for module_id, score in scores.items()])
+
+
+def queue_unpublished_grades(batch_size=BATCH_SIZE):
+    """
+    Queues every grade, or removed grade, which has `score_published` false
+    in its student's state and isn't queued already.  Each block is loaded,
+    once, for its maximum score.  Returns the number of grades queued.
+    """
+    # The state is written by json.dumps, so this finds the candidates
+    # without decoding every student's state.
+    query = StudentModule.objects.filter(
+        module_type='edx_sga', state__contains='"score_published": false',
+        sga_pending_grades__isnull=True).values(
+            'id', 'course_id', 'module_state_key', 'state')
+    max_scores = {}
+    queued = 0
+    scores = {}
+    for module in iterate_in_batches(query, batch_size):
+        state = json.loads(module['state'] or '{}')
+        if state.get('score_published', True):
+            continue
+        block = module['course_id'], module['module_state_key']
+        if block not in max_scores:
+            max_scores[block] = _max_score(*block)
+        if max_scores[block] is None:
+            continue
+        scores.setdefault(block, {})[module['id']] = state.get('score')
+        queued += 1
+        if queued % batch_size == 0:
+            _queue_blocks(scores, max_scores)
+            scores = {}
+    _queue_blocks(scores, max_scores)
+    return queued
+
+
+def _queue_blocks(scores, max_scores):
+    for block, block_scores in scores.items():
+        queue_grades(block_scores, max_scores[block])
+
+
+def _max_score(course_id, location):
+    try:
+        return modulestore().get_instance(
+            course_id, Location(location)).max_score()
+    except ItemNotFoundError:
+        log.warning("Not queueing grades for %s, which is no longer in %s",
+                    location, course_id)
+        return None
+
+
+def publish_grades(module_ids=None, batch_size=BATCH_SIZE,
+                   max_attempts=MAX_ATTEMPTS):
+    """
+    Publishes queued grades, or only those for the given student modules.
+    Each batch is published in a single transaction.  If that fails, the
+    grades in the batch are published one at a time, so one bad grade
+    doesn't hold up the rest.  Grades which fail `max_attempts` times are
+    left for someone to look at.  Returns the number of grades published and
+    the number which failed.
+    """
+    query = PendingGrade.objects.filter(
+        attempts__lt=max_attempts).order_by('id')
+    if module_ids is not None:
+        query = query.filter(module__in=list(module_ids))
+
+    published = failed = 0
+    last_id = 0
+    while True:
+        batch = list(query.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        try:
+            with transaction.commit_on_success():
+                changes = [_publish(pending) for pending in batch]
+            _update_statistics(changes)
+            published += len(batch)
+            continue
+        except Exception:
+            log.warning("Unable to publish batch of grades", exc_info=True)
+
+        for pending in batch:
+            try:
+                with transaction.commit_on_success():
+                    change = _publish(pending)
+                _update_statistics([change])
+                published += 1
+            except Exception as error:
+                log.error("Unable to publish grade for student module %s",
+                          pending.module_id, exc_info=True)
+                PendingGrade.objects.filter(pk=pending.pk).update(
+                    attempts=F('attempts') + 1, last_error=str(error))
+                failed += 1
+
+    return published, failed
+
+
+def _update_statistics(changes):
+    """
+    Counts published grades in their blocks' statistics.  `changes` are
+    `(block, old, new)` tuples, as returned by `_publish`.
+    """
+    blocks = {}
+    for block, old, new in changes:
+        blocks.setdefault(block, []).append((old, new))
+    for (course_id, location), rows in blocks.items():
+        update_statistics(course_id, location, rows)
+
+
+def _publish(pending):
+    """
+    Publishes a queued grade.  Returns the course id and location of the
+    block it is for, and the student's statistics rows before and after.
+    """
+    module = StudentModule.objects.select_for_update().get(
+        pk=pending.module_id)
+    state = json.loads(module.state or '{}')
+    old = statistics_row(state)
+    state['score_published'] = True
+    module.state = json.dumps(state)
+    module.grade = pending.score
+    module.max_grade = pending.max_score
+    module.save()
+    Submission.objects.filter(module=module.pk).update(score_published=True)
+    pending.delete()
+    return ((module.course_id, module.module_state_key), old,
+            statistics_row(state))
@@ -2,34 +2,170 @@
 This block defines a Staff Graded Assignment.  Students are shown a rubric
 and invited to upload a file which is then graded by staff.
 """
+import base64
+import codecs
+import collections
+import csv
 import datetime
+import fnmatch
 import hashlib
+import itertools
 import json
 import logging
 import mimetypes
 import os
 import pkg_resources
+import posixpath
 import pytz
+import tempfile
+import threading
+import time
+import urllib
+import uuid
+import zipfile
 
 from functools import partial
 
 from courseware.models import StudentModule
 
+from django.conf import settings
 from django.core.files import File
-from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core.files.storage import default_storage as _default_storage
+from django.db import connection, transaction
+from django.db.models import Count, Q
 from django.template.context import Context
 from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.translation import get_language
 
 from webob.response import Response
 
 from xblock.core import XBlock
-from xblock.fields import Boolean, DateTime, Scope, String, Float
+from xblock.fields import Boolean, DateTime, Dict, Scope, String, Float
 from xblock.fragment import Fragment
 
 from xmodule.util.duedate import get_extended_due_date
 
+from edx_sga.gradebook import FORMATS as COURSE_GRADEBOOK_FORMATS
+from edx_sga.instrumentation import InstrumentedStorage, instrumented
+from edx_sga.models import Submission
+from edx_sga.previews import has_preview, preview_path, previews_made
+from edx_sga.processing import (
+    LOST_PROCESSING_ERROR, fail_lost_processing, has_processors,
+    process_upload, processing_lost)
+from edx_sga.publishing import publish_grades, queue_grades
+from edx_sga.utils import (
+    HISTOGRAM_BINS, STATISTICS_CACHE_TIMEOUT, STORAGE_LAYOUT, CSVLine,
+    blob_path, csv_value, histogram_bin, iterate_in_batches,
+    statistics_cache_key, statistics_row, storage_prefix, update_statistics)
+from edx_sga.zipstream import stream_zip
+
 log = logging.getLogger(__name__)
 
+# Counts calls to storage towards the request's measurement, see
+# `edx_sga.instrumentation`.
+default_storage = InstrumentedStorage(_default_storage)
+
+try:
+    VERSION = pkg_resources.get_distribution('edx-sga').version
+except pkg_resources.DistributionNotFound:  # pragma NO COVER
+    VERSION = None
+
+# How many rendered student views to keep cached per process.
+FRAGMENT_CACHE_SIZE = getattr(settings, 'SGA_FRAGMENT_CACHE_SIZE', 10000)
+
+# The largest file which can be uploaded, in bytes.  Blocks can set a lower
+# limit of their own, see `max_file_size`.
+MAX_UPLOAD_SIZE = getattr(settings, 'SGA_MAX_UPLOAD_SIZE', 2**32)
+
+# How much larger than the file itself a form upload's body may be, for the
+# multipart headers and boundaries.
+UPLOAD_OVERHEAD = 2**14
+
+# How downloads are sent.  By default they are streamed by Python.  Set to
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) to have the
+# front end web server send them, or to 'redirect' to redirect to the storage
+# backend's URL for the file.
+FILE_SERVING = getattr(settings, 'SGA_FILE_SERVING', None)
+
+# With 'x-accel-redirect', the nginx internal location which maps to the
+# root of the storage backend.
+X_ACCEL_REDIRECT_PREFIX = getattr(
+    settings, 'SGA_X_ACCEL_REDIRECT_PREFIX', '/sga-files/')
+
+# Requests for more byte ranges than this get the whole file
+MAX_RANGES = 16
+
+STAFF_GRADING_PAGE_SIZE = 100
+MAX_STAFF_GRADING_PAGE_SIZE = 1000
+GRADING_BATCH_SIZE = 500
+
+# How many times staff changes to a student's state are tried, when someone
+# else keeps changing it at the same time, before giving up.
+STATE_UPDATE_ATTEMPTS = 5
+CONFLICT_ERROR = "Someone else is changing this student's state.  Try again."
+
+# The gradebook is read from the typed `Submission` columns, rather than by
+# decoding each student's JSON state.
+GRADING_COLUMNS = (
+    'id', 'student__username', 'student__profile__name',
+    'sga_submission__uploaded_sha1',
+    'sga_submission__uploaded_filename', 'sga_submission__uploaded_mimetype',
+    'sga_submission__uploaded_timestamp',
+    'sga_submission__score_published', 'sga_submission__score',
+    'sga_submission__annotated_filename', 'sga_submission__comment',
+    'sga_submission__processing_status')
+
+SYNC_TOKEN_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+SYNC_MARGIN = datetime.timedelta(seconds=5)
+
+GRADING_STATUSES = ('ungraded', 'unpublished', 'published', 'missing')
+
+# Filters for each of the `GRADING_STATUSES`.  Students without a submission
+# row yet are missing.
+GRADING_STATUS_FILTERS = {
+    'ungraded': Q(sga_submission__score__isnull=True,
+                  sga_submission__uploaded_sha1__isnull=False),
+    'unpublished': Q(sga_submission__score__isnull=False,
+                     sga_submission__score_published=False),
+    'published': Q(sga_submission__score__isnull=False,
+                   sga_submission__score_published=True),
+    'missing': Q(sga_submission__score__isnull=True,
+                 sga_submission__uploaded_sha1__isnull=True),
+}
+
+# The gradebook columns in CSV exports, in order.  Imports need the username
+# and score columns, and the comment column if comments are to be changed.
+GRADES_CSV_COLUMNS = (
+    'username', 'fullname', 'filename', 'timestamp', 'score', 'comment',
+    'annotated')
+
+# The user state fields copied to each student's `Submission`.
+SUBMISSION_FIELDS = (
+    'uploaded_sha1', 'uploaded_filename', 'uploaded_mimetype',
+    'uploaded_timestamp', 'annotated_sha1', 'annotated_filename',
+    'annotated_mimetype', 'annotated_timestamp', 'score', 'score_published',
+    'comment')
+
+# The column the gradebook is ordered by for each sort.
+GRADING_SORTS = {
+    'username': 'student__username',
+    'timestamp': 'sga_submission__uploaded_timestamp',
+    'score': 'sga_submission__score',
+}
+
+# Sort keys for gradebook rows.  Each key ends with the module id so that it is
+# unique and can be used as a pagination cursor.  Rows without a value sort
+# last.
+GRADING_SORT_KEYS = {
+    'username': lambda row: (False, row['username'], row['module_id']),
+    'timestamp': lambda row: (
+        row['timestamp'] is None, row['timestamp'], row['module_id']),
+    'score': lambda row: (
+        row['score'] is None, row['score'], row['module_id']),
+}
+
 
 class StaffGradedAssignmentXBlock(XBlock):
     """
@@ -59,6 +195,22 @@ class StaffGradedAssignmentXBlock(XBlock):
         default=100,
         scope=Scope.settings)
 
+    max_file_size = Float(
+        display_name="Maximum file size (MB)",
+        help=("The largest file, in megabytes, which students can upload. "
+              "Leave blank for no limit."),
+        values={"min": 0, "step": .1},
+        default=None,
+        scope=Scope.settings)
+
+    allowed_file_types = String(
+        display_name="Allowed file types",
+        help=("File extensions and mime types, separated by commas, of the "
+              "files students can upload, eg \".pdf, .docx, image/*\". "
+              "Leave blank to allow any."),
+        default='',
+        scope=Scope.settings)
+
     score = Float(
         display_name="Grade score",
         default=None,
@@ -127,55 +279,62 @@ class StaffGradedAssignmentXBlock(XBlock):
         default=None,
         help="When the annotated file was uploaded")
 
+    chunked_upload = Dict(
+        display_name="Chunked upload",
+        scope=Scope.user_state,
+        default=None,
+        help="The chunked upload in progress, if any.")
+
     def max_score(self):
         return self.points
 
+    @instrumented
     def student_view(self, context=None):
         """
         The primary view of the StaffGradedAssignmentXBlock, shown to students
         when viewing courses.
         """
-        # Ideally we would do this when the score is entered.  This write on
-        # read pattern is pretty bad.  Currently, though, the code in the
-        # courseware application that handles the grade event will puke if the
-        # user_id for the event is other than the logged in user.
-        if not self.score_published:
-            self.runtime.publish(self, 'grade', {
-                'value': self.score,
-                'max_value': self.max_score(),
-            })
-            self.score_published = True
-
-        template = get_template("staff_graded_assignment/show.html")
+        # Grades are published when staff enter them, see `edx_sga.publishing`,
+        # so viewing the assignment never writes anything.
         context = {
             "student_state": json.dumps(self.student_state()),
             "id": "_".join(filter(None, self.location))
         }
         if self.show_staff_grading_interface():
             context['is_course_staff'] = True
-        fragment = Fragment(template.render(Context(context)))
+        fragment = Fragment(_render_cached(
+            "staff_graded_assignment/show.html", context))
         fragment.add_css(_resource("static/css/edx_sga.css"))
         fragment.add_javascript(_resource("static/js/src/edx_sga.js"))
         fragment.initialize_js('StaffGradedAssignmentXBlock')
         return fragment
 
-    def student_state(self):
+    def student_state(self, state=None):
         """
         Returns a JSON serializable representation of student's state for
-        rendering in client view.
+        rendering in client view.  `state`, if given, is the student's user
+        state as just written, see `_record_upload`, to show rather than
+        the block's fields, which were read before it.
         """
-        if self.uploaded_sha1:
-            uploaded = {"filename": self.uploaded_filename}
+        if state is None:
+            state = self._submission_state()
+        score = state.get('score')
+
+        if state.get('uploaded_sha1'):
+            uploaded = {
+                "filename": state.get('uploaded_filename'),
+                "processing": self.processing_status(state['uploaded_sha1']),
+            }
         else:
             uploaded = None
 
-        if self.annotated_sha1:
-            annotated = {"filename": self.annotated_filename}
+        if state.get('annotated_sha1'):
+            annotated = {"filename": state.get('annotated_filename')}
         else:
             annotated = None
 
-        if self.score is not None:
-            graded = {'score': self.score, 'comment': self.comment}
+        if score is not None:
+            graded = {'score': score, 'comment': state.get('comment', '')}
         else:
             graded = None
 
@@ -184,34 +343,172 @@ class StaffGradedAssignmentXBlock(XBlock):
             "annotated": annotated,
             "graded": graded,
             "max_score": self.max_score(),
-            "published": self.score_published,
-            "upload_allowed": self.upload_allowed(),
+            "published": state.get('score_published', True),
+            "upload_allowed": not self.past_due() and score is None,
+            "max_file_size": self.upload_size_limit(),
+            "allowed_file_types": _file_types(self.allowed_file_types),
         }
 
-    def staff_grading_data(self):
-        def get_student_data(module):
-            state = json.loads(module.state)
-            return {
-                'module_id': module.id,
-                'username': module.student.username,
-                'fullname': module.student.profile.name,
-                'filename': state.get("uploaded_filename"),
-                'timestamp': state.get("uploaded_timestamp"),
-                'published': state.get("score_published"),
-                'score': state.get("score"),
-                'annotated': state.get("annotated_filename"),
-                'comment': state.get("comment", ''),
-            }
+    def staff_grading_data(self, sort='username', status=None, cursor=None,
+                           limit=None, since=None):
+        """
+        Returns the gradebook for this assignment, ordered by `sort` and
+        optionally restricted to assignments with the given grading `status`.
+        If `limit` is given only one page of at most `limit` rows is returned,
+        along with a cursor that can be passed back in to get the next page.
+        If `since` is given, only rows modified since that time are returned.
+        The `since` token in the result can be used to fetch rows modified
+        after this call.
+        """
+        data = {'max_score': self.max_score(), 'since': _sync_token()}
+        if limit is None:
+            data['assignments'] = list(
+                self._grading_rows(sort, cursor, None, since, status))
+            return data
 
-        query = StudentModule.objects.filter(
-            course_id=self.xmodule_runtime.course_id,
-            module_state_key=self.location.url())
+        # One more row than the page, to tell whether there is another page
+        rows = self._grading_rows(sort, cursor, limit + 1, since, status)
+        page = list(itertools.islice(rows, limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            data['cursor'] = _encode_cursor(GRADING_SORT_KEYS[sort](page[-1]))
+        else:
+            data['cursor'] = None
+        data['assignments'] = page
+        return data
 
+    def changed_grading_data(self, *module_ids):
+        """
+        Returns just the gradebook rows for the given student modules, for
+        handlers which have changed them.  The client patches these rows into
+        the table it already has.
+        """
+        query = self.student_modules().filter(pk__in=module_ids).values(
+            *GRADING_COLUMNS)
         return {
-            'assignments': [get_student_data(module) for module in query],
+            'assignments': [_student_data(module) for module in query],
             'max_score': self.max_score(),
         }
 
+    def statistics(self):
+        """
+        Returns how many students have submitted, been graded and have
+        grades waiting to be published, their average score and a histogram
+        of scores.  These are cached, and kept up to date as submissions and
+        grades change, see `edx_sga.utils.update_statistics`, so asking for
+        them costs nothing like a pass over every student.
+        """
+        max_score = self.max_score()
+        key = statistics_cache_key(
+            self.xmodule_runtime.course_id, self.location.url())
+        stats = cache.get(key)
+        if stats is None or stats['max_score'] != max_score:
+            stats = self._compute_statistics(max_score)
+            cache.set(key, stats, STATISTICS_CACHE_TIMEOUT)
+        graded = stats['graded']
+        return {
+            'max_score': max_score,
+            'students': stats['students'],
+            'submitted': stats['submitted'],
+            'graded': graded,
+            'unpublished': stats['unpublished'],
+            'average_score': stats['total_score'] / graded if graded else None,
+            'histogram': stats['histogram'],
+        }
+
+    def _compute_statistics(self, max_score):
+        """
+        Computes the statistics from the `Submission` table, with one query
+        for the counts and one for the number of students with each score.
+        """
+        modules = self.student_modules()
+        counts = modules.aggregate(
+            students=Count('id'),
+            submitted=Count('sga_submission__uploaded_sha1'))
+        scores = modules.filter(sga_submission__score__isnull=False).values(
+            'sga_submission__score', 'sga_submission__score_published'
+        ).annotate(count=Count('id')).order_by()
+
+        graded = unpublished = 0
+        total = 0.0
+        histogram = [0] * HISTOGRAM_BINS
+        for row in scores:
+            score, count = row['sga_submission__score'], row['count']
+            graded += count
+            total += score * count
+            if not row['sga_submission__score_published']:
+                unpublished += count
+            if max_score:
+                histogram[histogram_bin(score, max_score)] += count
+        return {
+            'max_score': max_score,
+            'students': counts['students'],
+            'submitted': counts['submitted'],
+            'graded': graded,
+            'unpublished': unpublished,
+            'total_score': total,
+            'histogram': histogram,
+            'computed': timezone.now(),
+            'expires': time.time() + STATISTICS_CACHE_TIMEOUT,
+        }
+
+    def _update_statistics(self, changes, created=()):
+        update_statistics(
+            self.xmodule_runtime.course_id, self.location.url(), changes,
+            created)
+
+    def student_modules(self):
+        """
+        Returns a query for the state of every student for this assignment.
+        """
+        return StudentModule.objects.filter(
+            course_id=self.xmodule_runtime.course_id,
+            module_state_key=self.location.url())
+
+    def _grading_rows(self, sort, cursor=None, batch_size=None, since=None,
+                      status=None):
+        """
+        Generates gradebook rows in `sort` order, starting after `cursor`.
+        The database sorts and filters the rows, and is paged through using
+        the sort column and module id of the last row seen as the key,
+        `batch_size` rows at a time, so only as many rows as are needed are
+        ever fetched.  Rows with no value in the sort column are paged
+        through by module id after the rest.
+        """
+        # Fetch the student's username and full name in the same query as the
+        # submission, and only the columns the gradebook actually uses.
+        query = self.student_modules().values(*GRADING_COLUMNS)
+        if since is not None:
+            query = query.filter(modified__gte=since)
+        if status is not None:
+            query = query.filter(GRADING_STATUS_FILTERS[status])
+        batch_size = batch_size or GRADING_BATCH_SIZE
+        column = GRADING_SORTS[sort]
+
+        is_null, value, module_id = cursor or (False, None, None)
+        if not is_null:
+            start = None
+            if cursor is not None:
+                if sort == 'timestamp':
+                    value = _parse_datetime(value)
+                start = (value, module_id)
+            modules = iterate_in_batches(
+                query.filter(**{column + '__isnull': False}), batch_size,
+                (column, 'id'), start)
+            for module in modules:
+                yield _student_data(module)
+            module_id = None
+            if sort == 'username':
+                return  # every student has a username
+
+        start = (module_id,) if module_id is not None else None
+        modules = iterate_in_batches(
+            query.filter(**{column + '__isnull': True}), batch_size,
+            ('id',), start)
+        for module in modules:
+            yield _student_data(module)
+
+    @instrumented
     def studio_view(self, context=None):
         try:
             cls = type(self)
@@ -222,9 +519,11 @@ class StaffGradedAssignmentXBlock(XBlock):
                 for field, validator in (
                     (cls.display_name, 'string'),
                     (cls.points, 'number'),
-                    (cls.weight, 'number')))
+                    (cls.weight, 'number'),
+                    (cls.max_file_size, 'number'),
+                    (cls.allowed_file_types, 'string')))
 
-            template = get_template("staff_graded_assignment/edit.html")
+            template = _get_template("staff_graded_assignment/edit.html")
             fragment = Fragment(template.render(Context({
                 "fields": edit_fields
             })))
@@ -235,131 +534,906 @@ class StaffGradedAssignmentXBlock(XBlock):
             log.error("Don't swallow my exceptions", exc_info=True)
             raise
 
+    @instrumented
     @XBlock.json_handler
     def save_sga(self, data, suffix=''):
         for name in ('display_name', 'points', 'weight'):
             setattr(self, name, data.get(name, getattr(self, name)))
+        size = data.get('max_file_size', self.max_file_size)
+        self.max_file_size = float(size) if size not in (None, '') else None
+        self.allowed_file_types = data.get(
+            'allowed_file_types', self.allowed_file_types) or ''
 
+    @instrumented
     @XBlock.handler
     def upload_assignment(self, request, suffix=''):
         assert self.upload_allowed()
+        if request.content_length:
+            # Turn away a file which is too large before reading the rest of
+            # it.  Django may have read the body already, eg for the CSRF
+            # check, in which case this only saves storing it.
+            rejected = self._reject_upload(
+                size=request.content_length - UPLOAD_OVERHEAD)
+            if rejected:
+                return rejected
         upload = request.params['assignment']
-        self.uploaded_sha1 = _get_sha1(upload.file)
-        self.uploaded_filename = upload.file.name
-        self.uploaded_mimetype = mimetypes.guess_type(upload.file.name)[0]
-        self.uploaded_timestamp = _now()
-        path = _file_storage_path(
-            self.location.url(), self.uploaded_sha1, self.uploaded_filename)
-        if not default_storage.exists(path):
-            default_storage.save(path, File(upload.file))
+        filename = upload.file.name
+        rejected = self._reject_upload(filename)
+        if rejected:
+            return rejected
+        try:
+            sha1 = _save_file(
+                self.location.url(), upload.file, filename,
+                self.upload_size_limit())
+        except _FileTooLarge:
+            return self._too_large()
+        state = self._record_upload(sha1, filename)
+        if state is None:
+            return _conflict()
+        return Response(json_body=self.student_state(state))
+
+    @instrumented
+    @XBlock.handler
+    def get_student_state(self, request, suffix=''):
         return Response(json_body=self.student_state())
 
+    @instrumented
+    @XBlock.handler
+    def upload_chunked(self, request, suffix=''):
+        """
+        Uploads an assignment in chunks, so large uploads can be resumed if
+        the connection drops.  The client POSTs the file's `filename` and
+        `size` to `init`, then the body of each chunk to `append`, with the
+        `upload_id` it was given and the `offset` of the chunk, and then
+        calls `finalize`.  `init` resumes an upload of the same file that is
+        already in progress, and returns the offset to carry on from.
+        """
+        assert self.upload_allowed()
+        params = request.params
+        url = self.location.url()
+        upload = self.chunked_upload
+
+        if suffix == 'init':
+            filename = params['filename']
+            size = int(params['size'])
+            rejected = self._reject_upload(filename, size)
+            if rejected:
+                return rejected
+            if not (upload and upload['filename'] == filename and
+                    upload['size'] == size):
+                self._discard_chunked_upload()
+                upload = self.chunked_upload = {
+                    'upload_id': uuid.uuid4().hex,
+                    'filename': filename,
+                    'size': size,
+                    'offset': 0,
+                    'chunks': 0,
+                }
+            return Response(json_body=upload)
+
+        if not upload or params.get('upload_id') != upload['upload_id']:
+            return Response(status=404)
+
+        if suffix == 'append':
+            if int(params['offset']) != upload['offset']:
+                # The client missed our reply to a chunk.  Tell it where to
+                # carry on from.
+                return Response(status=409, json_body=upload)
+            path = _chunk_storage_path(
+                url, upload['upload_id'], upload['chunks'])
+            content = _HashingFile(
+                request.body_file, max_size=upload['size'] - upload['offset'])
+            try:
+                path = default_storage.save(path, content)
+            except _FileTooLarge:
+                _delete_partial(path)
+                return Response(status=400, json_body=upload)
+            sha1 = params.get('sha1')
+            size = upload['offset'] + content.bytes_read
+            if sha1 and sha1 != content.sha1.hexdigest():
+                default_storage.delete(path)
+                return Response(status=400, json_body=upload)
+            upload = dict(upload, offset=size, chunks=upload['chunks'] + 1)
+            self.chunked_upload = upload
+            return Response(json_body=upload)
+
+        if suffix == 'finalize':
+            if upload['offset'] != upload['size']:
+                return Response(status=409, json_body=upload)
+            paths = [_chunk_storage_path(url, upload['upload_id'], i)
+                     for i in range(upload['chunks'])]
+            filename = upload['filename']
+            sha1 = _save_file(url, _ConcatenatedFile(paths), filename)
+            state = self._record_upload(sha1, filename, chunked_upload=None)
+            if state is None:
+                return _conflict()
+            self._delete_chunks(upload)
+            return Response(json_body=self.student_state(state))
+
+        return Response(status=404)
+
+    def upload_size_limit(self):
+        """
+        Returns the largest file, in bytes, which students can upload.
+        """
+        if self.max_file_size is None:
+            return MAX_UPLOAD_SIZE
+        return min(MAX_UPLOAD_SIZE, int(self.max_file_size * 2**20))
+
+    def _reject_upload(self, filename=None, size=None):
+        """
+        Returns an error response if a file called `filename`, of `size`
+        bytes, can't be uploaded, or `None` if it can.
+        """
+        types = _file_types(self.allowed_file_types)
+        if filename is not None and not _type_allowed(types, filename):
+            return Response(status=415, json_body={
+                'error': "Files of this type can't be uploaded.  Upload one "
+                         "of these: %s" % ", ".join(types)})
+        if size is not None and size > self.upload_size_limit():
+            return self._too_large()
+        return None
+
+    def _too_large(self):
+        return Response(status=413, json_body={
+            'error': "File is larger than %d bytes." % self.upload_size_limit()})
+
+    def _submission_state(self):
+        """
+        Returns the student's state, as stored, from the block's fields.
+        """
+        return dict(
+            (name, self.fields[name].to_json(getattr(self, name)))
+            for name in SUBMISSION_FIELDS)
+
+    def _record_upload(self, sha1, filename, **changes):
+        """
+        Records the file the student just uploaded, along with any other
+        `changes` to their state, and queues it for processing.  Returns the
+        student's state as written, or `None` if it kept being changed by
+        staff and couldn't be.
+
+        Staff may have graded or annotated the student while the file was
+        uploading, so only the keys which change are written, with
+        `update_student_states`, rather than the state the block was read
+        with being saved over theirs.  The block's fields are left as they
+        were read, so the runtime doesn't save them either.  Only a student
+        with no state yet has it made by saving the block.
+        """
+        changes.update({
+            'uploaded_sha1': sha1,
+            'uploaded_filename': filename,
+            'uploaded_mimetype': mimetypes.guess_type(filename)[0],
+            'uploaded_timestamp': self.fields['uploaded_timestamp'].to_json(
+                _now()),
+        })
+        modules = list(self.student_modules().filter(
+            student=self.scope_ids.user_id).values_list(
+                'id', 'created', 'sga_submission__id'))
+        if not modules:
+            for name, value in changes.items():
+                setattr(self, name, self.fields[name].from_json(value))
+            state = self._submission_state()
+            module_ids = self._update_submission()
+        else:
+            module_ids = [module_id for module_id, _, _ in modules]
+            states = {}
+            self.update_student_states(
+                dict((module_id, changes) for module_id in module_ids),
+                states=states)
+            if not states:
+                return None
+            state = states.values()[0]
+            # Their module may have been made since the statistics were
+            # computed, eg by starting a chunked upload
+            created = [created for _, created, submission in modules
+                       if submission is None]
+            if created:
+                self._update_statistics([], created)
+        self._process_upload(module_ids, state)
+        return state
+
+    def _update_submission(self):
+        """
+        Copies the current student's state to their `Submission`, so that
+        staff see their upload in the gradebook straight away.  Returns the
+        ids of the student's modules.
+        """
+        self.save()
+        modules = list(self.student_modules().filter(
+            student=self.scope_ids.user_id).values_list('id', 'created'))
+        module_ids = [module_id for module_id, created in modules]
+        state = self._submission_state()
+        old = dict((row['module'], row) for row in Submission.objects.filter(
+            module__in=module_ids).values(
+                'module', 'uploaded_sha1', 'score', 'score_published'))
+        # Students without a submission yet counted as having none
+        changes = [(statistics_row(old.get(module_id, {})),
+                    statistics_row(state)) for module_id in module_ids]
+        for module_id in module_ids:
+            Submission.update_from_state(module_id, state)
+        # Their module may have been made since the statistics were computed
+        self._update_statistics(changes, [
+            created for module_id, created in modules
+            if module_id not in old])
+        return module_ids
+
+    def _process_upload(self, module_ids, state):
+        """
+        Queues the file the student just uploaded, as recorded in `state`,
+        for processing in the background, see `edx_sga.processing`.
+        """
+        sha1, filename = state['uploaded_sha1'], state['uploaded_filename']
+        path = _stored_file_path(self.location.url(), sha1, filename)
+        for module_id in module_ids:
+            process_upload(module_id, sha1, path, filename,
+                           state['uploaded_mimetype'])
+
+    def processing_status(self, sha1=None):
+        """
+        Returns how far processing of the student's uploaded file, or of the
+        one with the given `sha1`, has got, and why it failed, if it did, or
+        `None` if it isn't being processed.
+        """
+        sha1 = sha1 or self.uploaded_sha1
+        if not (sha1 and has_processors()):
+            return None
+        query = Submission.objects.filter(
+            module__course_id=self.xmodule_runtime.course_id,
+            module__module_state_key=self.location.url(),
+            module__student=self.scope_ids.user_id,
+            uploaded_sha1=sha1,
+            processing_status__isnull=False)
+        for status, error, modified in query.values_list(
+                'processing_status', 'processing_error', 'modified'):
+            if processing_lost(status, modified):
+                fail_lost_processing(query)
+                status, error = 'failed', LOST_PROCESSING_ERROR
+            return {'status': status, 'error': error}
+        return None
+
+    def _discard_chunked_upload(self):
+        """
+        Deletes the stored chunks of the chunked upload in progress, if any.
+        """
+        upload = self.chunked_upload
+        if not upload:
+            return
+        self._delete_chunks(upload)
+        self.chunked_upload = None
+
+    def _delete_chunks(self, upload):
+        for i in range(upload['chunks']):
+            path = _chunk_storage_path(
+                self.location.url(), upload['upload_id'], i)
+            default_storage.delete(path)
+
+    @instrumented
     @XBlock.handler
     def staff_upload_annotated(self, request, suffix=''):
         assert self.is_course_staff()
         upload = request.params['annotated']
-        module = StudentModule.objects.get(pk=request.params['module_id'])
-        state = json.loads(module.state)
-        state['annotated_sha1'] = sha1 =  _get_sha1(upload.file)
-        state['annotated_filename'] = filename = upload.file.name
-        state['annotated_mimetype'] = mimetypes.guess_type(upload.file.name)[0]
-        state['annotated_timestamp'] = _now().strftime(DateTime.DATETIME_FORMAT);
-        path = _file_storage_path(self.location.url(), sha1, filename)
-        if not default_storage.exists(path):
-            default_storage.save(path, File(upload.file))
-        module.state = json.dumps(state)
-        module.save()
-        return Response(json_body=self.staff_grading_data())
+        module_id = int(request.params['module_id'])
+        sha1 = _save_file(self.location.url(), upload.file, upload.file.name)
+        conflicts = set()
+        updated = self.update_student_states({module_id: {
+            'annotated_sha1': sha1,
+            'annotated_filename': upload.file.name,
+            'annotated_mimetype': mimetypes.guess_type(upload.file.name)[0],
+            'annotated_timestamp': _now().strftime(DateTime.DATETIME_FORMAT),
+        }}, conflicts)
+        if conflicts:
+            return _conflict()
+        if not updated:
+            return Response(status=404)
+        return Response(json_body=self.changed_grading_data(module_id))
+
+    @instrumented
+    @XBlock.handler
+    def staff_upload_annotated_zip(self, request, suffix=''):
+        """
+        Accepts a ZIP archive of annotated files for many students at once.
+        Each file is matched to a student by username, either as the name of
+        the folder it is in or as its own name without extension, or else by
+        the name of the file the student submitted.  Files are stored one at
+        a time and then every matched student's state is updated together,
+        see `update_student_states`.
+        """
+        assert self.is_course_staff()
+        upload = request.params['annotated']
+        try:
+            archive = zipfile.ZipFile(upload.file)
+        except zipfile.BadZipfile:
+            return Response(status=400)
+
+        by_username = {}
+        by_filename = {}
+        query = self.student_modules().values(
+            'id', 'student__username', 'sga_submission__uploaded_filename')
+        for module in iterate_in_batches(query, GRADING_BATCH_SIZE):
+            by_username[module['student__username']] = module['id']
+            filename = module['sga_submission__uploaded_filename']
+            if filename:
+                by_filename.setdefault(filename, []).append(module['id'])
 
+        def match(name):
+            folder, filename = posixpath.split(name)
+            candidates = [posixpath.basename(folder),
+                          posixpath.splitext(filename)[0]]
+            for username in candidates:
+                if username in by_username:
+                    return by_username[username], None
+            module_ids = by_filename.get(filename, ())
+            if len(module_ids) == 1:
+                return module_ids[0], None
+            if module_ids:
+                return None, "More than one student submitted this file."
+            return None, "No matching student."
+
+        url = self.location.url()
+        matched = []
+        unmatched = []
+        changes = {}
+        for info in archive.infolist():
+            name = info.filename
+            filename = posixpath.basename(name)
+            if not filename or filename.startswith('.') or (
+                    name.startswith('__MACOSX/')):
+                continue
+            module_id, reason = match(name)
+            if module_id in changes:
+                module_id, reason = None, "Another file matched this student."
+            if module_id is None:
+                unmatched.append({'filename': name, 'reason': reason})
+                continue
+            entry = archive.open(info)
+            try:
+                sha1 = _save_file(url, entry, filename)
+            finally:
+                entry.close()
+            changes[module_id] = {
+                'annotated_sha1': sha1,
+                'annotated_filename': filename,
+                'annotated_mimetype': mimetypes.guess_type(filename)[0],
+                'annotated_timestamp': _now().strftime(
+                    DateTime.DATETIME_FORMAT),
+            }
+            matched.append({'filename': name, 'module_id': module_id})
+
+        conflicts = set()
+        updated = self.update_student_states(changes, conflicts)
+        for item in [i for i in matched if i['module_id'] in conflicts]:
+            matched.remove(item)
+            unmatched.append(
+                {'filename': item['filename'], 'reason': CONFLICT_ERROR})
+        data = self.changed_grading_data(*updated)
+        data['matched'] = matched
+        data['unmatched'] = unmatched
+        return Response(json_body=data)
+
+    @instrumented
     @XBlock.handler
     def download_assignment(self, request, suffix=''):
-        path = _file_storage_path(
+        path = _stored_file_path(
             self.location.url(), self.uploaded_sha1, self.uploaded_filename)
         return self.download(path,
             self.uploaded_mimetype,
-            self.uploaded_filename)
+            self.uploaded_filename,
+            self.uploaded_sha1,
+            request)
 
+    @instrumented
     @XBlock.handler
     def download_annotated(self, request, suffix=''):
-        path = _file_storage_path(
+        path = _stored_file_path(
             self.location.url(), self.annotated_sha1, self.annotated_filename)
         return self.download(path,
             self.annotated_mimetype,
-            self.annotated_filename)
+            self.annotated_filename,
+            self.annotated_sha1,
+            request)
 
+    @instrumented
     @XBlock.handler
     def staff_download(self, request, suffix=''):
         assert self.is_course_staff()
         module = StudentModule.objects.get(pk=request.params['module_id'])
         state = json.loads(module.state)
-        path = _file_storage_path(
+        path = _stored_file_path(
             module.module_state_key, state['uploaded_sha1'],
             state['uploaded_filename'])
         return self.download(path,
             state['uploaded_mimetype'],
-            state['uploaded_filename'])
+            state['uploaded_filename'],
+            state['uploaded_sha1'],
+            request)
+
+    @instrumented
+    @XBlock.handler
+    def staff_download_preview(self, request, suffix=''):
+        """
+        Returns the preview of a student's uploaded file, if one has been
+        made, see `edx_sga.previews`.
+        """
+        assert self.is_course_staff()
+        query = self.student_modules().filter(
+            pk=request.params['module_id']).values_list(
+                'sga_submission__uploaded_sha1',
+                'sga_submission__uploaded_filename')
+        for sha1, filename in query:
+            if not sha1:
+                break
+            path = preview_path(_stored_file_path(
+                self.location.url(), sha1, filename))
+            if not default_storage.exists(path):
+                break
+            return self.download(path, 'image/jpeg', filename + '.jpg',
+                                 sha1 + '-preview', request)
+        return Response(status=404)
 
+    @instrumented
     @XBlock.handler
     def staff_download_annotated(self, request, suffix=''):
         assert self.is_course_staff()
         module = StudentModule.objects.get(pk=request.params['module_id'])
         state = json.loads(module.state)
-        path = _file_storage_path(
+        path = _stored_file_path(
             module.module_state_key, state['annotated_sha1'],
             state['annotated_filename'])
         return self.download(path,
             state['annotated_mimetype'],
-            state['annotated_filename'])
+            state['annotated_filename'],
+            state['annotated_sha1'],
+            request)
+
+    def download(self, path, mimetype, filename, sha1, request):
+        """
+        Returns a response for downloading a stored file.  Files are stored
+        under their sha1, which never changes, so it is used as a strong
+        ETag.  Conditional requests and single or multiple byte ranges are
+        supported, so clients can cache files and resume downloads.
+        """
+        etag = '"%s"' % sha1
+        size = default_storage.size(path)
+        headers = {
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': "attachment; filename=" + filename,
+        }
+        if _etag_matches(etag, request.headers.get('If-None-Match')):
+            return _response(headers, status=304)
+        if FILE_SERVING:
+            response = _offload_download(path, mimetype, headers)
+            if response is not None:
+                return response
+
+        ranges = None
+        if_range = request.headers.get('If-Range')
+        if 'Range' in request.headers and (not if_range or if_range == etag):
+            ranges = _parse_ranges(request.headers['Range'], size)
+
+        if not ranges:
+            if ranges is not None:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return _response(headers, status=416)
+            return _response(
+                headers,
+                app_iter=_read_chunks(path),
+                content_type=mimetype,
+                content_length=size)
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            return _response(
+                headers,
+                status=206,
+                app_iter=_read_chunks(path, start, end + 1),
+                content_type=mimetype,
+                content_length=end + 1 - start)
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = 0
+        for start, end in ranges:
+            part_header = (
+                "\r\n--%s\r\nContent-Type: %s\r\n"
+                "Content-Range: bytes %d-%d/%d\r\n\r\n" % (
+                    boundary, mimetype or 'application/octet-stream',
+                    start, end, size))
+            parts.append((part_header, start, end))
+            length += len(part_header) + end + 1 - start
+        trailer = "\r\n--%s--\r\n" % boundary
+        length += len(trailer)
+
+        def app_iter():
+            for part_header, start, end in parts:
+                yield part_header
+                for chunk in _read_chunks(path, start, end + 1):
+                    yield chunk
+            yield trailer
+
+        return _response(
+            headers,
+            status=206,
+            app_iter=app_iter(),
+            content_type="multipart/byteranges; boundary=" + boundary,
+            content_length=length)
+
+    @instrumented
+    @XBlock.handler
+    def staff_download_submissions(self, request, suffix=''):
+        """
+        Streams a ZIP archive of the files uploaded by students, optionally
+        restricted to those with a given grading `status` or uploaded `after`
+        a given date.  The archive is built while it is being sent, one file
+        at a time.
+        """
+        assert self.is_course_staff()
+        status = request.params.get('status') or None
+        if status not in (None,) + GRADING_STATUSES:
+            return Response(status=400)
+        try:
+            after = _parse_datetime(request.params.get('after'))
+        except ValueError:
+            return Response(status=400)
+        filename = "_".join(filter(None, self.location)) + ".zip"
+        return Response(
+            app_iter=stream_zip(self._submission_files(status, after)),
+            content_type="application/zip",
+            content_disposition="attachment; filename=" + filename)
 
-    def download(self, path, mimetype, filename):
-        BLOCK_SIZE = 2**10 * 8 # 8kb
-        file = default_storage.open(path)
-        app_iter = iter(partial(file.read, BLOCK_SIZE), '')
+    def _submission_files(self, status=None, after=None):
+        """
+        Generates a `(name, date_time, size, chunks)` tuple, as expected by
+        `stream_zip`, for each student's uploaded file.
+        """
+        url = self.location.url()
+        query = self.student_modules().filter(
+            sga_submission__uploaded_sha1__isnull=False)
+        if status is not None:
+            query = query.filter(GRADING_STATUS_FILTERS[status])
+        if after is not None:
+            query = query.filter(sga_submission__uploaded_timestamp__gt=after)
+        query = query.values(
+            'id', 'student__username', 'sga_submission__uploaded_sha1',
+            'sga_submission__uploaded_filename',
+            'sga_submission__uploaded_timestamp')
+        for module in iterate_in_batches(query, GRADING_BATCH_SIZE):
+            filename = module['sga_submission__uploaded_filename']
+            timestamp = module['sga_submission__uploaded_timestamp']
+            path = _stored_file_path(
+                url, module['sga_submission__uploaded_sha1'], filename)
+            try:
+                size = default_storage.size(path)
+            except (IOError, OSError):
+                log.warning("Missing submission file: %s", path)
+                continue
+            name = u"%s/%s" % (
+                module['student__username'], os.path.basename(filename))
+            yield name, timestamp or _now(), size, _read_chunks(path)
+
+    @instrumented
+    @XBlock.handler
+    def staff_download_grades(self, request, suffix=''):
+        """
+        Streams the gradebook as a CSV file.  Rows are written as they are
+        read from the database, a batch at a time, so the gradebook is never
+        held in memory.
+        """
+        assert self.is_course_staff()
+        filename = "_".join(filter(None, self.location)) + "_grades.csv"
         return Response(
-            app_iter=app_iter,
-            content_type=mimetype,
+            app_iter=self._grades_csv(),
+            content_type="text/csv",
             content_disposition="attachment; filename=" + filename)
 
+    @instrumented
+    @XBlock.handler
+    def staff_download_course_grades(self, request, suffix=''):
+        """
+        Streams the gradebook for every Staff Graded Assignment in this
+        block's course, as CSV or, with `format=json`, JSON.  See
+        `edx_sga.gradebook`.
+        """
+        assert self.is_course_staff()
+        kind = request.params.get('format', 'csv')
+        if kind not in COURSE_GRADEBOOK_FORMATS:
+            return Response(status=400)
+        generate, content_type = COURSE_GRADEBOOK_FORMATS[kind]
+        course_id = self.xmodule_runtime.course_id
+        filename = "%s_sga_grades.%s" % (
+            "_".join(filter(None, course_id.split("/"))), kind)
+        return Response(
+            app_iter=generate(course_id),
+            content_type=content_type,
+            content_disposition="attachment; filename=" + filename)
+
+    def _grades_csv(self):
+        writer = csv.writer(CSVLine())
+        yield writer.writerow(GRADES_CSV_COLUMNS)
+        for row in self._grading_rows('username'):
+            yield writer.writerow(
+                [csv_value(row[column]) for column in GRADES_CSV_COLUMNS])
+
+    @instrumented
+    @XBlock.handler
+    def staff_upload_grades(self, request, suffix=''):
+        """
+        Enters grades from a CSV file in the format exported by
+        `staff_download_grades`, eg after grading offline.  Students are
+        matched by username, and rows with no score are skipped.  The file is
+        read a row at a time and grades are entered a batch at a time, see
+        `update_student_states`.  The result has the number of grades
+        entered and, for each row which couldn't be, its line number and why.
+        """
+        assert self.is_course_staff()
+        upload = request.params['grades']
+        reader = csv.reader(upload.file)
+        try:
+            header = next(reader)
+        except (StopIteration, csv.Error):
+            return Response(status=400)
+        if header and header[0].startswith(codecs.BOM_UTF8):
+            header[0] = header[0][len(codecs.BOM_UTF8):]  # saved by Excel
+        columns = dict((name.strip(), i) for i, name in enumerate(header))
+        if 'username' not in columns or 'score' not in columns:
+            return Response(status=400, json_body={
+                'error': "The file needs username and score columns."})
+
+        updated = 0
+        errors = []
+        rows = enumerate(_csv_rows(reader, errors), 2)
+        for batch in _batches(rows, GRADING_BATCH_SIZE):
+            updated += self._import_grades(batch, columns, errors)
+        return Response(json_body={'updated': updated, 'errors': errors})
+
+    def _import_grades(self, rows, columns, errors):
+        """
+        Enters the grades in `rows`, a batch of `(line, row)` pairs from an
+        uploaded CSV file, adding any problems to `errors`.  Returns how many
+        grades were entered.
+        """
+        max_score = self.max_score()
+        grades = {}
+        for line, row in rows:
+            try:
+                username = row[columns['username']].decode('utf8').strip()
+                grade = row[columns['score']].strip()
+                changes = {}
+                if 'comment' in columns:
+                    changes['comment'] = row[columns['comment']].decode('utf8')
+            except IndexError:
+                errors.append({'line': line, 'error': "Missing columns."})
+                continue
+            except UnicodeDecodeError:
+                errors.append({'line': line, 'error': "Not UTF-8 text."})
+                continue
+            if not grade:
+                continue
+            try:
+                changes['score'] = _validate_grade(grade, max_score)
+            except ValueError as error:
+                errors.append({'line': line, 'error': str(error)})
+                continue
+            changes['score_published'] = False  # see edx_sga.publishing
+            grades[username] = (line, changes)
+
+        module_ids = dict(self.student_modules().filter(
+            student__username__in=list(grades)).values_list(
+                'student__username', 'id'))
+        changes = {}
+        lines = {}
+        for username, (line, change) in grades.items():
+            if username not in module_ids:
+                errors.append({'line': line, 'error': "No such student."})
+                continue
+            changes[module_ids[username]] = change
+            lines[module_ids[username]] = line
+        conflicts = set()
+        updated = self.update_student_states(changes, conflicts)
+        for module_id in conflicts:
+            errors.append({'line': lines[module_id], 'error': CONFLICT_ERROR})
+        self.publish_grades(dict(
+            (module_id, changes[module_id]['score'])
+            for module_id in updated))
+        return len(updated)
+
+    @instrumented
     @XBlock.handler
     def get_staff_grading_data(self, request, suffix=''):
         assert self.is_course_staff()
-        return Response(json_body=self.staff_grading_data())
+        sort = request.params.get('sort', 'username')
+        status = request.params.get('status') or None
+        try:
+            cursor = _decode_cursor(request.params.get('cursor'))
+            limit = int(request.params.get('limit', STAFF_GRADING_PAGE_SIZE))
+            since = _parse_sync_token(request.params.get('since'))
+        except ValueError:
+            return Response(status=400)
+        if (sort not in GRADING_SORT_KEYS or
+                status not in (None,) + GRADING_STATUSES or limit < 1):
+            return Response(status=400)
+        limit = min(limit, MAX_STAFF_GRADING_PAGE_SIZE)
+        return Response(json_body=self.staff_grading_data(
+            sort, status, cursor, limit, since))
 
+    @instrumented
+    @XBlock.handler
+    def get_statistics(self, request, suffix=''):
+        assert self.is_course_staff()
+        return Response(json_body=self.statistics())
+
+    @instrumented
     @XBlock.handler
     def enter_grade(self, request, suffix=''):
         assert self.is_course_staff()
-        module = StudentModule.objects.get(pk=request.params['module_id'])
-        state = json.loads(module.state)
-        state['score'] = float(request.params['grade'])
-        state['comment'] = request.params.get('comment', '')
-        state['score_published'] = False    # see student_view
-        module.state = json.dumps(state)
+        module_id = int(request.params['module_id'])
+        try:
+            score = _validate_grade(
+                request.params.get('grade'), self.max_score())
+        except ValueError as error:
+            return Response(status=400, json_body={'error': str(error)})
+        conflicts = set()
+        updated = self.update_student_states({module_id: {
+            'score': score,
+            'comment': request.params.get('comment', ''),
+            'score_published': False,   # see edx_sga.publishing
+        }}, conflicts)
+        if conflicts:
+            return _conflict()
+        if not updated:
+            return Response(status=404)
+        self.publish_grades({module_id: score})
+        return Response(json_body=self.changed_grading_data(module_id))
 
-        # This is how we'd like to do it.  See student_view
-        #self.runtime.publish(self, 'grade', {
-        #    'value': state['score'],
-        #    'max_value': self.max_score(),
-        #    'user_id': module.student.id
-        #})
+    @instrumented
+    @XBlock.json_handler
+    def enter_grades(self, data, suffix=''):
+        """
+        Enters many grades at once, eg from a spreadsheet.  `data` has a list
+        of `grades`, each with a `module_id`, `grade` and optional `comment`.
+        The valid grades are written together, see `update_student_states`.
+        The result says for each entry whether it was applied and, if not,
+        why.
+        """
+        assert self.is_course_staff()
+        results = []
+        changes = {}
+        for entry in data.get('grades', []):
+            result = {'module_id': entry.get('module_id'), 'success': False}
+            results.append(result)
+            try:
+                module_id = int(entry['module_id'])
+                score = _validate_grade(entry.get('grade'), self.max_score())
+            except (KeyError, TypeError, ValueError) as error:
+                result['error'] = str(error)
+                continue
+            changes[module_id] = {
+                'score': score,
+                'comment': entry.get('comment') or '',
+                'score_published': False,   # see edx_sga.publishing
+            }
 
-        module.save()
-        return Response(json_body=self.staff_grading_data())
+        conflicts = set()
+        updated = self.update_student_states(changes, conflicts)
+        self.publish_grades(dict(
+            (module_id, changes[module_id]['score'])
+            for module_id in updated))
+        for result in results:
+            if 'error' in result:
+                continue
+            module_id = int(result['module_id'])
+            if module_id in updated:
+                result['success'] = True
+            elif module_id in conflicts:
+                result['error'] = CONFLICT_ERROR
+            else:
+                result['error'] = "No such student module."
 
+        data = self.changed_grading_data(*updated)
+        data['results'] = results
+        return data
+
+    def publish_grades(self, scores):
+        """
+        Publishes grades just entered by staff.  `scores` maps student module
+        ids to scores, or to `None` for removed grades.  Any which can't be
+        published now stay queued, and are retried by the
+        `publish_sga_grades` management command.
+        """
+        if not scores:
+            return
+        queue_grades(scores, self.max_score())
+        publish_grades(scores.keys())
+
+    def update_student_states(self, changes, conflicts=None, states=None):
+        """
+        Applies `changes`, a mapping of student module ids to the state keys
+        to change for each student.  Modules which don't belong to this
+        assignment are ignored.  Each student's `Submission` is kept in step
+        with their state.  Returns the ids of the modules which were updated,
+        and adds the states written to `states`, by module id, if given.
+
+        No locks are held.  A state is only written if it is still as it was
+        read, so nothing written meanwhile, by other staff or by the
+        student, is lost.  If it has changed, it is read again and the
+        changes applied to it again, up to `STATE_UPDATE_ATTEMPTS` times.
+        The ids of any modules still not updated after that are added to
+        `conflicts`, if given.
+        """
+        updated = set()
+        rows = []
+        for attempt in range(STATE_UPDATE_ATTEMPTS):
+            if not changes:
+                break
+            changes = self._try_update_student_states(
+                changes, updated, rows, states)
+        if changes:
+            log.warning("Gave up updating student modules %s, which kept "
+                        "changing.", sorted(changes))
+            if conflicts is not None:
+                conflicts.update(changes)
+        self._update_statistics(rows)
+        return updated
+
+    def _try_update_student_states(self, changes, updated, rows,
+                                   states=None):
+        """
+        Makes one attempt at `update_student_states`, in a single
+        transaction, adding the ids of the modules it updates to `updated`,
+        their statistics rows before and after to `rows`, and their states
+        to `states`, if given.  Returns the changes to the modules which were
+        changed by someone else since they were read.
+        """
+        conflicted = {}
+        now = timezone.now()
+        with transaction.commit_on_success():
+            modules = self.student_modules().filter(
+                pk__in=list(changes)).values_list('id', 'state')
+            for module_id, old_state in modules:
+                state = json.loads(old_state or '{}')
+                row = statistics_row(state)
+                state.update(changes[module_id])
+                # StudentModule has no version column, so the state it was
+                # read with stands in for one.
+                if not _with_state(StudentModule.objects.filter(
+                        pk=module_id), old_state).update(
+                            state=json.dumps(state), modified=now):
+                    conflicted[module_id] = changes[module_id]
+                    continue
+                Submission.update_from_state(module_id, state)
+                updated.add(module_id)
+                rows.append((row, statistics_row(state)))
+                if states is not None:
+                    states[module_id] = state
+            # Commit even if nothing was written, so that a retry reads the
+            # states as they are now, not as they were when this
+            # transaction started.
+            transaction.set_dirty()
+        return conflicted
+
+    @instrumented
     @XBlock.handler
     def remove_grade(self, request, suffix=''):
         assert self.is_course_staff()
-        module = StudentModule.objects.get(pk=request.params['module_id'])
-        state = json.loads(module.state)
-        state['score'] = None
-        state['comment'] = ''
-        state['score_published'] = False    # see student_view
-        state['annotated_sha1'] = None
-        state['annotated_filename'] = None
-        state['annotated_mimetype'] = None
-        state['annotated_timestamp'] = None
-        module.state = json.dumps(state)
-        module.save()
-        return Response(json_body=self.staff_grading_data())
+        module_id = int(request.params['module_id'])
+        conflicts = set()
+        updated = self.update_student_states({module_id: {
+            'score': None,
+            'comment': '',
+            'score_published': False,   # see edx_sga.publishing
+            'annotated_sha1': None,
+            'annotated_filename': None,
+            'annotated_mimetype': None,
+            'annotated_timestamp': None,
+        }}, conflicts)
+        if conflicts:
+            return _conflict()
+        if not updated:
+            return Response(status=404)
+        self.publish_grades({module_id: None})
+        return Response(json_body=self.changed_grading_data(module_id))
 
     def is_course_staff(self):
         return getattr(self.xmodule_runtime, 'user_is_staff', False)
@@ -378,26 +1452,724 @@ class StaffGradedAssignmentXBlock(XBlock):
         return not self.past_due() and self.score is None
 
 
+def _with_state(modules, state):
+    """
+    Restricts a `StudentModule` query to the modules whose state is exactly
+    `state`.  MySQL compares strings ignoring case and trailing spaces under
+    its usual collations, so there the comparison is made on bytes.
+    """
+    if state is None:
+        return modules.filter(state__isnull=True)
+    if connection.vendor == 'mysql':
+        return modules.extra(where=['BINARY state = %s'], params=[state])
+    return modules.filter(state=state)
+
+
+def _student_data(module):
+    """
+    Makes a gradebook row from a `StudentModule` fetched with the
+    `GRADING_COLUMNS` values.
+    """
+    timestamp = module['sga_submission__uploaded_timestamp']
+    if timestamp is not None:
+        timestamp = timestamp.strftime(DateTime.DATETIME_FORMAT)
+    return {
+        'module_id': module['id'],
+        'username': module['student__username'],
+        'fullname': module['student__profile__name'],
+        'filename': module['sga_submission__uploaded_filename'],
+        'preview': _preview_made(module),
+        'timestamp': timestamp,
+        'published': module['sga_submission__score_published'],
+        'score': module['sga_submission__score'],
+        'annotated': module['sga_submission__annotated_filename'],
+        'comment': module['sga_submission__comment'] or '',
+        'status': _grading_status(module),
+    }
+
+
+def _preview_made(module):
+    """
+    Tells whether a preview has been made of the file a student uploaded,
+    so that staff aren't sent looking for previews which don't exist.
+    """
+    return (module['sga_submission__processing_status'] == 'done' and
+            has_preview(module['sga_submission__uploaded_mimetype']) and
+            previews_made())
+
+
+def _grading_status(module):
+    """
+    Returns which of the `GRADING_STATUSES` a `StudentModule` fetched with
+    the `GRADING_COLUMNS` values has, as `GRADING_STATUS_FILTERS` would.
+    """
+    if module['sga_submission__score'] is not None:
+        if module['sga_submission__score_published']:
+            return 'published'
+        return 'unpublished'
+    if module['sga_submission__uploaded_sha1'] is not None:
+        return 'ungraded'
+    return 'missing'
+
+
+def _conflict():
+    return Response(status=409, json_body={'error': CONFLICT_ERROR})
+
+
+def _validate_grade(grade, max_score):
+    """
+    Returns `grade` as a score, or raises `ValueError` if it isn't a number
+    between zero and `max_score`.
+    """
+    if grade is None or grade == '':
+        raise ValueError("Grade is required.")
+    score = float(grade)
+    if score != score:
+        raise ValueError("Grade must be a number.")
+    if score < 0:
+        raise ValueError("Grade must be positive.")
+    if score > max_score:
+        raise ValueError("Maximum score is %s." % max_score)
+    return score
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return tuple(json.loads(
+            base64.urlsafe_b64decode(str(cursor)).decode('utf8')))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+
+
+def _sync_token():
+    # Back the token off a little, so that rows saved by transactions which
+    # were still in flight when it was issued are picked up by the next sync.
+    # Sending a row the client already has is harmless.
+    return (_now() - SYNC_MARGIN).strftime(SYNC_TOKEN_FORMAT)
+
+
+def _parse_sync_token(token):
+    if not token:
+        return None
+    return datetime.datetime.strptime(
+        token, SYNC_TOKEN_FORMAT).replace(tzinfo=pytz.utc)
+
+
 def _file_storage_path(url, sha1, filename):
-    assert url.startswith("i4x://")
-    path = url[6:] + '/' + sha1
+    """
+    Returns where a file for the block at `url` is stored under the block
+    storage layout.
+    """
+    path = storage_prefix(url) + '/' + sha1
     path += os.path.splitext(filename)[1]
     return path
 
 
-def _get_sha1(file):
-    BLOCK_SIZE = 2**10 * 8 # 8kb
-    sha1 = hashlib.sha1()
-    for block in iter(partial(file.read, BLOCK_SIZE), ''):
-        sha1.update(block)
-    file.seek(0)
-    return sha1.hexdigest()
+def _new_file_path(url, sha1, filename):
+    """
+    Returns where to store a new file, under the `STORAGE_LAYOUT` in use.
+    """
+    if STORAGE_LAYOUT == 'shared':
+        return blob_path(sha1)
+    return _file_storage_path(url, sha1, filename)
+
+
+def _stored_file_path(url, sha1, filename):
+    """
+    Returns where a stored file is.  Under the shared storage layout, files
+    stored before switching to it are still in the block's folder.
+    """
+    if STORAGE_LAYOUT == 'shared':
+        path = blob_path(sha1)
+        if default_storage.exists(path):
+            return path
+    return _file_storage_path(url, sha1, filename)
+
+
+def _batches(iterable, size):
+    """
+    Generates lists of up to `size` items from `iterable`, which is consumed
+    lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _csv_rows(reader, errors):
+    """
+    Generates the rows read by a `csv.reader` up to the first which can't
+    be parsed, if any, which is added to `errors` instead.  The rows before
+    it are still generated, so they can be used.
+    """
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            errors.append({'line': reader.line_num, 'error': str(error)})
+            return
+
+
+def _read_chunks(path, start=0, end=None, block_size=2**16):
+    """
+    Generates the contents of a stored file from byte `start` up to, but not
+    including, byte `end`, `block_size` bytes at a time.  The file is only
+    opened once the first chunk is wanted.
+    """
+    file = default_storage.open(path)
+    try:
+        if start:
+            file.seek(start)
+        remaining = end - start if end is not None else None
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                block = file.read(block_size)
+            else:
+                block = file.read(min(block_size, remaining))
+                remaining -= len(block)
+            if not block:
+                break
+            yield block
+    finally:
+        file.close()
+
+
+def _response(headers, **kw):
+    response = Response(**kw)
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
+
+
+def _offload_download(path, mimetype, headers):
+    """
+    Returns a response which hands sending a stored file off to the front
+    end web server or to the storage backend, as set by `FILE_SERVING`, or
+    `None` if the storage backend can't do that.  Only the permission check
+    is then done in Python.
+    """
+    if FILE_SERVING == 'redirect':
+        # Storage backends like S3 return a signed URL which expires.  The
+        # browser takes the file's name and type from the storage backend's
+        # response, not from the redirect, so the URL has to ask for them.
+        try:
+            url = default_storage.url(path, response_headers={
+                'response-content-disposition':
+                    headers['Content-Disposition'],
+                'response-content-type': mimetype,
+            })
+        except (NotImplementedError, TypeError):
+            # The backend's URLs can't do that
+            return None
+        return _response(headers, status=302, location=url)
+
+    if FILE_SERVING == 'x-accel-redirect':
+        headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + urllib.quote(
+            path.encode('utf8'))
+    elif FILE_SERVING == 'x-sendfile':
+        try:
+            headers['X-Sendfile'] = default_storage.path(path)
+        except NotImplementedError:
+            return None
+    else:
+        raise ValueError("Unknown SGA_FILE_SERVING: %s" % FILE_SERVING)
+
+    # The web server sends the body and works out its length itself.
+    response = _response(headers, content_type=mimetype)
+    response.content_length = None
+    return response
+
+
+def _etag_matches(etag, if_none_match):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as RFC 7232 requires for If-None-Match
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+
+def _parse_ranges(header, size):
+    """
+    Parses an HTTP Range header for a file of `size` bytes.  Returns a list
+    of inclusive `(start, end)` byte ranges, an empty list if none of the
+    ranges can be satisfied, or `None` if the header should be ignored.
+    """
+    units, _, specs = header.partition('=')
+    if units.strip() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if not dash:
+                return None
+            if not first:
+                # The last `last` bytes of the file
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+            else:
+                start = int(first)
+                end = size - 1
+                if last:
+                    if int(last) < start:
+                        return None
+                    end = min(int(last), end)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    return DateTime().from_json(value)
+
+
+class _FileTooLarge(Exception):
+    pass
+
+
+class _HashingFile(File):
+    """
+    A `File` which computes the sha1 of its contents as they are read, so a
+    file can be hashed and stored in a single pass.  Reading more than
+    `max_size` bytes raises `_FileTooLarge`, so storing a file which is too
+    large is given up as soon as that is known.  Files which can't be
+    sought are spooled as they are read, see `_SpooledFile`, since some
+    storage backends rewind the file and read it again.
+    """
+
+    def __init__(self, file, name=None, max_size=None):
+        if not _seekable(file):
+            file = _SpooledFile(file, max_size)
+        super(_HashingFile, self).__init__(file, name)
+        self.sha1 = hashlib.sha1()
+        self.bytes_read = 0
+        self.max_size = max_size
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self.sha1.update(data)
+        self.bytes_read += len(data)
+        if self.max_size is not None and self.bytes_read > self.max_size:
+            raise _FileTooLarge()
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        # Some storage backends rewind the file and read it again.
+        if (pos, whence) == (0, os.SEEK_SET):
+            self.sha1 = hashlib.sha1()
+            self.bytes_read = 0
+        self.file.seek(pos, whence)
+
+    def chunks(self, chunk_size=None):
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        return iter(partial(self.read, chunk_size), '')
+
+
+def _seekable(file):
+    if hasattr(file, 'seekable'):
+        return file.seekable()
+    return hasattr(file, 'seek')
+
+
+class _SpooledFile(object):
+    """
+    Makes a file which can only be read straight through seekable, by
+    keeping what has been read of it in a temporary file, in memory until it
+    is larger than `FILE_UPLOAD_MAX_MEMORY_SIZE`.  Spooling more than
+    `max_size` bytes raises `_FileTooLarge`.
+    """
+
+    def __init__(self, file, max_size=None):
+        self.source = file
+        self.max_size = max_size
+        self.spool = tempfile.SpooledTemporaryFile(
+            settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        self.length = 0
+
+    def read(self, size=-1):
+        data = self.spool.read(size)
+        if size < 0:
+            more = self.source.read()
+        elif len(data) < size:
+            more = self.source.read(size - len(data))
+        else:
+            return data
+        # Reading the spool to its end leaves it positioned to append
+        self._append(more)
+        return data + more
+
+    def _append(self, data):
+        self.length += len(data)
+        if self.max_size is not None and self.length > self.max_size:
+            raise _FileTooLarge()
+        self.spool.write(data)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET or pos > self.length:
+            # Spool the rest, to know where the end is
+            self.spool.seek(0, os.SEEK_END)
+            for data in iter(partial(self.source.read, 2**16), ''):
+                self._append(data)
+        self.spool.seek(pos, whence)
+
+    def tell(self):
+        return self.spool.tell()
+
+    def close(self):
+        self.spool.close()
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+class _ConcatenatedFile(object):
+    """
+    Reads a sequence of stored files as though they were one file.  It can
+    be sought, by opening the stored file the position is in, so it is
+    never spooled.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.sizes = None
+        self.index = 0
+        self.file = None
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(partial(self.read, 2**16), ''))
+        while self.index < len(self.paths):
+            if self.file is None:
+                self.file = default_storage.open(self.paths[self.index])
+            data = self.file.read(size)
+            if data:
+                self.pos += len(data)
+                return data
+            self.file.close()
+            self.file = None
+            self.index += 1
+        return ''
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if (pos, whence) != (0, os.SEEK_SET) and self.sizes is None:
+            self.sizes = [default_storage.size(path) for path in self.paths]
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += sum(self.sizes)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.index, self.pos, offset = 0, pos, pos
+        while offset and self.index < len(self.paths):
+            if offset < self.sizes[self.index]:
+                self.file = default_storage.open(self.paths[self.index])
+                self.file.seek(offset)
+                break
+            offset -= self.sizes[self.index]
+            self.index += 1
+
+    def tell(self):
+        return self.pos
+
+
+def _save_file(url, file, filename, max_size=None):
+    """
+    Stores `file` under its content address for the block at `url`, and
+    returns its sha1.  The file is read only once: it is hashed while it is
+    written to a temporary key, which is then either moved to the content
+    address or, if that file is already stored, deleted.  Under the shared
+    storage layout, that includes files uploaded to other blocks.  Raises
+    `_FileTooLarge`, having stored nothing, as soon as more than `max_size`
+    bytes have been read.
+
+    Where files can't just be renamed in storage, a file which isn't in
+    storage already is hashed where it is first, and then stored once,
+    straight to its content address, rather than sent to storage, copied
+    and deleted.
+    """
+    content = _HashingFile(file, filename, max_size)
+    if not isinstance(file, _ConcatenatedFile) and not _storage_has_paths():
+        return _save_hashed_file(url, content, filename)
+    tmp = _temp_storage_path(url, filename)
+    try:
+        tmp = default_storage.save(tmp, content)
+    except _FileTooLarge:
+        _delete_partial(tmp)
+        raise
+    sha1 = content.sha1.hexdigest()
+    path = _new_file_path(url, sha1, filename)
+    if _refresh_stored_file(path):
+        default_storage.delete(tmp)
+    else:
+        _move_stored_file(tmp, path)
+    return sha1
+
+
+def _save_hashed_file(url, content, filename):
+    """
+    Stores a `_HashingFile` which can be read twice under its content
+    address, having read it through to hash it.
+    """
+    for _ in content.chunks():
+        pass
+    sha1 = content.sha1.hexdigest()
+    path = _new_file_path(url, sha1, filename)
+    if not _refresh_stored_file(path):
+        content.seek(0)
+        saved = default_storage.save(path, content)
+        if saved != path:
+            # Someone else stored the same file meanwhile
+            default_storage.delete(saved)
+    return sha1
+
+
+def _refresh_stored_file(path):
+    """
+    Returns whether a file is stored already, and if it is, makes it count
+    as new, so that it isn't collected as garbage, see `edx_sga.garbage`,
+    before the state which is to refer to it again is saved.  A file which
+    has just been collected has to be stored again.  Backends other than the
+    filesystem and S3 can only be asked whether it is there.
+    """
+    try:
+        local_path = default_storage.path(path)
+    except NotImplementedError:
+        pass
+    else:
+        try:
+            os.utime(local_path, None)
+        except OSError:
+            return False
+        return True
+
+    bucket, key = _s3_key(path)
+    if bucket is None:
+        return default_storage.exists(path)
+    # S3 only copies an object onto itself if its metadata is replaced
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    try:
+        bucket.copy_key(key, bucket.name, key, preserve_acl=True,
+                        metadata={'Content-Type': mimetype})
+    except Exception as error:
+        if getattr(error, 'status', None) == 404:
+            return False
+        raise
+    return True
+
+
+def _storage_has_paths():
+    try:
+        default_storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def _delete_partial(path):
+    """
+    Deletes what was stored of a file before storing it was given up.
+    """
+    try:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+    except (IOError, OSError):
+        log.warning("Unable to delete partial file %s", path, exc_info=True)
+
+
+def _file_types(spec):
+    """
+    Parses the allowed file types setting into a list of lower case
+    extensions and mime type patterns.
+    """
+    return [part.strip().lower() for part in (spec or '').split(',')
+            if part.strip()]
+
+
+def _type_allowed(types, filename):
+    """
+    Tells whether a file called `filename` is one of the `types`, which
+    are extensions, eg '.pdf', or mime types, eg 'image/*'.  Any file is
+    allowed if there are none.
+    """
+    if not types:
+        return True
+    name = filename.lower()
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    for pattern in types:
+        if pattern.startswith('.'):
+            if name.endswith(pattern):
+                return True
+        elif fnmatch.fnmatch(mimetype, pattern):
+            return True
+    return False
+
+
+def _move_stored_file(src, dst):
+    """
+    Moves a file within `default_storage`.  Storage backends on the local
+    filesystem just rename it, S3 copies it itself, others have to have it
+    downloaded and uploaded again.
+    """
+    try:
+        src_path = default_storage.path(src)
+        dst_path = default_storage.path(dst)
+    except NotImplementedError:
+        if not _copy_in_storage(src, dst):
+            file = default_storage.open(src)
+            try:
+                default_storage.save(dst, file)
+            finally:
+                file.close()
+        default_storage.delete(src)
+        return
+
+    directory = os.path.dirname(dst_path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Someone else may have just made it
+            if not os.path.isdir(directory):
+                raise
+    os.rename(src_path, dst_path)
+
+
+def _copy_in_storage(src, dst):
+    """
+    Has the storage backend copy a file itself, if it is S3, and returns
+    whether it was copied.
+    """
+    bucket, src_key = _s3_key(src)
+    if bucket is None:
+        return False
+    bucket.copy_key(_s3_key(dst)[1], bucket.name, src_key, preserve_acl=True)
+    return True
+
+
+def _s3_key(path):
+    """
+    Returns the bucket and key name of a stored file, if the storage backend
+    is S3 through boto (django-storages' `S3BotoStorage`), or `None`s.
+    """
+    storage = getattr(default_storage, 'storage', default_storage)
+    bucket = getattr(storage, 'bucket', None)
+    if not hasattr(bucket, 'copy_key'):
+        return None, None
+    name = storage._normalize_name(storage._clean_name(path))
+    return bucket, storage._encode_name(name)
+
+
+def _chunk_storage_path(url, upload_id, index):
+    return '%s/tmp/%s/%06d' % (storage_prefix(url), upload_id, index)
+
+
+def _temp_storage_path(url, filename):
+    path = storage_prefix(url) + '/tmp/' + uuid.uuid4().hex
+    path += os.path.splitext(filename)[1]
+    return path
+
+
+class _LRUCache(object):
+    """
+    A dictionary which holds on to at most `size` of the items most recently
+    used.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# Process wide caches of compiled templates, static resources and rendered
+# fragments.  Keys include the package version, so nothing stale is served
+# after an upgrade.
+_templates = {}
+_resources = {}
+_fragments = _LRUCache(FRAGMENT_CACHE_SIZE)
+
+
+def clear_caches():
+    _templates.clear()
+    _resources.clear()
+    _fragments.clear()
+
+
+def _get_template(name):
+    key = (VERSION, name)
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = get_template(name)
+    return template
+
+
+def _render_cached(name, context):
+    """
+    Renders template `name` with `context`, which must be JSON serializable.
+    The result is cached, keyed on a hash of the context and the language it
+    is translated into, so rendering again for a student whose state hasn't
+    changed is just a lookup.
+    """
+    key = hashlib.sha1(json.dumps(
+        [VERSION, name, get_language(), context],
+        sort_keys=True).encode('utf8')).hexdigest()
+    html = _fragments.get(key)
+    if html is None:
+        html = _get_template(name).render(Context(context))
+        _fragments.set(key, html)
+    return html
 
 
 def _resource(path):  # pragma NO COVER
     """Handy helper for getting resources from our kit."""
-    data = pkg_resources.resource_string(__name__, path)
-    return data.decode("utf8")
+    key = (VERSION, path)
+    data = _resources.get(key)
+    if data is None:
+        data = pkg_resources.resource_string(__name__, path).decode("utf8")
+        _resources[key] = data
+    return data
 
 
 def _now():
@@ -2,18 +2,51 @@
 function StaffGradedAssignmentXBlock(runtime, element) {
     function xblock($, _) {
         var uploadUrl = runtime.handlerUrl(element, 'upload_assignment');
+        var chunkedInitUrl = runtime.handlerUrl(element, 'upload_chunked', 'init');
+        var chunkedAppendUrl = runtime.handlerUrl(element, 'upload_chunked', 'append');
+        var chunkedFinalizeUrl = runtime.handlerUrl(element, 'upload_chunked', 'finalize');
+        var chunkSize = 8 * 1024 * 1024;
+        var maxRetries = 5;
         var downloadUrl = runtime.handlerUrl(element, 'download_assignment');
+        var studentStateUrl = runtime.handlerUrl(element, 'get_student_state');
+        var processingPollInterval = 5000;      // growing by half each time
+        var processingPollMaxInterval = 60000;
+        var processingPollLimit = 60;           // about an hour, then stop
+        var processingPolls = 0;
+        var processingPoll;
         var annotatedUrl = runtime.handlerUrl(element, 'download_annotated');
         var getStaffGradingUrl = runtime.handlerUrl(element, 'get_staff_grading_data');
         var staffDownloadUrl = runtime.handlerUrl(element, 'staff_download');
         var staffAnnotatedUrl = runtime.handlerUrl(element, 'staff_download_annotated');
+        var staffPreviewUrl = runtime.handlerUrl(element, 'staff_download_preview');
         var staffUploadUrl = runtime.handlerUrl(element, 'staff_upload_annotated');
+        var staffUploadZipUrl = runtime.handlerUrl(
+            element, 'staff_upload_annotated_zip');
+        var staffDownloadSubmissionsUrl = runtime.handlerUrl(
+            element, 'staff_download_submissions');
+        var staffDownloadGradesUrl = runtime.handlerUrl(
+            element, 'staff_download_grades');
+        var staffUploadGradesUrl = runtime.handlerUrl(
+            element, 'staff_upload_grades');
+        var staffDownloadCourseGradesUrl = runtime.handlerUrl(
+            element, 'staff_download_course_grades');
+        var getStatisticsUrl = runtime.handlerUrl(element, 'get_statistics');
         var enterGradeUrl = runtime.handlerUrl(element, 'enter_grade');
         var removeGradeUrl = runtime.handlerUrl(element, 'remove_grade');
         var template = _.template($(element).find("#sga-tmpl").text());
         var gradingTemplate;
+        var gradingRowTemplate;
+        var statisticsTemplate;
+        var gradingQuery = {sort: "username", status: ""};
+        var gradingData;
+        var gradingIndex = {};      // module id -> position in gradingData
+        var renderedRows = null;    // [first, last) rows currently rendered
+        var rowHeight = 0;
+        var overscan = 10;          // rows rendered above and below the view
+        var annotatedUploads = {};  // module id -> percent uploaded
+        var annotatedModuleId;
 
-        function render(state) {
+        function render(state, polled) {
             // Add download urls to template context
             state.downloadUrl = downloadUrl;
             state.annotatedUrl = annotatedUrl;
@@ -22,17 +55,50 @@ function StaffGradedAssignmentXBlock(runtime, element) {
             // Render template
             var content = $(element).find("#sga-content").html(template(state));
 
+            // Check back while the uploaded file is being processed, less
+            // and less often, and not forever
+            clearTimeout(processingPoll);
+            if (!polled) {
+                processingPolls = 0;
+            }
+            var processing = state.uploaded && state.uploaded.processing;
+            if (processing && (processing.status == "pending" ||
+                               processing.status == "running") &&
+                    processingPolls < processingPollLimit) {
+                var interval = Math.min(
+                    processingPollInterval * Math.pow(1.5, processingPolls),
+                    processingPollMaxInterval);
+                processingPoll = setTimeout(function() {
+                    processingPolls += 1;
+                    $.get(studentStateUrl).success(function(state) {
+                        render(state, true);
+                    });
+                }, interval);
+            }
+
             // Set up file upload
             $(content).find(".fileupload").fileupload({
                 url: uploadUrl,
                 add: function(e, data) {
+                    var error = checkUpload(data.files[0], state);
+                    if (error) {
+                        state.error = error;
+                        render(state);
+                        return;
+                    }
                     var do_upload = $(content).find(".upload").html('');
                     $('<button/>')
                         .text('Upload ' + data.files[0].name)
                         .appendTo(do_upload)
                         .click(function() {
+                            var file = data.files[0];
                             do_upload.text("Uploading...");
-                            data.submit();
+                            if (file.size > chunkSize && file.slice) {
+                                uploadChunked(file, state);
+                            }
+                            else {
+                                data.submit();
+                            }
                         });
                 },
                 progressall: function(e, data) {
@@ -58,76 +124,394 @@ function StaffGradedAssignmentXBlock(runtime, element) {
                     else {
                         render(data.result); 
                     }
+                },
+                fail: function(e, data) {
+                    var error = data.jqXHR.responseJSON;
+                    state.error = error ? error.error : "Upload failed.";
+                    render(state);
+                }
+            });
+        }
+
+        /* Check a file against the assignment's limits before sending any
+         * of it.  Returns why it can't be uploaded, if it can't.  The server
+         * checks again, as the upload arrives. */
+        function checkUpload(file, state) {
+            var types = state.allowed_file_types;
+            if (types.length) {
+                var name = file.name.toLowerCase();
+                var mimetype = (file.type || "").toLowerCase();
+                var allowed = types.some(function(type) {
+                    if (type.charAt(0) == ".") {
+                        return name.slice(-type.length) == type;
+                    }
+                    if (type.slice(-2) == "/*") {
+                        return mimetype.indexOf(type.slice(0, -1)) === 0;
+                    }
+                    return mimetype == type;
+                });
+                if (!allowed) {
+                    return "Files of this type can't be uploaded.  " +
+                        "Upload one of these: " + types.join(", ");
+                }
+            }
+            if (file.size !== undefined && file.size > state.max_file_size) {
+                return "File is larger than " + state.max_file_size +
+                    " bytes.";
+            }
+            return null;
+        }
+
+        /* Upload a large file in chunks.  If a chunk fails, ask the server
+         * where the upload got to and carry on from there. */
+        function uploadChunked(file, state) {
+            var retries = 0;
+
+            function fail(xhr) {
+                var error = "Upload failed.";
+                try {
+                    error = JSON.parse(xhr.responseText).error || error;
+                }
+                catch (e) {}
+                state.error = error;
+                render(state);
+            }
+
+            function resume() {
+                if (retries++ >= maxRetries) {
+                    return fail({});
+                }
+                setTimeout(function() {
+                    $.post(chunkedInitUrl, {filename: file.name, size: file.size})
+                        .success(send)
+                        .error(resume);
+                }, 1000 * retries);
+            }
+
+            function send(upload) {
+                if (upload.offset >= upload.size) {
+                    $.post(chunkedFinalizeUrl, {upload_id: upload.upload_id})
+                        .success(function(state) {
+                            render(state);
+                        })
+                        .error(fail);
+                    return;
+                }
+                var end = Math.min(upload.offset + chunkSize, upload.size);
+                var percent = parseInt(upload.offset / upload.size * 100, 10);
+                $(element).find("#sga-content .upload").text(
+                    "Uploading... " + percent + "%");
+                $.ajax({
+                    type: "POST",
+                    url: chunkedAppendUrl + "?" + $.param({
+                        upload_id: upload.upload_id,
+                        offset: upload.offset
+                    }),
+                    data: file.slice(upload.offset, end),
+                    processData: false,
+                    contentType: "application/octet-stream",
+                    success: function(upload) {
+                        retries = 0;
+                        send(upload);
+                    },
+                    error: function(xhr) {
+                        if (xhr.status == 409) {
+                            send(JSON.parse(xhr.responseText));
+                        }
+                        else {
+                            resume();
+                        }
+                    }
+                });
+            }
+
+            $.post(chunkedInitUrl, {filename: file.name, size: file.size})
+                .success(send)
+                .error(fail);
+        }
+
+        /* Fetch a page of the gradebook.  With a cursor, the page is added
+         * to the rows already shown, otherwise it replaces them. */
+        function loadStaffGrading(cursor) {
+            var params = $.extend({}, gradingQuery);
+            if (cursor) {
+                params.cursor = cursor;
+            }
+            $.ajax({
+                url: getStaffGradingUrl,
+                data: params,
+                success: function(data) {
+                    if (cursor) {
+                        gradingData.assignments = gradingData.assignments.concat(
+                            data.assignments);
+                        gradingData.cursor = data.cursor;
+                        indexGradingRows();
+                        $(element).find("#grading-more").toggle(!!data.cursor);
+                        renderGradingRows(true);
+                    }
+                    else {
+                        renderStaffGrading(data);
+                    }
+                }
+            });
+        }
+
+        /* Fetch only the rows modified since the gradebook was loaded, then
+         * call `done`, if given.  Rows are fetched whatever their status, so
+         * that rows which have changed out of the status being shown are
+         * seen, and dropped. */
+        function syncStaffGrading(cursor, since, done) {
+            var params = {since: gradingData.since, sort: gradingQuery.sort};
+            if (cursor) {
+                params.cursor = cursor;
+            }
+            $.ajax({
+                url: getStaffGradingUrl,
+                data: params,
+                success: function(data) {
+                    since = since || data.since;
+                    patchStaffGrading(data);
+                    if (data.cursor) {
+                        syncStaffGrading(data.cursor, since, done);
+                    }
+                    else {
+                        gradingData.since = since;
+                        if (done) {
+                            done();
+                        }
+                    }
+                }
+            });
+        }
+
+        /* Replace rows in the gradebook with changed rows returned by the
+         * server, re-rendering only those which are in view.  Rows which no
+         * longer have the status being shown are dropped.  New rows are only
+         * added once every page has been loaded, since otherwise they may
+         * belong on a page not fetched yet. */
+        function patchStaffGrading(changes) {
+            var reindex = false;
+            var dropped = {};
+            $(".grade-modal").hide();
+            changes.assignments.map(function(assignment) {
+                var i = gradingIndex[assignment.module_id];
+                var shown = !gradingQuery.status ||
+                    assignment.status == gradingQuery.status;
+                if (i !== undefined && !shown) {
+                    dropped[assignment.module_id] = true;
+                    reindex = true;
+                }
+                else if (i !== undefined) {
+                    gradingData.assignments[i] = assignment;
+                    renderGradingRow(assignment.module_id);
+                }
+                else if (shown && !gradingData.cursor) {
+                    gradingData.assignments.push(assignment);
+                    reindex = true;
+                }
+            });
+            if (reindex) {
+                gradingData.assignments = gradingData.assignments.filter(
+                    function(assignment) {
+                        return !dropped[assignment.module_id];
+                    });
+                indexGradingRows();
+                renderGradingRows(true);
+            }
+            loadStatistics();
+        }
+
+        /* Show the grading progress summary next to the grading button. */
+        function loadStatistics() {
+            $.ajax({
+                url: getStatisticsUrl,
+                success: function(data) {
+                    $(element).find(".grading-statistics")
+                        .html(statisticsTemplate(data));
                 }
             });
         }
 
+        /* Render the gradebook: the filters, the table and the upload
+         * widgets.  Only the rows in view are rendered, see
+         * renderGradingRows. */
         function renderStaffGrading(data) {
             $(".grade-modal").hide();
+            gradingData = data;
+            indexGradingRows();
+            renderedRows = null;
 
             // Add download urls to template context
-            data.downloadUrl = staffDownloadUrl;
-            data.annotatedUrl = staffAnnotatedUrl;
+            data.downloadSubmissionsUrl = staffDownloadSubmissionsUrl;
+            data.downloadGradesUrl = staffDownloadGradesUrl;
+            data.downloadCourseGradesUrl = staffDownloadCourseGradesUrl;
+            data.status = gradingQuery.status;
 
             // Render template
-            $(element).find("#grade-info")
-                .html(gradingTemplate(data))
-                .data(data);
-
-            // Map data to table rows
-            data.assignments.map(function(assignment) {
-                $(element).find("#grade-info #row-" + assignment.module_id)
-                    .data(assignment);
+            $(element).find("#grade-info").html(gradingTemplate(data));
+            $(element).find("#grading-status").val(gradingQuery.status);
+            $(element).find(".grading-rows").on("scroll", function() {
+                renderGradingRows(false);
             });
+            renderGradingRows(true);
 
             // Set up grade entry modal
-            $(element).find(".enter-grade-button")
-                .leanModal({closeButton: "#enter-grade-cancel"})
-                .on("click", handleGradeEntry);
-
-            // Set up annotated file upload
-            $(element).find("#grade-info .fileupload").each(function() {
-                var row = $(this).parents("tr");
-                var url = staffUploadUrl + "?module_id=" + row.data("module_id");
-                $(this).fileupload({
-                    url: url,
-                    /*
-                    add: function(e, data) {
-                        var upload = $(this).parents(".upload").html('');
-                        $('<button/>')
-                            .text('Upload ' + data.files[0].name)
-                            .appendTo(upload)
-                            .click(function() {
-                                upload.text("Uploading...");
-                                data.submit();
-                            });
-                    },
-                    */
-                    progressall: function(e, data) {
-                        var percent = parseInt(data.loaded / data.total * 100, 10);
-                        row.find(".upload").text("Uploading... " + percent + "%");
-                    },
-                    done: function(e, data) { 
-                        // Add a time delay so user will notice upload finishing
-                        // for small files
-                        setTimeout(
-                            function() { renderStaffGrading(data.result); }, 
-                            3000)
-                    }
-                });
+            $(element).find("#enter-grade-trigger")
+                .leanModal({closeButton: "#enter-grade-cancel"});
+
+            // Set up annotated file upload, for whichever row's button was
+            // clicked
+            $(element).find("#annotated-upload").fileupload({
+                url: staffUploadUrl,
+                add: function(e, data) {
+                    var module_id = annotatedModuleId;
+                    data.url = staffUploadUrl + "?module_id=" + module_id;
+                    data.module_id = module_id;
+                    annotatedUploads[module_id] = 0;
+                    renderGradingRow(module_id);
+                    data.submit();
+                },
+                progress: function(e, data) {
+                    annotatedUploads[data.module_id] = parseInt(
+                        data.loaded / data.total * 100, 10);
+                    renderGradingRow(data.module_id);
+                },
+                done: function(e, data) {
+                    // Add a time delay so user will notice upload finishing
+                    // for small files
+                    setTimeout(function() {
+                        delete annotatedUploads[data.module_id];
+                        patchStaffGrading(data.result);
+                    }, 3000);
+                }
+            });
+
+            // Set up upload of a ZIP of annotated files
+            $(element).find("#grade-info .upload-zip .fileupload").fileupload({
+                url: staffUploadZipUrl,
+                progressall: function(e, data) {
+                    var percent = parseInt(data.loaded / data.total * 100, 10);
+                    $(element).find(".upload-summary").text(
+                        "Uploading... " + percent + "%");
+                },
+                done: function(e, data) {
+                    var unmatched = data.result.unmatched.map(function(file) {
+                        return file.filename + " (" + file.reason + ")";
+                    });
+                    patchStaffGrading(data.result);
+                    $(element).find(".upload-summary").text(
+                        data.result.matched.length + " files matched. " +
+                        (unmatched.length ?
+                            "Not matched: " + unmatched.join(", ") : ""));
+                }
+            });
+
+            // Set up upload of grades from a CSV file
+            $(element).find("#grade-info .upload-grades .fileupload").fileupload({
+                url: staffUploadGradesUrl,
+                progressall: function(e, data) {
+                    var percent = parseInt(data.loaded / data.total * 100, 10);
+                    $(element).find(".upload-grades-summary").text(
+                        "Uploading... " + percent + "%");
+                },
+                done: function(e, data) {
+                    var errors = data.result.errors.map(function(error) {
+                        return "line " + error.line + " (" + error.error + ")";
+                    });
+                    syncStaffGrading(null, null, function() {
+                        $(element).find(".upload-grades-summary").text(
+                            data.result.updated + " grades entered. " +
+                            (errors.length ?
+                                "Not entered: " + errors.join(", ") : ""));
+                    });
+                },
+                fail: function(e, data) {
+                    var error = data.jqXHR.responseJSON;
+                    $(element).find(".upload-grades-summary").text(
+                        error ? error.error : "Upload failed.");
+                }
+            });
+        }
+
+        function indexGradingRows() {
+            gradingIndex = {};
+            gradingData.assignments.map(function(assignment, i) {
+                gradingIndex[assignment.module_id] = i;
             });
         }
 
-        /* Click event handler for "enter grade" */
-        function handleGradeEntry() {
-            var row = $(this).parents("tr");
+        function gradingRowHtml(assignment) {
+            return gradingRowTemplate($.extend({
+                downloadUrl: staffDownloadUrl,
+                annotatedUrl: staffAnnotatedUrl,
+                previewUrl: staffPreviewUrl,
+                max_score: gradingData.max_score,
+                uploading: annotatedUploads[assignment.module_id]
+            }, assignment));
+        }
+
+        function spacerHtml(height) {
+            return '<tr class="grading-spacer" style="height: ' + height +
+                'px"><td colspan="9"></td></tr>';
+        }
+
+        /* Render just the rows which are in view, or nearly, with empty
+         * rows above and below standing in for the rest.  Rows are all the
+         * same height, so which are in view follows from how far the table
+         * is scrolled.  Does nothing if those rows are already rendered,
+         * unless `force` is set. */
+        function renderGradingRows(force) {
+            var container = $(element).find(".grading-rows");
+            var body = container.find(".grading-body");
+            var rows = gradingData.assignments;
+            if (!rowHeight && rows.length) {
+                body.html(gradingRowHtml(rows[0]));
+                rowHeight = body.children().first().outerHeight() || 64;
+            }
+            var height = container.height() || 20 * rowHeight;
+            var top = container.scrollTop();
+            var first = Math.max(0, Math.floor(top / rowHeight) - overscan);
+            var last = Math.min(
+                rows.length,
+                Math.ceil((top + height) / rowHeight) + overscan);
+            if (!force && renderedRows &&
+                    renderedRows[0] == first && renderedRows[1] == last) {
+                return;
+            }
+            var html = [spacerHtml(first * rowHeight)];
+            for (var i = first; i < last; i++) {
+                html.push(gradingRowHtml(rows[i]));
+            }
+            html.push(spacerHtml((rows.length - last) * rowHeight));
+            body.html(html.join(""));
+            renderedRows = [first, last];
+        }
+
+        /* Re-render one row, if it is in view. */
+        function renderGradingRow(module_id) {
+            var i = gradingIndex[module_id];
+            if (i === undefined || !renderedRows ||
+                    i < renderedRows[0] || i >= renderedRows[1]) {
+                return;
+            }
+            $(element).find("#row-" + module_id).replaceWith(
+                gradingRowHtml(gradingData.assignments[i]));
+        }
+
+        function rowAssignment(target) {
+            var module_id = $(target).parents("tr").data("module_id");
+            return gradingData.assignments[gradingIndex[module_id]];
+        }
+
+        /* Open the grade entry form for a student's row. */
+        function handleGradeEntry(assignment) {
             var form = $(element).find("#enter-grade-form");
-            $(element).find("#student-name").text(row.data("fullname"));
-            form.find("#module_id-input").val(row.data("module_id"));
-            form.find("#grade-input").val(row.data("score"));
-            form.find("#comment-input").text(row.data("comment"));
+            $(element).find("#student-name").text(assignment.fullname);
+            form.find("#module_id-input").val(assignment.module_id);
+            form.find("#grade-input").val(assignment.score);
+            form.find("#comment-input").text(assignment.comment);
             form.off("submit").on("submit", function(event) {
-                var max_score = row.parents("#grade-info").data("max_score");
+                var max_score = gradingData.max_score;
                 var score = Number(form.find("#grade-input").val());
                 event.preventDefault();
                 if (isNaN(score)) {
@@ -142,12 +526,40 @@ function StaffGradedAssignmentXBlock(runtime, element) {
                 else {
                     // No errors
                     $.post(enterGradeUrl, form.serialize())
-                        .success(renderStaffGrading);
+                        .success(patchStaffGrading);
                 }
             });
-            form.find("#remove-grade").on("click", function() {
-                var url = removeGradeUrl + "?module_id=" + row.data("module_id");
-                $.get(url).success(renderStaffGrading);
+            form.find("#remove-grade").off("click").on("click", function() {
+                var url = removeGradeUrl + "?module_id=" + assignment.module_id;
+                $.get(url).success(patchStaffGrading);
+            });
+            $(element).find("#enter-grade-trigger").click();
+        }
+
+        /* The gradebook is re-rendered as it changes and scrolls, so its
+         * controls are handled here, once, rather than bound to each
+         * row. */
+        function bindStaffGrading() {
+            var info = $(element).find("#grade-info");
+            info.on("change", "#grading-status", function() {
+                gradingQuery.status = $(this).val();
+                loadStaffGrading();
+            });
+            info.on("click", ".grading-sort", function(event) {
+                event.preventDefault();
+                gradingQuery.sort = $(this).data("sort");
+                loadStaffGrading();
+            });
+            info.on("click", "#grading-more", function() {
+                loadStaffGrading(gradingData.cursor);
+            });
+            info.on("click", ".enter-grade-button", function(event) {
+                event.preventDefault();
+                handleGradeEntry(rowAssignment(this));
+            });
+            info.on("click", ".upload-annotated", function() {
+                annotatedModuleId = rowAssignment(this).module_id;
+                info.find("#annotated-upload").click();
             });
         }
 
@@ -160,13 +572,21 @@ function StaffGradedAssignmentXBlock(runtime, element) {
             if (is_staff) {
                 gradingTemplate = _.template(
                     $(element).find("#sga-grading-tmpl").text());
+                gradingRowTemplate = _.template(
+                    $(element).find("#sga-grading-row-tmpl").text());
+                bindStaffGrading();
+                statisticsTemplate = _.template(
+                    $(element).find("#sga-statistics-tmpl").text());
+                loadStatistics();
                 block.find("#grade-submissions-button")
                     .leanModal()
                     .on("click", function() {
-                        $.ajax({
-                            url: getStaffGradingUrl,
-                            success: renderStaffGrading
-                        });
+                        if (gradingData) {
+                            syncStaffGrading();
+                        }
+                        else {
+                            loadStaffGrading();
+                        }
                     });
             }
         });
@@ -1,15 +1,26 @@
+import codecs
 import datetime
+import hashlib
 import json
 import mock
 import os
 import pkg_resources
 import pytz
+import StringIO
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 from courseware.models import StudentModule
 from django.contrib.auth.models import User
-from django.core.files.storage import FileSystemStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db import IntegrityError, connection
+from django.utils import translation
+from edx_sga.models import PendingGrade, Submission
 from student.models import UserProfile
 from xblock.field_data import DictFieldData
 
@@ -44,15 +55,85 @@ class DummyUpload(object):
     def read(self, n=None):
         return self.stream.read(n)
 
-    def seek(self, n):
-        return self.stream.seek(n)
+    def seek(self, n, whence=0):
+        return self.stream.seek(n, whence)
 
 
-class StaffGradedAssignmentXblockTests(unittest.TestCase):
+class DummyStream(object):
+    """
+    A request body, which can only be read straight through.
+    """
+
+    def __init__(self, data):
+        self.stream = StringIO.StringIO(data)
+
+    def read(self, n=-1):
+        return self.stream.read(n)
+
+
+class RewindingStorage(FileSystemStorage):
+    """
+    Reads each file through before saving it, and rewinds it, as backends
+    which checksum files before sending them do.
+    """
+
+    def _save(self, name, content):
+        content.seek(0, os.SEEK_END)
+        content.seek(0, os.SEEK_SET)
+        content.read()
+        content.seek(0, os.SEEK_SET)
+        return super(RewindingStorage, self)._save(name, content)
+
+
+class RemoteStorage(Storage):
+    """
+    Has no local paths, like storage backends which send files elsewhere,
+    and counts the files saved.
+    """
+
+    def __init__(self, location):
+        self.local = RewindingStorage(location)
+        self.saved = []
+
+    def _open(self, name, mode='rb'):
+        return self.local.open(name, mode)
+
+    def _save(self, name, content):
+        self.saved.append(name)
+        return self.local.save(name, content)
+
+    def delete(self, name):
+        self.local.delete(name)
+
+    def exists(self, name):
+        return self.local.exists(name)
+
+    def size(self, name):
+        return self.local.size(name)
+
+
+class CountQueries(object):
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.use_debug_cursor
+
+
+class StaffGradedAssignmentTestCase(unittest.TestCase):
 
     def setUp(self):
+        from edx_sga.sga import clear_caches
+        from edx_sga.utils import invalidate_statistics
+        clear_caches()
+        invalidate_statistics(('test_course', DummyLocation().url()))
         self.runtime = mock.Mock(course_id='test_course')
-        self.scope_ids = mock.Mock()
+        self.scope_ids = mock.Mock(user_id=1)
         tmp = tempfile.mkdtemp()
         patcher = mock.patch(
             "edx_sga.sga.default_storage",
@@ -75,10 +156,12 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         profile.save()
         module = StudentModule(
             module_state_key=block.location.url(),
+            module_type='edx_sga',
             student=user,
             course_id=block.xmodule_runtime.course_id,
             state=json.dumps(state))
         module.save()
+        Submission.update_from_state(module.id, state)
 
         self.addCleanup(profile.delete)
         self.addCleanup(module.delete)
@@ -92,6 +175,10 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         for k, v in state.items():
             setattr(block, k, v)
 
+
+
+class StaffGradedAssignmentXblockTests(StaffGradedAssignmentTestCase):
+
     def test_ctor(self):
         block = self.make_one(points=10, score=9)
         self.assertEqual(block.display_name, "Staff Graded Assignment")
@@ -130,12 +217,42 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
     @mock.patch('edx_sga.sga._resource', DummyResource)
     @mock.patch('edx_sga.sga.get_template')
     @mock.patch('edx_sga.sga.Fragment')
-    def test_student_view_publish_grade(self, Fragment, get_template):
+    def test_student_view_cached(self, Fragment, get_template):
+        block = self.make_one()
+        block.student_view()
+        block.student_view()
+        get_template.assert_called_once_with(
+            "staff_graded_assignment/show.html")
+        render = get_template.return_value.render
+        self.assertEqual(render.call_count, 1)
+        block.uploaded_sha1 = 'foo'
+        block.uploaded_filename = 'foo.bar'
+        block.student_view()
+        self.assertEqual(render.call_count, 2)
+
+    @mock.patch('edx_sga.sga._resource', DummyResource)
+    @mock.patch('edx_sga.sga.get_template')
+    @mock.patch('edx_sga.sga.Fragment')
+    def test_student_view_cached_per_language(self, Fragment, get_template):
+        block = self.make_one()
+        render = get_template.return_value.render
+        with translation.override('en'):
+            block.student_view()
+        with translation.override('fr'):
+            block.student_view()
+        self.assertEqual(render.call_count, 2)
+        with translation.override('en'):
+            block.student_view()
+        self.assertEqual(render.call_count, 2)
+
+    @mock.patch('edx_sga.sga._resource', DummyResource)
+    @mock.patch('edx_sga.sga.get_template')
+    @mock.patch('edx_sga.sga.Fragment')
+    def test_student_view_does_not_publish_grade(self, Fragment, get_template):
         block = self.make_one(score=9, points=10, score_published=False)
         block.student_view()
-        self.runtime.publish.assert_called_once_with(block, 'grade', {
-            'value': 9, 'max_value': 10})
-        self.assertEqual(block.score_published, True)
+        self.assertFalse(self.runtime.publish.called)
+        self.assertEqual(block.score_published, False)
 
     @mock.patch('edx_sga.sga._resource', DummyResource)
     @mock.patch('edx_sga.sga.get_template')
@@ -145,7 +262,8 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         block.student_view()
         context = get_template.return_value.render.call_args[0][0]
         student_state = json.loads(context['student_state'])
-        self.assertEqual(student_state['uploaded'], {'filename': 'foo.bar'})
+        self.assertEqual(student_state['uploaded'],
+                         {'filename': 'foo.bar', 'processing': None})
 
     @mock.patch('edx_sga.sga._resource', DummyResource)
     @mock.patch('edx_sga.sga.get_template')
@@ -171,7 +289,9 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         self.assertEqual(tuple(context['fields']), (
             (cls.display_name, 'Staff Graded Assignment', 'string'),
             (cls.points, 100, 'number'),
-            (cls.weight, '', 'number')
+            (cls.weight, '', 'number'),
+            (cls.max_file_size, '', 'number'),
+            (cls.allowed_file_types, '', 'string')
         ))
         fragment.add_javascript.assert_called_once_with(
             DummyResource("static/js/src/studio.js"))
@@ -191,16 +311,498 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         self.assertEqual(block.display_name, "Test Block")
         self.assertEqual(block.points, 23)
         self.assertEqual(block.weight, 11)
+        self.assertEqual(block.max_file_size, None)
+        block.save_sga(mock.Mock(body=json.dumps({
+            "max_file_size": "2.5",
+            "allowed_file_types": ".pdf, image/*"})))
+        self.assertEqual(block.max_file_size, 2.5)
+        self.assertEqual(block.upload_size_limit(), int(2.5 * 2**20))
+        self.assertEqual(block.allowed_file_types, ".pdf, image/*")
 
     def test_upload_download_assignment(self):
         path = pkg_resources.resource_filename(__package__, 'tests.py')
         expected = open(path, 'rb').read()
         upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
         block = self.make_one()
-        block.upload_assignment(mock.Mock(params={'assignment': upload}))
-        response = block.download_assignment(None)
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
+        response = block.download_assignment(mock.Mock(headers={}))
         self.assertEqual(response.body, expected)
 
+    def test_instrumentation(self):
+        from edx_sga import instrumentation, sga
+        sink = instrumentation.MemorySink()
+        patcher = mock.patch(
+            'edx_sga.sga.default_storage',
+            instrumentation.InstrumentedStorage(sga.default_storage))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        expected = open(path, 'rb').read()
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.scope_ids.user_id = fred.student_id
+        upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+        with mock.patch('edx_sga.instrumentation.SINKS', [sink]):
+            response = block.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None))
+            self.assertEqual(
+                json.loads(response.body)['uploaded']['filename'], 'test.txt')
+            self.personalize(block, fred)
+            response = block.download_assignment(mock.Mock(headers={}))
+            # Not measured in full until it has been sent
+            self.assertEqual(len(sink.measurements), 1)
+            self.assertEqual(response.body, expected)
+
+        upload, download = sink.measurements
+        self.assertEqual(upload.name, 'upload_assignment')
+        self.assertTrue(upload.queries > 0)
+        self.assertEqual(upload.storage_calls['save'], 1)
+        self.assertEqual(download.name, 'download_assignment')
+        self.assertEqual(download.storage_calls['open'], 1)
+        self.assertEqual(download.bytes_sent, len(expected))
+        self.assertEqual(download.error, None)
+
+    def test_upload_assignment_limits(self):
+        from edx_sga import sga
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        size = os.path.getsize(path)
+        block = self.make_one(allowed_file_types='.pdf, text/*')
+
+        def upload(name, content_length=None):
+            return block.upload_assignment(mock.Mock(
+                params={'assignment': mock.Mock(file=DummyUpload(path, name))},
+                content_length=content_length))
+
+        response = upload('test.exe')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(block.uploaded_sha1, None)
+
+        # The site wide limit applies to blocks without one of their own
+        with mock.patch('edx_sga.sga.MAX_UPLOAD_SIZE', size - 1):
+            response = block.upload_assignment(mock.Mock(
+                spec=['content_length'],
+                content_length=size + sga.UPLOAD_OVERHEAD))
+        self.assertEqual(response.status_code, 413)
+
+        block.max_file_size = float(size - 1) / 2**20
+        # Rejected before the body is read
+        request = mock.Mock(spec=['content_length'],
+                            content_length=size + sga.UPLOAD_OVERHEAD)
+        response = block.upload_assignment(request)
+        self.assertEqual(response.status_code, 413)
+
+        # Rejected as it is stored, since there's no Content-Length
+        response = upload('test.txt')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(block.uploaded_sha1, None)
+        self.assertEqual(sga.default_storage.listdir('foo/bar/baz/tmp'),
+                         ([], []))
+
+        block.max_file_size = float(size) / 2**20
+        upload('test.txt', size + 200)
+        self.assertEqual(block.uploaded_filename, 'test.txt')
+
+        response = block.upload_chunked(mock.Mock(params={
+            'filename': 'test.exe', 'size': 10}), 'init')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(block.chunked_upload, None)
+
+    def test_upload_assignment_graded_meanwhile(self):
+        from edx_sga import sga
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        block = self.make_one()
+        staff = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.scope_ids.user_id = fred.student_id
+        save_file = sga._save_file
+
+        def save_file_then_grade(*args):
+            sha1 = save_file(*args)
+            staff.enter_grade(mock.Mock(params={
+                'module_id': fred.id, 'grade': 9, 'comment': "Good!"}))
+            return sha1
+
+        with mock.patch('edx_sga.sga._save_file', save_file_then_grade):
+            upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+            data = block.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None)).json_body
+        self.assertEqual(data['uploaded']['filename'], 'test.txt')
+        self.assertEqual(data['graded'], {'score': 9, 'comment': "Good!"})
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['uploaded_filename'], 'test.txt')
+        self.assertEqual(state['score'], 9)
+        submission = Submission.objects.get(module=fred.id)
+        self.assertEqual(submission.uploaded_filename, 'test.txt')
+        self.assertEqual(submission.score, 9)
+        # The block's fields, as read before the grade, aren't changed, so
+        # they aren't saved over it
+        self.assertEqual(block.uploaded_sha1, None)
+
+    def test_upload_assignment_shows_in_gradebook(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.scope_ids.user_id = fred.student_id
+        upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
+        data = block.staff_grading_data(status='ungraded')
+        self.assertEqual(len(data['assignments']), 1)
+        self.assertEqual(data['assignments'][0]['module_id'], fred.id)
+        self.assertEqual(data['assignments'][0]['filename'], 'test.txt')
+
+    @mock.patch('edx_sga.processing._pool', None)
+    @mock.patch('edx_sga.processing.PROCESSING_POOL', 'inline')
+    def test_upload_processed(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.scope_ids.user_id = fred.student_id
+        processed = []
+
+        def processor(path, filename, mimetype, sha1):
+            processed.append((path, filename, mimetype, sha1))
+
+        def failing_processor(path, filename, mimetype, sha1):
+            raise ValueError("Infected!")
+
+        with mock.patch('edx_sga.processing.PROCESSORS', [processor]):
+            upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+            data = block.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None)).json_body
+            self.personalize(block, fred)
+            self.assertEqual(processed, [(
+                'foo/bar/baz/%s.txt' % block.uploaded_sha1, 'test.txt',
+                'text/plain', block.uploaded_sha1)])
+            self.assertEqual(data['uploaded']['processing'],
+                             {'status': 'done', 'error': ''})
+
+        with mock.patch('edx_sga.processing.PROCESSORS', [failing_processor]):
+            upload = mock.Mock(file=DummyUpload(path, 'other.txt'))
+            block.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None))
+            self.personalize(block, fred)
+            self.assertEqual(block.processing_status(),
+                             {'status': 'failed', 'error': 'Infected!'})
+
+    @mock.patch('edx_sga.processing._pool', lambda func, *args: None)
+    def test_upload_processing_lost(self):
+        from django.utils import timezone
+        from edx_sga import processing
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.scope_ids.user_id = fred.student_id
+        with mock.patch('edx_sga.processing.PROCESSORS', [mock.Mock()]):
+            upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+            block.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None))
+            self.personalize(block, fred)
+            self.assertEqual(block.processing_status(),
+                             {'status': 'pending', 'error': ''})
+
+            # The worker it was queued on went away
+            Submission.objects.filter(module=fred.id).update(
+                modified=timezone.now() - datetime.timedelta(
+                    seconds=processing.PROCESSING_TIMEOUT + 1))
+            failed = {'status': 'failed',
+                      'error': processing.LOST_PROCESSING_ERROR}
+            self.assertEqual(block.processing_status(), failed)
+            self.assertEqual(block.processing_status(), failed)
+
+    @mock.patch('edx_sga.previews.PDF_TIMEOUT', 0.1)
+    def test_pdf_preview_times_out(self):
+        from edx_sga import previews, sga
+        patcher = mock.patch(
+            'edx_sga.previews.default_storage', sga.default_storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        path = 'foo/bar/baz/abc.pdf'
+        sga.default_storage.save(path, ContentFile('%PDF-1.4'))
+        popen = subprocess.Popen
+        with mock.patch('subprocess.Popen',
+                        lambda args: popen(['sleep', '10'])):
+            with self.assertRaises(RuntimeError):
+                previews.generate_preview(
+                    path, 'abc.pdf', 'application/pdf', 'abc')
+        self.assertFalse(sga.default_storage.exists(
+            previews.preview_path(path)))
+
+    def test_staff_download_preview(self):
+        from PIL import Image
+        from edx_sga import previews, sga
+        patcher = mock.patch(
+            'edx_sga.previews.default_storage', sga.default_storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        image = StringIO.StringIO()
+        Image.new('RGB', (1000, 500), 'red').save(image, 'PNG')
+        image.seek(0)
+        image.name = 'red.png'
+
+        block = self.make_one()
+        sha1 = sga._save_file(block.location.url(), image, 'red.png')
+        fred = self.make_student_module(
+            block, "fred", uploaded_sha1=sha1, uploaded_filename='red.png',
+            uploaded_mimetype='image/png')
+        data = block.staff_grading_data()
+        self.assertEqual(data['assignments'][0]['preview'], False)
+        response = block.staff_download_preview(mock.Mock(headers={}, params={
+            'module_id': fred.id}))
+        self.assertEqual(response.status_code, 404)
+
+        path = 'foo/bar/baz/%s.png' % sha1
+        previews.generate_preview(path, 'red.png', 'image/png', sha1)
+        Submission.objects.filter(module=fred).update(
+            processing_status='done')
+        self.assertEqual(
+            block.staff_grading_data()['assignments'][0]['preview'], False)
+        with mock.patch('edx_sga.processing.PROCESSORS',
+                        [previews.PREVIEW_PROCESSOR]):
+            self.assertEqual(
+                block.staff_grading_data()['assignments'][0]['preview'], True)
+        response = block.staff_download_preview(mock.Mock(headers={}, params={
+            'module_id': fred.id}))
+        self.assertEqual(response.content_type, 'image/jpeg')
+        preview = Image.open(StringIO.StringIO(response.body))
+        self.assertEqual(preview.size, (240, 120))
+
+    def test_processing_thread_pool(self):
+        from edx_sga.processing import ThreadPool
+        pool = ThreadPool(2)
+        finish = threading.Event()
+        done = []
+
+        def work(n):
+            finish.wait()
+            done.append(n)
+
+        pool.submit(work, 1)
+        pool.submit(work, 2)
+        self.assertEqual(done, [])
+        finish.set()
+        pool.join()
+        self.assertEqual(sorted(done), [1, 2])
+
+    @mock.patch('edx_sga.sga.STORAGE_LAYOUT', 'shared')
+    def test_shared_storage_layout(self):
+        from edx_sga.sga import default_storage
+        from edx_sga.utils import blob_path
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        expected = open(path, 'rb').read()
+        block = self.make_one()
+        other = self.make_one()
+        other.location = DummyLocation()
+        other.location.parts = ('i4x', 'foo', 'bar', 'qux')
+        for b in (block, other):
+            upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+            b.upload_assignment(mock.Mock(
+                params={'assignment': upload}, content_length=None))
+        sha1 = block.uploaded_sha1
+        self.assertEqual(other.uploaded_sha1, sha1)
+        self.assertTrue(default_storage.exists(blob_path(sha1)))
+        self.assertFalse(default_storage.exists('foo/bar/baz/%s.txt' % sha1))
+        response = other.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.body, expected)
+
+        # Files stored before switching layout can still be read
+        default_storage.save('foo/bar/baz/0123.txt', ContentFile('Old'))
+        block.uploaded_sha1 = '0123'
+        response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.body, 'Old')
+
+    def test_upload_chunked(self):
+        block = self.make_one()
+
+        def upload(suffix, body='', **params):
+            return block.upload_chunked(mock.Mock(
+                params=params, body_file=StringIO.StringIO(body)), suffix)
+
+        data = upload('init', filename='test.txt', size=11).json_body
+        upload_id = data['upload_id']
+        self.assertEqual(data['offset'], 0)
+        data = upload('append', 'Hello ', upload_id=upload_id,
+                      offset=0).json_body
+        self.assertEqual(data['offset'], 6)
+
+        # Resuming carries on from the last chunk received
+        data = upload('init', filename='test.txt', size=11).json_body
+        self.assertEqual(data['upload_id'], upload_id)
+        self.assertEqual(data['offset'], 6)
+        response = upload('append', 'world', upload_id=upload_id, offset=0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json_body['offset'], 6)
+
+        upload('append', 'world', upload_id=upload_id, offset=6)
+        data = upload('finalize', upload_id=upload_id).json_body
+        self.assertEqual(data['uploaded'],
+                         {'filename': 'test.txt', 'processing': None})
+        self.assertEqual(block.chunked_upload, None)
+        response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.body, 'Hello world')
+
+    def test_storage_rewinds_uploads(self):
+        from edx_sga import sga
+        block = self.make_one()
+
+        def sha1(data):
+            return hashlib.sha1(data).hexdigest()
+
+        with mock.patch("edx_sga.sga.default_storage",
+                        RewindingStorage(tempfile.mkdtemp())):
+            upload = StringIO.StringIO('Hello')
+            upload.name = 'test.txt'
+            block.upload_assignment(mock.Mock(
+                params={'assignment': mock.Mock(file=upload)},
+                content_length=None))
+            self.assertEqual(block.uploaded_sha1, sha1('Hello'))
+
+            # Chunks are joined from storage
+            data = block.upload_chunked(mock.Mock(params={
+                'filename': 'test.txt', 'size': 11}), 'init').json_body
+            for offset, body in ((0, 'Hello '), (6, 'world')):
+                block.upload_chunked(mock.Mock(
+                    params={'upload_id': data['upload_id'], 'offset': offset},
+                    body_file=DummyStream(body)), 'append')
+            block.upload_chunked(mock.Mock(params={
+                'upload_id': data['upload_id']}), 'finalize')
+            self.assertEqual(block.uploaded_sha1, sha1('Hello world'))
+            response = block.download_assignment(mock.Mock(headers={}))
+            self.assertEqual(response.body, 'Hello world')
+
+            # Zip entries can't be sought
+            fred = self.make_student_module(block, "fred")
+            buf = StringIO.StringIO()
+            archive = zipfile.ZipFile(buf, 'w')
+            archive.writestr('fred.txt', 'Fred notes')
+            archive.close()
+            buf.seek(0)
+            block.staff_upload_annotated_zip(mock.Mock(params={
+                'annotated': mock.Mock(file=buf)}))
+            state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+            self.assertEqual(state['annotated_sha1'], sha1('Fred notes'))
+            self.assertTrue(sga.default_storage.exists(sga._stored_file_path(
+                block.location.url(), state['annotated_sha1'], 'fred.txt')))
+
+    def test_remote_storage_saves_once(self):
+        from edx_sga import sga
+        block = self.make_one()
+        storage = RemoteStorage(tempfile.mkdtemp())
+        with mock.patch("edx_sga.sga.default_storage", storage):
+            upload = StringIO.StringIO('Hello')
+            upload.name = 'test.txt'
+            block.upload_assignment(mock.Mock(
+                params={'assignment': mock.Mock(file=upload)},
+                content_length=None))
+            path = sga._stored_file_path(
+                block.location.url(), block.uploaded_sha1, 'test.txt')
+            self.assertEqual(storage.saved, [path])
+            self.assertEqual(storage.open(path).read(), 'Hello')
+
+            # Stored already
+            sga._save_file(block.location.url(), DummyStream('Hello'),
+                           'test.txt')
+            self.assertEqual(storage.saved, [path])
+
+            # S3 copies files itself
+            storage.bucket = mock.Mock()
+            storage.bucket.name = 'bucket'
+            storage._clean_name = storage._normalize_name = lambda name: name
+            storage._encode_name = lambda name: name
+            storage.local.save('tmp/one', ContentFile('Hello'))
+            sga._move_stored_file('tmp/one', 'files/one')
+            storage.bucket.copy_key.assert_called_once_with(
+                'files/one', 'bucket', 'tmp/one', preserve_acl=True)
+            self.assertFalse(storage.exists('tmp/one'))
+
+    @mock.patch('edx_sga.sga.MAX_UPLOAD_SIZE', 10)
+    def test_upload_chunked_too_large(self):
+        block = self.make_one()
+        response = block.upload_chunked(mock.Mock(params={
+            'filename': 'test.txt', 'size': 11}), 'init')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(block.chunked_upload, None)
+
+    def test_download_conditional_and_ranges(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        expected = open(path, 'rb').read()
+        upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+        block = self.make_one()
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
+
+        def download(**headers):
+            return block.download_assignment(mock.Mock(headers=headers))
+
+        response = download()
+        etag = '"%s"' % block.uploaded_sha1
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.content_length, len(expected))
+
+        response = download(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = download(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.body, expected[10:20])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 10-19/%d' % len(expected))
+
+        response = download(Range='bytes=10-19', **{'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, expected)
+
+        response = download(Range='bytes=0-4,-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.content_type.startswith(
+            'multipart/byteranges'))
+        self.assertEqual(response.content_length, len(response.body))
+        self.assertTrue(expected[:5] in response.body)
+        self.assertTrue(expected[-5:] in response.body)
+
+        response = download(Range='bytes=%d-' % len(expected))
+        self.assertEqual(response.status_code, 416)
+
+    def test_download_offloaded(self):
+        from edx_sga import sga
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+        block = self.make_one()
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
+        stored = sga._file_storage_path(
+            block.location.url(), block.uploaded_sha1, 'test.txt')
+
+        with mock.patch('edx_sga.sga.FILE_SERVING', 'x-sendfile'):
+            response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.headers['X-Sendfile'],
+                         sga.default_storage.path(stored))
+        self.assertEqual(response.body, '')
+
+        with mock.patch('edx_sga.sga.FILE_SERVING', 'x-accel-redirect'):
+            response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/sga-files/' + stored)
+        self.assertEqual(response.content_type, 'text/plain')
+
+        # The filesystem's URLs can't name the file, so it is streamed
+        with mock.patch('edx_sga.sga.FILE_SERVING', 'redirect'):
+            response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, open(path, 'rb').read())
+
+        url = mock.Mock(return_value='https://s3/signed')
+        with mock.patch('edx_sga.sga.FILE_SERVING', 'redirect'), \
+                mock.patch.object(sga.default_storage, 'url', url):
+            response = block.download_assignment(mock.Mock(headers={}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, 'https://s3/signed')
+        url.assert_called_once_with(stored, response_headers={
+            'response-content-disposition': 'attachment; filename=test.txt',
+            'response-content-type': 'text/plain',
+        })
+
     def test_staff_upload_download_annotated(self):
         path = pkg_resources.resource_filename(__package__, 'tests.py')
         expected = open(path, 'rb').read()
@@ -210,10 +812,38 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         block.staff_upload_annotated(mock.Mock(params={
             'annotated': upload,
             'module_id': fred.id}))
-        response = block.staff_download_annotated(mock.Mock(params={
+        response = block.staff_download_annotated(mock.Mock(headers={}, params={
             'module_id': fred.id}))
         self.assertEqual(response.body, expected)
 
+    def test_staff_upload_annotated_zip(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney")
+        wilma = self.make_student_module(
+            block, "wilma", uploaded_filename="essay.doc")
+        buf = StringIO.StringIO()
+        archive = zipfile.ZipFile(buf, 'w')
+        archive.writestr('fred/notes.txt', 'Fred notes')
+        archive.writestr('barney.txt', 'Barney notes')
+        archive.writestr('essay.doc', 'Wilma notes')
+        archive.writestr('dino.txt', 'Dino notes')
+        archive.close()
+        buf.seek(0)
+        data = block.staff_upload_annotated_zip(mock.Mock(params={
+            'annotated': mock.Mock(file=buf)})).json_body
+        self.assertEqual(
+            sorted((m['filename'], m['module_id']) for m in data['matched']),
+            [('barney.txt', barney.id), ('essay.doc', wilma.id),
+             ('fred/notes.txt', fred.id)])
+        self.assertEqual(data['unmatched'], [
+            {'filename': 'dino.txt', 'reason': "No matching student."}])
+        self.assertEqual(len(data['assignments']), 3)
+        self.personalize(block, fred)
+        self.assertEqual(block.annotated_filename, 'notes.txt')
+        response = block.download_annotated(mock.Mock(headers={}))
+        self.assertEqual(response.body, 'Fred notes')
+
     def test_download_annotated(self):
         path = pkg_resources.resource_filename(__package__, 'tests.py')
         expected = open(path, 'rb').read()
@@ -224,7 +854,7 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
             'annotated': upload,
             'module_id': fred.id}))
         self.personalize(block, fred)
-        response = block.download_annotated(None)
+        response = block.download_annotated(mock.Mock(headers={}))
         self.assertEqual(response.body, expected)
 
     def test_staff_download(self):
@@ -232,16 +862,266 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         expected = open(path, 'rb').read()
         upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
         block = self.make_one()
-        block.upload_assignment(mock.Mock(params={'assignment': upload}))
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
         fred = self.make_student_module(
             block, "fred",
             uploaded_sha1=block.uploaded_sha1,
             uploaded_filename=block.uploaded_filename,
             uploaded_mimetype=block.uploaded_mimetype)
-        response = block.staff_download(mock.Mock(params={
+        response = block.staff_download(mock.Mock(headers={}, params={
             'module_id': fred.id}))
         self.assertEqual(response.body, expected)
 
+    def test_staff_download_submissions(self):
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        expected = open(path, 'rb').read()
+        upload = mock.Mock(file=DummyUpload(path, 'test.txt'))
+        block = self.make_one()
+        block.upload_assignment(mock.Mock(
+            params={'assignment': upload}, content_length=None))
+        submission = {
+            'uploaded_sha1': block.uploaded_sha1,
+            'uploaded_filename': block.uploaded_filename,
+            'uploaded_mimetype': block.uploaded_mimetype,
+            'uploaded_timestamp': '2014-03-01T12:00:00.000000'}
+        self.make_student_module(block, "fred", **submission)
+        self.make_student_module(
+            block, "barney", score=10, score_published=True, **submission)
+        self.make_student_module(block, "wilma")
+
+        def download(**params):
+            response = block.staff_download_submissions(
+                mock.Mock(params=params))
+            self.assertEqual(response.content_type, 'application/zip')
+            return zipfile.ZipFile(StringIO.StringIO(response.body))
+
+        archive = download()
+        self.assertEqual(sorted(archive.namelist()),
+                         ['barney/test.txt', 'fred/test.txt'])
+        self.assertEqual(archive.read('fred/test.txt'), expected)
+        archive = download(status='ungraded')
+        self.assertEqual(archive.namelist(), ['fred/test.txt'])
+        archive = download(after='2014-04-01')
+        self.assertEqual(archive.namelist(), [])
+
+    def test_collect_garbage(self):
+        from edx_sga import sga
+        from edx_sga.garbage import collect_garbage
+        patcher = mock.patch(
+            'edx_sga.garbage.default_storage', sga.default_storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def upload(name, content, folder='foo/bar/baz/'):
+            path = folder + name
+            sga.default_storage.save(path, ContentFile(content))
+            return path
+
+        block = self.make_one()
+        self.make_student_module(
+            block, "fred", uploaded_sha1="abc", annotated_sha1="def",
+            chunked_upload={'upload_id': 'f00'})
+        self.make_student_module(block, "barney", uploaded_sha1="123")
+        live = [upload('abc.txt', 'Fred'), upload('def.pdf', 'Notes'),
+                upload('123.txt', 'Barney'), upload('tmp/f00/000000', 'Fr')]
+        dead = [upload('456.txt', 'Old'), upload('tmp/0123abcd.txt', 'Tmp'),
+                upload('tmp/ba5/000000', 'Gone')]
+        # Files shared between blocks
+        live.append(upload('abc', 'Fred', 'sga-blobs/ab/c/'))
+        dead.append(upload('789', 'Old', 'sga-blobs/78/9/'))
+
+        self.assertEqual(collect_garbage(), (9, 0))
+        zero = datetime.timedelta(0)
+        self.assertEqual(collect_garbage(dry_run=True, min_age=zero), (9, 4))
+        self.assertTrue(all(map(sga.default_storage.exists, dead)))
+        self.assertEqual(collect_garbage(course_id='test_course',
+                                         min_age=zero, batch_size=1), (7, 3))
+        self.assertEqual(collect_garbage(min_age=zero), (6, 1))
+        self.assertFalse(any(map(sga.default_storage.exists, dead)))
+        self.assertTrue(all(map(sga.default_storage.exists, live)))
+
+    def test_collect_garbage_file_used_again(self):
+        from edx_sga import garbage, sga
+        patcher = mock.patch(
+            'edx_sga.garbage.default_storage', sga.default_storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred", uploaded_sha1="abc")
+        paths = ['foo/bar/baz/456.txt', 'sga-blobs/78/9/789']
+        for path in paths:
+            sga.default_storage.save(path, ContentFile('Old'))
+        live_references, live_blobs = (
+            garbage._live_references, garbage._live_blobs)
+
+        def go_back(state):
+            StudentModule.objects.filter(pk=fred.id).update(
+                state=json.dumps(state))
+            Submission.update_from_state(fred.id, state)
+
+        def references_then_go_back(modules, batch_size):
+            live = live_references(modules, batch_size)
+            go_back({'uploaded_sha1': '456'})
+            return live
+
+        def blobs_then_go_back(sha1s):
+            live = live_blobs(sha1s)
+            if not blobs_then_go_back.called:
+                blobs_then_go_back.called = True
+                go_back({'uploaded_sha1': '456', 'annotated_sha1': '789'})
+            return live
+        blobs_then_go_back.called = False
+
+        with mock.patch('edx_sga.garbage._live_references',
+                        references_then_go_back):
+            with mock.patch('edx_sga.garbage._live_blobs',
+                            blobs_then_go_back):
+                self.assertEqual(garbage.collect_garbage(
+                    min_age=datetime.timedelta(0)), (2, 0))
+        self.assertTrue(all(map(sga.default_storage.exists, paths)))
+
+    def test_collect_garbage_file_stored_again(self):
+        from edx_sga import garbage, sga
+        patcher = mock.patch(
+            'edx_sga.garbage.default_storage', sga.default_storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        block = self.make_one()
+        self.make_student_module(block, "fred")
+        url = block.location.url()
+        sha1 = sga._save_file(url, StringIO.StringIO('Old'), 'old.txt')
+        path = sga._file_storage_path(url, sha1, 'old.txt')
+        long_ago = time.time() - 7 * 24 * 3600
+        os.utime(sga.default_storage.path(path), (long_ago, long_ago))
+        live_references = garbage._live_references
+
+        def references_then_store(modules, batch_size):
+            # Eg an annotated zip, whose states are saved once every file
+            # in it has been stored
+            live = live_references(modules, batch_size)
+            sga._save_file(url, StringIO.StringIO('Old'), 'old.txt')
+            return live
+
+        with mock.patch('edx_sga.garbage._live_references',
+                        references_then_store):
+            self.assertEqual(garbage.collect_garbage(), (1, 0))
+        self.assertTrue(sga.default_storage.exists(path))
+
+    def test_staff_download_grades(self):
+        block = self.make_one()
+        self.make_student_module(
+            block, "fred", uploaded_sha1="abc", uploaded_filename="foo.txt",
+            uploaded_timestamp="2014-03-01T12:00:00.000000", score=7,
+            comment=u"Tr\xe8s bien")
+        self.make_student_module(block, "barney")
+        response = block.staff_download_grades(mock.Mock(params={}))
+        self.assertEqual(response.content_type, 'text/csv')
+        self.assertEqual(response.body.splitlines(), [
+            "username,fullname,filename,timestamp,score,comment,annotated",
+            "barney,barney,,,,,",
+            "fred,fred,foo.txt,2014-03-01T12:00:00.000000,7.0,"
+            "Tr\xc3\xa8s bien,",
+        ])
+
+    def test_staff_download_course_grades(self):
+        from django.core.management import call_command
+        block = self.make_one()
+        fred = self.make_student_module(
+            block, "fred", uploaded_sha1="abc", score=7)
+        self.make_student_module(block, "barney")
+        other = self.make_one()
+        other.location = DummyLocation()
+        other.location.parts = ('i4x', 'foo', 'bar', 'qux')
+        module = StudentModule(
+            module_state_key=other.location.url(), module_type='edx_sga',
+            student=fred.student, course_id='test_course', state='{}')
+        module.save()
+        self.addCleanup(module.delete)
+        Submission.update_from_state(module.id, {'uploaded_sha1': 'def'})
+
+        response = block.staff_download_course_grades(mock.Mock(params={}))
+        self.assertEqual(response.content_type, 'text/csv')
+        self.assertEqual(response.body.splitlines(), [
+            "username,fullname,baz,baz status,qux,qux status",
+            "fred,fred,7.0,published,,ungraded",
+            "barney,barney,,missing,,missing",
+        ])
+
+        response = block.staff_download_course_grades(
+            mock.Mock(params={'format': 'json'}))
+        data = json.loads(response.body)
+        self.assertEqual(data['assignments'], [
+            'i4x://foo/bar/baz', 'i4x://foo/bar/qux'])
+        self.assertEqual(data['learners'][0], {
+            'username': 'fred', 'fullname': 'fred', 'cells': [
+                {'status': 'published', 'score': 7.0},
+                {'status': 'ungraded', 'score': None}]})
+
+        output = StringIO.StringIO()
+        call_command('sga_gradebook', course_id='test_course', batch_size=1,
+                     stdout=output)
+        self.assertEqual(output.getvalue().splitlines()[1:], [
+            "fred,fred,7.0,published,,ungraded",
+            "barney,barney,,missing,,missing",
+        ])
+
+    def test_staff_upload_grades(self):
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney", score=5)
+        wilma = self.make_student_module(block, "wilma")
+        grades = "\r\n".join([
+            codecs.BOM_UTF8 + "username,fullname,score,comment",
+            "fred,Fred,9,Tr\xc3\xa8s bien",
+            "barney,Barney,,",
+            "wilma,Wilma,11,",
+            "dino,Dino,3,",
+        ])
+        upload = mock.Mock(file=StringIO.StringIO(grades))
+        data = block.staff_upload_grades(mock.Mock(params={
+            'grades': upload})).json_body
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['errors'], [
+            {'line': 4, 'error': "Maximum score is 10.0."},
+            {'line': 5, 'error': "No such student."}])
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], 9)
+        self.assertEqual(state['comment'], u"Tr\xe8s bien")
+        self.assertEqual(StudentModule.objects.get(pk=fred.id).grade, 9)
+        state = json.loads(StudentModule.objects.get(pk=barney.id).state)
+        self.assertEqual(state['score'], 5)
+        state = json.loads(StudentModule.objects.get(pk=wilma.id).state)
+        self.assertEqual(state, {})
+
+        upload = mock.Mock(file=StringIO.StringIO("name,grade\r\n"))
+        response = block.staff_upload_grades(mock.Mock(params={
+            'grades': upload}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_upload_grades_malformed(self):
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney")
+        wilma = self.make_student_module(block, "wilma")
+        grades = "\r\n".join([
+            "username,score",
+            "fred,7",
+            "barney,8",
+            "wil\0ma,9",
+            "wilma,9",
+        ])
+        upload = mock.Mock(file=StringIO.StringIO(grades))
+        data = block.staff_upload_grades(mock.Mock(params={
+            'grades': upload})).json_body
+        # The rows before the one which can't be read are still entered
+        self.assertEqual(data['updated'], 2)
+        self.assertEqual(data['errors'], [
+            {'line': 4, 'error': "line contains NUL"}])
+        for module, score in ((fred, 7), (barney, 8), (wilma, None)):
+            state = json.loads(StudentModule.objects.get(pk=module.id).state)
+            self.assertEqual(state.get('score'), score)
+
     def test_get_staff_grading_data(self):
         block = self.make_one()
         barney = self.make_student_module(
@@ -251,7 +1131,7 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
             annotated_filename="foo_corrected.txt",
             comment="Good work!")
         fred = self.make_student_module(block, "fred")
-        data = block.get_staff_grading_data(None).json_body
+        data = block.get_staff_grading_data(mock.Mock(params={})).json_body
         assignments = sorted(data['assignments'], key=lambda x: x['username'])
         self.assertEqual(assignments[0]['module_id'], barney.id)
         self.assertEqual(assignments[0]['username'], 'barney')
@@ -268,6 +1148,143 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         self.assertEqual(assignments[1]['annotated'], None)
         self.assertEqual(assignments[1]['comment'], '')
 
+    def test_staff_grading_data_query_count(self):
+        block = self.make_one()
+        self.make_student_module(block, "fred")
+        with CountQueries() as few:
+            block.staff_grading_data()
+        for name in ("barney", "wilma", "betty", "dino"):
+            self.make_student_module(block, name, uploaded_filename="foo.txt")
+        with CountQueries() as many:
+            data = block.staff_grading_data()
+        self.assertEqual(len(data['assignments']), 5)
+        self.assertEqual(few.count, 1)
+        self.assertEqual(many.count, few.count)
+
+    def test_get_staff_grading_data_paginated(self):
+        block = self.make_one()
+        for name in ("fred", "barney", "wilma", "betty", "dino"):
+            self.make_student_module(block, name)
+        with CountQueries():
+            data = block.get_staff_grading_data(mock.Mock(params={
+                'limit': 2})).json_body
+            self.assertIn('LIMIT 3', connection.queries[-1]['sql'])
+        self.assertEqual(
+            [a['username'] for a in data['assignments']], ['barney', 'betty'])
+        data = block.get_staff_grading_data(mock.Mock(params={
+            'limit': 2, 'cursor': data['cursor']})).json_body
+        self.assertEqual(
+            [a['username'] for a in data['assignments']], ['dino', 'fred'])
+        data = block.get_staff_grading_data(mock.Mock(params={
+            'limit': 2, 'cursor': data['cursor']})).json_body
+        self.assertEqual(
+            [a['username'] for a in data['assignments']], ['wilma'])
+        self.assertEqual(data['cursor'], None)
+
+    def test_get_staff_grading_data_sort_and_filter(self):
+        block = self.make_one()
+        upload = {'uploaded_sha1': 'abc', 'uploaded_filename': 'foo.txt'}
+        self.make_student_module(
+            block, "fred", score=7, score_published=False, **upload)
+        self.make_student_module(
+            block, "barney", score=9, score_published=True, **upload)
+        self.make_student_module(
+            block, "wilma", score=8, score_published=True, **upload)
+        self.make_student_module(block, "betty", **upload)
+        self.make_student_module(block, "dino")
+
+        def usernames(**params):
+            data = block.get_staff_grading_data(
+                mock.Mock(params=params)).json_body
+            return [a['username'] for a in data['assignments']]
+
+        self.assertEqual(usernames(sort='score'),
+                         ['fred', 'wilma', 'barney', 'betty', 'dino'])
+        self.assertEqual(usernames(status='published'), ['barney', 'wilma'])
+        self.assertEqual(usernames(status='unpublished'), ['fred'])
+        self.assertEqual(usernames(status='ungraded'), ['betty'])
+        self.assertEqual(usernames(status='missing'), ['dino'])
+        data = block.get_staff_grading_data(mock.Mock(params={})).json_body
+        self.assertEqual(
+            [a['status'] for a in data['assignments']],
+            ['published', 'ungraded', 'missing', 'unpublished', 'published'])
+        response = block.get_staff_grading_data(mock.Mock(params={
+            'sort': 'shoe size'}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_staff_grading_data_since(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney")
+        StudentModule.objects.filter(pk=fred.id).update(
+            modified=datetime.datetime(2010, 5, 12, 2, 42, tzinfo=pytz.utc))
+        data = block.get_staff_grading_data(mock.Mock(params={
+            'since': '2012-01-01T00:00:00.000000'})).json_body
+        self.assertEqual(
+            [a['module_id'] for a in data['assignments']], [barney.id])
+        self.assertTrue(data['since'])
+
+    def test_get_statistics(self):
+        from edx_sga.utils import invalidate_statistics
+        block = self.make_one(points=10)
+        upload = {'uploaded_sha1': 'abc', 'uploaded_filename': 'foo.txt'}
+        fred = self.make_student_module(block, "fred", **upload)
+        self.make_student_module(
+            block, "barney", score=9, score_published=True, **upload)
+        self.make_student_module(
+            block, "wilma", score=4, score_published=False, **upload)
+        self.make_student_module(block, "dino")
+        data = block.get_statistics(mock.Mock(params={})).json_body
+        self.assertEqual(data['students'], 4)
+        self.assertEqual(data['submitted'], 3)
+        self.assertEqual(data['graded'], 2)
+        self.assertEqual(data['unpublished'], 1)
+        self.assertEqual(data['average_score'], 6.5)
+        self.assertEqual(data['histogram'], [0, 0, 0, 0, 1, 0, 0, 0, 0, 1])
+
+        with CountQueries() as cached:
+            block.statistics()
+        self.assertEqual(cached.count, 0)
+
+        # Grading and publishing update the cached statistics in place
+        block.enter_grade(mock.Mock(params={'module_id': fred.id, 'grade': 10}))
+        with CountQueries() as updated:
+            data = block.statistics()
+        self.assertEqual(updated.count, 0)
+        self.assertEqual(data['graded'], 3)
+        self.assertEqual(data['unpublished'], 1)
+        self.assertEqual(data['average_score'], 23 / 3.0)
+        self.assertEqual(data['histogram'], [0, 0, 0, 0, 1, 0, 0, 0, 0, 2])
+        invalidate_statistics(('test_course', block.location.url()))
+        self.assertEqual(block.statistics(), data)
+
+        # So do students whose state is made as they upload, once
+        pebbles = self.make_student_module(block, "pebbles")
+        Submission.objects.filter(module=pebbles.id).delete()
+        self.scope_ids.user_id = pebbles.student_id
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        for _ in range(2):
+            block.upload_assignment(mock.Mock(params={
+                'assignment': mock.Mock(file=DummyUpload(path, 'test.txt'))},
+                content_length=None))
+            data = block.statistics()
+            self.assertEqual(data['students'], 5)
+            self.assertEqual(data['submitted'], 4)
+        invalidate_statistics(('test_course', block.location.url()))
+        self.assertEqual(block.statistics(), data)
+
+    def test_enter_grade_returns_changed_row(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        self.make_student_module(block, "barney")
+        data = block.enter_grade(mock.Mock(params={
+            'module_id': fred.id,
+            'grade': 9,
+            'comment': "Good!"})).json_body
+        self.assertEqual(len(data['assignments']), 1)
+        self.assertEqual(data['assignments'][0]['module_id'], fred.id)
+        self.assertEqual(data['assignments'][0]['score'], 9)
+
     def test_enter_grade(self):
         block = self.make_one()
         fred = self.make_student_module(block, "fred")
@@ -279,6 +1296,209 @@ class StaffGradedAssignmentXblockTests(unittest.TestCase):
         self.assertEqual(state['score'], 9)
         self.assertEqual(state['comment'], 'Good!')
 
+        for grade in ('nan', '-1', '101', ''):
+            response = block.enter_grade(mock.Mock(params={
+                'module_id': fred.id,
+                'grade': grade}))
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(response.json_body['error'])
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], 9)
+
+    def concurrently(self, module, times, **change):
+        """
+        Patches `json.loads` so that the next `times` states read for
+        `module` are changed by someone else straight after being read.
+        """
+        loads = json.loads
+        writes = []
+
+        def read_then_change(state, *args, **kw):
+            value = loads(state, *args, **kw)
+            if len(writes) < times and isinstance(value, dict):
+                writes.append(change)
+                changed = dict(value, **change)
+                changed[change.keys()[0] + '_writes'] = len(writes)
+                StudentModule.objects.filter(pk=module.id).update(
+                    state=json.dumps(changed))
+            return value
+
+        return mock.patch('edx_sga.sga.json.loads', read_then_change)
+
+    def test_state_compared_exactly(self):
+        from edx_sga.sga import _with_state
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred", comment="Good")
+        modules = StudentModule.objects.filter(pk=fred.id)
+        state = json.dumps({'comment': "Good"})
+        self.assertTrue(_with_state(modules, state).exists())
+        for other in (state.upper(), state + ' ', None):
+            self.assertFalse(_with_state(modules, other).exists())
+
+    def test_enter_grade_concurrent_change(self):
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        with self.concurrently(fred, 2, uploaded_filename='new.txt'):
+            response = block.enter_grade(mock.Mock(params={
+                'module_id': fred.id,
+                'grade': 9,
+                'comment': "Good!"}))
+        self.assertEqual(response.status_code, 200)
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], 9)
+        self.assertEqual(state['uploaded_filename'], 'new.txt')
+        self.assertEqual(state['uploaded_filename_writes'], 2)
+        self.assertEqual(
+            Submission.objects.get(module=fred.id).uploaded_filename,
+            'new.txt')
+
+    def test_enter_grade_conflict(self):
+        from edx_sga.sga import STATE_UPDATE_ATTEMPTS
+        block = self.make_one()
+        fred = self.make_student_module(block, "fred")
+        with self.concurrently(fred, STATE_UPDATE_ATTEMPTS, comment="Mine"):
+            response = block.enter_grade(mock.Mock(params={
+                'module_id': fred.id,
+                'grade': 9,
+                'comment': "Good!"}))
+        self.assertEqual(response.status_code, 409)
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['comment'], 'Mine')
+        self.assertFalse('score' in state)
+
+    def test_enter_grade_publishes_grade(self):
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        block.enter_grade(mock.Mock(params={
+            'module_id': fred.id,
+            'grade': 9,
+            'comment': "Good!"}))
+        fred = StudentModule.objects.get(pk=fred.id)
+        self.assertEqual(fred.grade, 9)
+        self.assertEqual(fred.max_grade, 10)
+        self.assertEqual(json.loads(fred.state)['score_published'], True)
+        self.assertFalse(PendingGrade.objects.filter(module=fred).exists())
+
+    def test_publish_grades_retries(self):
+        from edx_sga.publishing import publish_grades
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        with mock.patch('edx_sga.publishing._publish',
+                        side_effect=Exception("Database on fire")):
+            block.enter_grade(mock.Mock(params={
+                'module_id': fred.id,
+                'grade': 9}))
+        pending = PendingGrade.objects.get(module=fred)
+        self.assertEqual(pending.attempts, 1)
+        self.assertEqual(pending.last_error, "Database on fire")
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score_published'], False)
+
+        self.assertEqual(publish_grades(), (1, 0))
+        fred = StudentModule.objects.get(pk=fred.id)
+        self.assertEqual(fred.grade, 9)
+        self.assertEqual(json.loads(fred.state)['score_published'], True)
+        self.assertFalse(PendingGrade.objects.filter(module=fred).exists())
+        self.assertTrue(Submission.objects.get(module=fred).score_published)
+
+    @mock.patch('edx_sga.publishing.modulestore')
+    def test_queue_unpublished_grades(self, modulestore):
+        from django.core.management import call_command
+        block = self.make_one(points=10)
+        modulestore.return_value.get_instance.return_value = block
+        # Entered before upgrading, so waiting for fred to view it
+        fred = self.make_student_module(
+            block, "fred", score=9, score_published=False)
+        barney = self.make_student_module(
+            block, "barney", score=None, score_published=False)
+        wilma = self.make_student_module(block, "wilma", score=7)
+
+        call_command('publish_sga_grades', queue_unpublished=True)
+        fred = StudentModule.objects.get(pk=fred.id)
+        self.assertEqual((fred.grade, fred.max_grade), (9, 10))
+        self.assertEqual(json.loads(fred.state)['score_published'], True)
+        barney = StudentModule.objects.get(pk=barney.id)
+        self.assertEqual(json.loads(barney.state)['score_published'], True)
+        self.assertEqual(StudentModule.objects.get(pk=wilma.id).grade, None)
+        self.assertEqual(
+            modulestore.return_value.get_instance.call_count, 1)
+
+    def test_backfill_sga_submissions(self):
+        from django.core.management import call_command
+        block = self.make_one()
+        fred = self.make_student_module(
+            block, "fred", uploaded_sha1="abc", uploaded_filename="foo.txt",
+            uploaded_timestamp="2014-03-01T12:00:00.000000", score=7)
+        barney = self.make_student_module(block, "barney")
+        StudentModule.objects.filter(pk__in=(fred.id, barney.id)).update(
+            module_type='edx_sga')
+        Submission.objects.filter(module=fred).delete()
+        Submission.objects.filter(module=barney).update(comment="Stale")
+
+        call_command('backfill_sga_submissions')
+        submission = Submission.objects.get(module=fred)
+        self.assertEqual(submission.uploaded_filename, "foo.txt")
+        self.assertEqual(submission.uploaded_timestamp, datetime.datetime(
+            2014, 3, 1, 12, tzinfo=pytz.utc))
+        self.assertEqual(submission.score, 7)
+        self.assertEqual(Submission.objects.get(module=barney).comment, "Stale")
+
+        call_command('backfill_sga_submissions', refresh=True)
+        self.assertEqual(Submission.objects.get(module=barney).comment, "")
+
+    def test_enter_grades(self):
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney")
+        wilma = self.make_student_module(block, "wilma")
+        data = block.enter_grades(mock.Mock(method='POST', body=json.dumps({
+            'grades': [
+                {'module_id': fred.id, 'grade': 9, 'comment': "Good!"},
+                {'module_id': barney.id, 'grade': 11},
+                {'module_id': wilma.id, 'grade': 'A+'},
+                {'module_id': 0, 'grade': 5},
+            ]}))).json_body
+        results = data['results']
+        self.assertEqual([r['success'] for r in results],
+                         [True, False, False, False])
+        self.assertEqual(results[1]['error'], "Maximum score is 10.0.")
+        self.assertEqual(results[3]['error'], "No such student module.")
+        self.assertEqual(
+            [a['module_id'] for a in data['assignments']], [fred.id])
+        state = json.loads(StudentModule.objects.get(pk=fred.id).state)
+        self.assertEqual(state['score'], 9)
+        self.assertEqual(state['comment'], 'Good!')
+        self.assertEqual(state['score_published'], True)
+        state = json.loads(StudentModule.objects.get(pk=barney.id).state)
+        self.assertEqual(state, {})
+
+    def test_enter_grades_submission_created_meanwhile(self):
+        block = self.make_one(points=10)
+        fred = self.make_student_module(block, "fred")
+        barney = self.make_student_module(block, "barney")
+        Submission.objects.filter(module=barney).delete()
+        create = Submission.objects.create
+
+        def create_meanwhile(**kw):
+            # Someone else creates barney's submission first
+            create(**kw)
+            raise IntegrityError("Duplicate entry")
+
+        body = json.dumps({'grades': [
+            {'module_id': fred.id, 'grade': 9},
+            {'module_id': barney.id, 'grade': 8},
+        ]})
+        with mock.patch.object(Submission.objects, 'create',
+                               side_effect=create_meanwhile):
+            data = block.enter_grades(
+                mock.Mock(method='POST', body=body)).json_body
+        self.assertEqual([r['success'] for r in data['results']], [True, True])
+        for module, score in ((fred, 9), (barney, 8)):
+            state = json.loads(StudentModule.objects.get(pk=module.id).state)
+            self.assertEqual(state['score'], score)
+            self.assertEqual(
+                Submission.objects.get(module=module).score, score)
+
     def test_remove_grade(self):
         block = self.make_one()
         fred = self.make_student_module(
@@ -0,0 +1,185 @@
+"""
+Helpers shared by the XBlock and the management commands.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+BATCH_SIZE = 500
+
+# How long, in seconds, a block's grading statistics stay cached.  They are
+# updated in place whenever a submission or grade changes, so this only
+# bounds how long a change lost to another request writing them at the same
+# time, or made while they were being computed, can go uncounted.
+STATISTICS_CACHE_TIMEOUT = getattr(
+    settings, 'SGA_STATISTICS_CACHE_TIMEOUT', 300)
+
+# The number of equal bins, from zero to the maximum score, in the score
+# histogram.
+HISTOGRAM_BINS = 10
+
+# Where uploaded files are stored.  With 'block', each block has a folder of
+# its own, so a file uploaded to several blocks is stored several times.  With
+# 'shared', files are stored once, in a folder shared by every block, keyed
+# only by their SHA1.  Files stored under the block layout can still be read
+# after switching to 'shared'.
+STORAGE_LAYOUT = getattr(settings, 'SGA_STORAGE_LAYOUT', 'block')
+
+# The folder for the shared layout.  Files are spread over two levels of
+# subfolders by the first four hex digits of their SHA1, so that no folder
+# holds more than a small fraction of them.
+BLOB_PREFIX = 'sga-blobs'
+
+
+def iterate_in_batches(query, batch_size=BATCH_SIZE, order=('id',),
+                       start=None):
+    """
+    Iterates over the rows of a `values` query in `order`, which must be
+    unique, fetching `batch_size` rows at a time.  If `start` is given, it is
+    the `order` values of the row to start after.  Each batch is fetched by
+    starting after the last row of the batch before, rather than with an
+    offset, so memory use and the cost of each query stay bounded however
+    many rows there are.
+    """
+    query = query.order_by(*order)
+    while True:
+        batch = query
+        if start is not None:
+            batch = batch.filter(_after(order, start))
+        batch = list(batch[:batch_size])
+        for row in batch:
+            yield row
+        if len(batch) < batch_size:
+            return
+        start = [batch[-1][column] for column in order]
+
+
+def _after(order, values):
+    """
+    Returns a filter for the rows which come after `values` in `order`.
+    """
+    column, value = order[0], values[0]
+    after = Q(**{column + '__gt': value})
+    if len(order) > 1:
+        after |= Q(**{column: value}) & _after(order[1:], values[1:])
+    return after
+
+
+def statistics_cache_key(course_id, location):
+    """
+    Returns the cache key for the grading statistics of the block at
+    `location`, a usage id, in the given course.
+    """
+    key = hashlib.sha1(u'%s|%s' % (course_id, location)).hexdigest()
+    return 'edx_sga.statistics.' + key
+
+
+def histogram_bin(score, max_score):
+    """
+    Returns which of the `HISTOGRAM_BINS` a score falls in.
+    """
+    index = int(score * HISTOGRAM_BINS / max_score)
+    return max(0, min(index, HISTOGRAM_BINS - 1))
+
+
+def statistics_row(state):
+    """
+    Returns what a student's state, or the `Submission` columns of the same
+    names, counts for in the grading statistics: whether they have
+    submitted, their score and whether it has been published.
+    """
+    return (state.get('uploaded_sha1') is not None, state.get('score'),
+            state.get('score_published', True))
+
+
+def update_statistics(course_id, location, changes, created=()):
+    """
+    Counts changes to students' states in the cached grading statistics of
+    the block at `location`, if there are any, at the cost of a cache read
+    and write.  `changes` are `(old, new)` pairs of `statistics_row`s.
+    `created` are when the student modules of students who are counted for
+    the first time were made.  Those made since the statistics were
+    computed add to the number of students.
+    """
+    key = statistics_cache_key(course_id, location)
+    stats = cache.get(key)
+    if stats is None:
+        return
+    for old, new in changes:
+        _count(stats, old, -1)
+        _count(stats, new, 1)
+    if 'computed' in stats:
+        stats['students'] += len(
+            [time for time in created if time > stats['computed']])
+    # Keep the time they were computed at, so that any miscount expires
+    timeout = int(stats['expires'] - time.time())
+    if timeout > 0:
+        cache.set(key, stats, timeout)
+    else:
+        cache.delete(key)
+
+
+def _count(stats, row, sign):
+    submitted, score, published = row
+    if submitted:
+        stats['submitted'] += sign
+    if score is None:
+        return
+    stats['graded'] += sign
+    stats['total_score'] += sign * score
+    if not published:
+        stats['unpublished'] += sign
+    if stats['max_score']:
+        stats['histogram'][histogram_bin(score, stats['max_score'])] += sign
+
+
+def invalidate_statistics(*blocks):
+    """
+    Drops the cached grading statistics of `blocks`, which are
+    `(course_id, location)` pairs.
+    """
+    keys = set(statistics_cache_key(course_id, location)
+               for course_id, location in blocks)
+    if keys:
+        cache.delete_many(list(keys))
+
+
+def storage_prefix(url):
+    """
+    Returns the folder, in the storage backend, where files for the block at
+    `url` are stored.
+    """
+    assert url.startswith("i4x://")
+    return url[6:]
+
+
+def blob_path(sha1):
+    """
+    Returns where the file with the given SHA1 is stored under the shared
+    storage layout.
+    """
+    return '%s/%s/%s/%s' % (BLOB_PREFIX, sha1[:2], sha1[2:4], sha1)
+
+
+class CSVLine(object):
+    """
+    A file for `csv.writer` which hands each line back, rather than writing
+    it anywhere, so rows can be yielded as they are written.
+    """
+
+    def write(self, line):
+        return line
+
+
+def csv_value(value):
+    """
+    Encodes a value for `csv.writer`, which wants byte strings.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
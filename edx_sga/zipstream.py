@@ -0,0 +1,156 @@
+"""
+Writes ZIP archives as a stream of chunks, without seeking, so an archive can
+be sent to the client while it is being built.  Neither the archive nor any
+of the files in it are ever held in memory or written to disk.
+
+The standard library's `zipfile` module needs a seekable file to write to, so
+it can't be used for this.  Each file's local header is written with the
+"data descriptor" flag set, and the CRC and sizes, which are only known once
+the file has been read, follow the file data.  Archives larger than 4GB use
+the ZIP64 extensions.
+"""
+import struct
+import zlib
+
+ZIP64_LIMIT = 0xffffffff
+ZIP_FILECOUNT_LIMIT = 0xffff
+
+# Files are stored, not compressed.  Submissions are mostly PDFs, images and
+# videos, which are compressed already, and deflating tens of gigabytes
+# would make the server CPU bound for little gain.
+ZIP_STORED = 0
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+VERSION = 20
+VERSION_ZIP64 = 45
+
+
+class _Entry(object):
+
+    def __init__(self, name, date_time, offset, zip64):
+        self.name = name
+        self.date_time = date_time
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.size = 0
+
+
+def stream_zip(files):
+    """
+    Generates the chunks of a ZIP archive containing `files`, which is an
+    iterable of `(name, date_time, size, chunks)` tuples.  `date_time` is a
+    `datetime` for the file's modification time, `size` is the expected size
+    of the file, or `None` if not known, and `chunks` is an iterable of the
+    file's contents.  `files` and `chunks` are consumed lazily.
+    """
+    entries = []
+    offset = 0
+    for name, date_time, size, chunks in files:
+        zip64 = size is None or size >= ZIP64_LIMIT
+        entry = _Entry(name.encode('utf8'), date_time, offset, zip64)
+        entries.append(entry)
+
+        header = _local_header(entry)
+        offset += len(header)
+        yield header
+
+        crc = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            crc = zlib.crc32(chunk, crc)
+            entry.size += len(chunk)
+            offset += len(chunk)
+            yield chunk
+        entry.crc = crc & 0xffffffff
+
+        descriptor = _data_descriptor(entry)
+        offset += len(descriptor)
+        yield descriptor
+
+    cd_offset = offset
+    cd_size = 0
+    for entry in entries:
+        record = _central_directory_record(entry)
+        cd_size += len(record)
+        yield record
+
+    yield _end_of_central_directory(len(entries), cd_size, cd_offset)
+
+
+def _dos_date_time(date_time):
+    date = ((max(date_time.year, 1980) - 1980) << 9 |
+            date_time.month << 5 | date_time.day)
+    time = (date_time.hour << 11 | date_time.minute << 5 |
+            date_time.second // 2)
+    return date, time
+
+
+def _local_header(entry):
+    date, time = _dos_date_time(entry.date_time)
+    if entry.zip64:
+        # Sizes follow in the data descriptor, as 64 bit values.
+        version = VERSION_ZIP64
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        size = ZIP64_LIMIT
+    else:
+        version = VERSION
+        extra = b''
+        size = 0
+    return struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, version,
+        FLAG_DATA_DESCRIPTOR | FLAG_UTF8, ZIP_STORED, time, date, 0, size,
+        size, len(entry.name), len(extra)) + entry.name + extra
+
+
+def _data_descriptor(entry):
+    if entry.zip64:
+        return struct.pack(
+            '<IIQQ', 0x08074b50, entry.crc, entry.size, entry.size)
+    if entry.size >= ZIP64_LIMIT:
+        raise ValueError(
+            "%s is larger than its expected size." % entry.name)
+    return struct.pack('<IIII', 0x08074b50, entry.crc, entry.size, entry.size)
+
+
+def _central_directory_record(entry):
+    date, time = _dos_date_time(entry.date_time)
+    extra = []
+    size = entry.size
+    if size >= ZIP64_LIMIT:
+        extra.extend((size, size))
+        size = ZIP64_LIMIT
+    offset = entry.offset
+    if offset >= ZIP64_LIMIT:
+        extra.append(offset)
+        offset = ZIP64_LIMIT
+    if extra:
+        extra = struct.pack(
+            '<HH%dQ' % len(extra), 0x0001, 8 * len(extra), *extra)
+    else:
+        extra = b''
+    version = VERSION_ZIP64 if entry.zip64 or extra else VERSION
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version,
+        FLAG_DATA_DESCRIPTOR | FLAG_UTF8, ZIP_STORED, time, date, entry.crc,
+        size, size, len(entry.name), len(extra), 0, 0, 0, 0o100644 << 16,
+        offset) + entry.name + extra
+
+
+def _end_of_central_directory(count, cd_size, cd_offset):
+    records = b''
+    if (count >= ZIP_FILECOUNT_LIMIT or cd_size >= ZIP64_LIMIT or
+            cd_offset >= ZIP64_LIMIT):
+        zip64_offset = cd_offset + cd_size
+        records += struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, 3 << 8 | VERSION_ZIP64,
+            VERSION_ZIP64, 0, 0, count, count, cd_size, cd_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+        count = min(count, ZIP_FILECOUNT_LIMIT)
+        cd_size = min(cd_size, ZIP64_LIMIT)
+        cd_offset = min(cd_offset, ZIP64_LIMIT)
+    return records + struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0)